@@ -8,8 +8,8 @@
 #
 
 from pymate.matenet import MateNET, MateDevice, MateMXDevice, MateFXDevice, MateDCDevice
-from time import sleep
-from datetime import datetime
+from pymate.engine import CollectionEngine
+from datetime import datetime, timedelta
 from base64 import b64encode
 import urllib2
 import json
@@ -102,7 +102,7 @@ def collect_logpage():
 	try:
 		logpage = mx.get_logpage(-1)  # Get yesterday's logpage
 
-		day = datetime(now.year, now.month, now.day-1)
+		day = datetime.now() - timedelta(days=1)
 
 		ts, tz = timestamp()
 		return {
@@ -224,66 +224,25 @@ def synchronize():
 
 ##### COLLECTION STARTS #####
 
-log.info("Starting collection...")
-now = datetime.now()
-
-# Calculate datetime of next status collection
-t_next_status = now + STATUS_INTERVAL
-t_next_fx_status = now + FXSTATUS_INTERVAL
-t_next_dc_status = now + DCSTATUS_INTERVAL
-t_next_sync = now + SYNC_INTERVAL
-
-# Calculate datetime of next logpage collection
-d = now.date()
-t = LOGPAGE_RETRIEVAL_TIME
-t_next_logpage = datetime(d.year, d.month, d.day, t.hour, t.minute, t.second, t.microsecond) + timedelta(days=1)
-log.debug("Next logpage: " + str(t_next_logpage))
-
-# Collect status and log pages
-while True:
-	try:
-		sleep(1.0)
-		now = datetime.now()
-
-		# Time to collect a log page
-		if now >= t_next_logpage:
-			if mx:
-				t_next_logpage += timedelta(days=1)
-				log.debug("Next logpage: " + str(t_next_logpage))
-
-				packet = collect_logpage()
-				if packet:
-					upload_packet(packet)
-
-		# Time to collect status
-		if now >= t_next_status:
-			t_next_status = now + STATUS_INTERVAL
-			
-			if mx:
-				packet = collect_status()
-				if packet:
-					upload_packet(packet)
-
-		if now >= t_next_fx_status:
-			t_next_fx_status = now + FXSTATUS_INTERVAL
-			if fx:
-				packet = collect_fx()
-				if packet:
-					upload_packet(packet)
-
-		if now >= t_next_dc_status:
-			t_next_dc_status = now + DCSTATUS_INTERVAL
-			if dc:
-				packet = collect_dc()
-				if packet:
-					upload_packet(packet)
-		
-		if now >= t_next_sync:
-			t_next_sync = now + SYNC_INTERVAL
-			synchronize()
-		
-	except Exception as e:
-		# Don't terminate the program, log and keep collecting.
-		# sleep will keep things from going out of control.
-		log.exception("EXCEPTION in main")
+def upload(collect):
+	"""
+	Create a task which collects a packet and uploads it
+	"""
+	def task():
+		packet = collect()
+		if packet:
+			upload_packet(packet)
+	return task
+
+engine = CollectionEngine()
+if mx:
+	engine.add('mx-status', upload(collect_status), STATUS_INTERVAL)
+	engine.add_daily('mx-logpage', upload(collect_logpage), LOGPAGE_RETRIEVAL_TIME)
+if fx:
+	engine.add('fx-status', upload(collect_fx), FXSTATUS_INTERVAL)
+if dc:
+	engine.add('dc-status', upload(collect_dc), DCSTATUS_INTERVAL)
+engine.add('sync', synchronize, SYNC_INTERVAL)
 
+log.info("Starting collection...")
+engine.run()
@@ -3,6 +3,31 @@ __author__ = 'Jared'
 from struct import calcsize, unpack_from, Struct
 
 
+# Buffers that Struct.unpack_from() can read directly
+_BUFFER_TYPES = (str, bytearray, memoryview, buffer)
+
+
+def iter_unpack(fmt, data, offset=0):
+    """
+    Unpack a buffer containing several fixed-size records, one after the other
+    fmt: a python struct (Struct)
+    data: str, bytearray or memoryview
+    offset: Where the first record starts within the buffer
+    Returns an iterator of tuples (one per record)
+    """
+    size = fmt.size
+    if (len(data) - offset) % size != 0:
+        raise RuntimeError("Error parsing structs - buffer length (%d bytes) is not a multiple of the record size (%d bytes)"
+                           % (len(data) - offset, size))
+
+    if hasattr(fmt, 'iter_unpack'):
+        # Not available in Python 2
+        view = memoryview(data)
+        return fmt.iter_unpack(view[offset:] if offset else view)
+
+    return (fmt.unpack_from(data, i) for i in range(offset, len(data), size))
+
+
 def struct(fmt, fields):
     """
     Construct a new struct class which matches the provided format and fields.
@@ -52,27 +77,43 @@ def struct(fmt, fields):
                 setattr(self, name, value)
 
         @classmethod
-        def from_buffer(cls, data):
+        def from_buffer(cls, data, offset=0):
             """
-            Unpack a buffer of data into a struct object
+            Unpack a buffer of data into a struct object.
+            data can be a str, bytearray or memoryview, which is unpacked in place (no copies are made).
+            offset: Where the struct starts within the buffer.
+                If 0, the buffer must be exactly the size of the struct.
             """
 
             if data is None:
                 raise RuntimeError("Error parsing struct - no data provided")
 
-            # Length validation
-            data_len = len(data)
-            if data_len != cls._size:
-                raise RuntimeError("Error parsing struct - invalid length (Got %d bytes, expected %d)" % (data_len, cls._size))
-
             # Convert to binary string if necessary
-            if not isinstance(data, (str, unicode)):
+            if isinstance(data, unicode):
+                data = data.encode('latin-1')  # One byte per character
+            elif not isinstance(data, _BUFFER_TYPES):
                 data = ''.join(chr(c) for c in data)
 
+            # Length validation
+            data_len = len(data) - offset
+            if data_len < cls._size or (offset == 0 and data_len != cls._size):
+                raise RuntimeError("Error parsing struct - invalid length (Got %d bytes, expected %d)" % (data_len, cls._size))
+
             # Construct new struct class
-            values = cls._fmt.unpack(data)
+            values = cls._fmt.unpack_from(data, offset)
             return cls(*values)
 
+        @classmethod
+        def iter_from_buffer(cls, data, offset=0):
+            """
+            Unpack a buffer containing several structs, one after the other
+            data: str, bytearray or memoryview
+            offset: Where the first struct starts within the buffer
+            Returns an iterator of struct objects
+            """
+            for values in iter_unpack(cls._fmt, data, offset):
+                yield cls(*values)
+
         def to_buffer(self):
             """
             Convert the struct into a packed data format
@@ -0,0 +1,235 @@
+# pyMATE collection engine
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Runs periodic collection tasks (status polls, log pages, synchronization, etc.)
+# from a heap of deadlines on a monotonic clock.
+#
+#  - The engine sleeps exactly until the next task is due, instead of waking up periodically.
+#  - Each task keeps a fixed cadence: the next deadline is based on the previous deadline,
+#    not on when the task actually ran, so late runs don't cause the schedule to drift.
+#  - How late each task ran is recorded, so sample timing can be checked.
+#
+# Usage:
+#   engine = CollectionEngine()
+#   engine.add('mx-status', collect_status, interval=10.0)
+#   engine.add_daily('mx-logpage', collect_logpage, at=time(hour=0, minute=5))
+#   engine.run()
+#
+
+__author__ = 'Jared'
+
+from pymate.util import monotonic
+from datetime import datetime, timedelta
+from time import sleep
+import itertools
+import heapq
+import logging
+
+
+def _seconds(interval):
+    if isinstance(interval, timedelta):
+        return interval.total_seconds()
+    return float(interval)
+
+
+class Task(object):
+    """
+    A function which is called at a fixed interval
+    """
+    def __init__(self, name, fn, interval, deadline):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.deadline = deadline  # When the task is next due (monotonic)
+
+        # Statistics
+        self.runs = 0
+        self.skipped = 0          # Deadlines that were missed entirely (the task ran too late)
+        self.lateness = 0.0       # How late the last run was (seconds)
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    @property
+    def mean_lateness(self):
+        return (self.total_lateness / self.runs) if self.runs else 0.0
+
+    def reschedule(self, now):
+        """
+        Calculate the next deadline, after the task has run
+        """
+        self.deadline += self.interval
+        if self.deadline <= now:
+            # We're more than a whole interval behind, skip the missed deadlines
+            # rather than running the task several times in a row.
+            missed = int((now - self.deadline) // self.interval) + 1
+            self.deadline += missed * self.interval
+            self.skipped += missed
+
+    def __repr__(self):
+        return 'Task(%s, runs=%d, mean_lateness=%.3fs, max_lateness=%.3fs)' % (
+            self.name, self.runs, self.mean_lateness, self.max_lateness)
+
+
+class DailyTask(Task):
+    """
+    A function which is called at a particular (local) time of day
+    """
+    def __init__(self, name, fn, at):
+        self.at = at
+
+        # Wall-clock time the task is next due
+        now = datetime.now()
+        self._target = datetime.combine(now.date(), self.at)
+        if self._target <= now:
+            self._target += timedelta(days=1)
+
+        super(DailyTask, self).__init__(name, fn, 24*60*60, self._next_deadline())
+
+    def _next_deadline(self):
+        # Based on the wall clock, so the task follows changes to the system time (eg. DST)
+        return monotonic() + (self._target - datetime.now()).total_seconds()
+
+    def reschedule(self, now):
+        # Advance from the previous target, rather than from the current wall-clock time.
+        # The task is fired by the monotonic clock, so the wall clock may still be slightly
+        # before the target (eg. NTP slew), which would otherwise run the task again straight away.
+        self._target += timedelta(days=1)
+
+        wall_now = datetime.now()
+        if self._target <= wall_now:
+            # The task ran more than a day late (or the clock jumped forward), skip the missed days
+            missed = (wall_now - self._target).days + 1
+            self._target += timedelta(days=missed)
+            self.skipped += missed
+
+        self.deadline = self._next_deadline()
+
+
+class SchedulerTask(Task):
+    """
+    Runs an AdaptiveScheduler (see scheduler.py), whose deadlines vary with the data
+    """
+    def __init__(self, name, scheduler, callback=None):
+        self.scheduler = scheduler
+        self.callback = callback
+        self.delay = 0.0
+        super(SchedulerTask, self).__init__(name, self._run, 0.0, monotonic())
+
+    def _run(self):
+        self.delay = self.scheduler.run_pending(self.callback)
+
+    def reschedule(self, now):
+        self.deadline = monotonic() + (1.0 if self.delay is None else self.delay)
+
+
+class CollectionEngine(object):
+    """
+    Runs collection tasks when they are due
+    """
+    def __init__(self):
+        self.log = logging.getLogger('mate.engine')
+        self.tasks = []  # heap of (deadline, seq, Task)
+        self.current = None  # The task that is waiting to run or running (not in the heap), see run_once()
+        self.running = False
+        self._seq = itertools.count()
+
+        # Log a warning if a task runs later than this (seconds)
+        self.LATE_WARNING = 1.0
+
+        # Called with (task, lateness) after each task runs
+        self.on_run = None
+
+    def _push(self, task):
+        heapq.heappush(self.tasks, (task.deadline, next(self._seq), task))
+        return task
+
+    def add(self, name, fn, interval, delay=None):
+        """
+        Call fn() every interval
+        :param interval: seconds (or timedelta)
+        :param delay: Time until the first call, defaults to one interval
+        :return: Task
+        """
+        interval = _seconds(interval)
+        delay = interval if delay is None else _seconds(delay)
+        return self._push(Task(name, fn, interval, monotonic() + delay))
+
+    def add_daily(self, name, fn, at):
+        """
+        Call fn() once a day
+        :param at: datetime.time (local time)
+        :return: DailyTask
+        """
+        return self._push(DailyTask(name, fn, at))
+
+    def add_scheduler(self, scheduler, callback=None, name='adaptive'):
+        """
+        Run an AdaptiveScheduler alongside the other tasks (see scheduler.py)
+        :return: SchedulerTask
+        """
+        return self._push(SchedulerTask(name, scheduler, callback))
+
+    def remove(self, task):
+        self.tasks = [entry for entry in self.tasks if entry[2] is not task]
+        heapq.heapify(self.tasks)
+
+    def run_once(self):
+        """
+        Wait until the next task is due, and run it
+        """
+        deadline, _, task = heapq.heappop(self.tasks)
+        self.current = task
+        try:
+            self._run_task(deadline, task)
+        finally:
+            self.current = None
+
+    def _run_task(self, deadline, task):
+        delay = deadline - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+        now = monotonic()
+        lateness = max(0.0, now - deadline)
+        task.runs += 1
+        task.lateness = lateness
+        task.total_lateness += lateness
+        task.max_lateness = max(task.max_lateness, lateness)
+        if lateness > self.LATE_WARNING:
+            self.log.warning('%s ran %.3fs late', task.name, lateness)
+
+        try:
+            task.fn()
+        except Exception:
+            # Don't stop collecting, just log and carry on
+            self.log.exception('Exception in task %s', task.name)
+
+        if self.on_run:
+            self.on_run(task, lateness)
+
+        task.reschedule(monotonic())
+        self._push(task)
+
+    def run(self):
+        """
+        Run tasks until stop() is called
+        """
+        self.running = True
+        try:
+            while self.running and self.tasks:
+                self.run_once()
+        finally:
+            self.running = False
+
+    def stop(self):
+        self.running = False
+
+    def stats(self):
+        """
+        :return: dict of {name: Task}, for reporting timing statistics
+        """
+        tasks = [task for _, _, task in list(self.tasks)]
+        current = self.current
+        if current is not None:
+            tasks.append(current)
+        return dict((task.name, task) for task in tasks)
@@ -4,10 +4,18 @@ __author__ = 'Jared'
 from matedevice import MateDevice
 from matenet_pjon import MateNETPJON
 from matenet_ser import MateNETSerial
+try:
+    from matenet_termios import MateNETTermios
+except ImportError:
+    pass  # Not supported on this platform (requires termios)
 from matenet import MateNET
+from transaction import TransactionRecord
+from errors import ChecksumError, InvalidCommandError
+from eventloop import EventLoop, AsyncMateNET
 from mx import MateMXDevice
 from fx import MateFXDevice
 from flexnetdc import MateDCDevice
+from snapshot import poll_snapshot, Snapshot
 
 # DEPRECATED:
 from matedevice import Mate
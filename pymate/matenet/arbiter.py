@@ -0,0 +1,266 @@
+# pyMATE bus arbiter
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# The MateNET bus is half-duplex, and a response must be read before the
+# next command is sent. If two threads talk to the bus at the same time,
+# their packets will be interleaved and both transactions will fail.
+#
+# The arbiter owns the bus: a single thread executes transactions one at a time,
+# taking them from a priority queue. Other threads submit transactions and
+# get a BusFuture back, which they can wait on.
+#
+
+__author__ = 'Jared'
+
+from threading import Thread, Event, Lock, current_thread
+from Queue import PriorityQueue, Empty
+import itertools
+import logging
+import sys
+
+# Lower values are executed first
+PRIORITY_STOP    = -1
+PRIORITY_CONTROL = 0  # Writes/controls (eg. operator commands)
+PRIORITY_QUERY   = 1  # Register reads
+PRIORITY_STATUS  = 2  # Routine status/log page polls
+
+
+class BusFuture(object):
+    """
+    The result of a transaction that has been submitted to the bus arbiter
+    """
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        :return: True if the transaction has completed (successfully or not)
+        """
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the transaction to complete, and return its result.
+        If the transaction raised an exception, it is re-raised here.
+        :param timeout: seconds to wait, None to wait indefinitely
+        """
+        if not self._event.wait(timeout):
+            raise RuntimeError("Timed out waiting for bus transaction")
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the transaction to complete, and return the exception it raised (or None)
+        :param timeout: seconds to wait, None to wait indefinitely
+        """
+        if not self._event.wait(timeout):
+            raise RuntimeError("Timed out waiting for bus transaction")
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(future) when the transaction completes.
+        The callback is executed by the arbiter thread, so it should not block.
+        If the transaction has already completed, fn is called immediately.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def then(self, fn):
+        """
+        Chain a function onto the result of this future.
+        :param fn: Called with the result, if the transaction succeeded
+        :return: A new BusFuture, whose result is fn(result)
+        """
+        future = BusFuture()
+        def callback(f):
+            if f._exc_info:
+                future.set_exception(f._exc_info)
+                return
+            try:
+                future.set_result(fn(f._result))
+            except Exception:
+                future.set_exception(sys.exc_info())
+        self.add_done_callback(callback)
+        return future
+
+    @staticmethod
+    def gather(futures):
+        """
+        Combine several futures into one
+        :param futures: list of BusFuture
+        :return: A new BusFuture, whose result is the list of results (in the same order).
+            If any of the futures fail, the new future fails with the same exception.
+        """
+        future = BusFuture()
+        futures = list(futures)
+        remaining = [len(futures)]
+        lock = Lock()
+
+        def callback(f):
+            with lock:
+                if future.done():
+                    return
+                if f._exc_info:
+                    future.set_exception(f._exc_info)
+                    return
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    future.set_result([x._result for x in futures])
+
+        if not futures:
+            future.set_result([])
+        for f in futures:
+            f.add_done_callback(callback)
+        return future
+
+    def set_result(self, result):
+        self._result = result
+        self._complete()
+
+    def set_exception(self, exc_info):
+        """
+        :param exc_info: As returned by sys.exc_info()
+        """
+        self._exc_info = exc_info
+        self._complete()
+
+    def _complete(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.getLogger('mate.arbiter').exception('Exception in BusFuture callback')
+
+
+class BusArbiter(object):
+    """
+    Executes bus transactions one at a time from a single thread,
+    in order of priority (and in order of submission for equal priorities).
+
+    Usage:
+    arbiter = BusArbiter()
+    arbiter.start()
+    future = arbiter.submit(bus.query, (0x0000,), priority=PRIORITY_QUERY)
+    value = future.result()
+    """
+    def __init__(self, name='MateNET'):
+        self.name = name
+        self.log = logging.getLogger('mate.arbiter')
+        self.queue = PriorityQueue()
+        self.thread = None
+        self.stopped = False  # Set by stop(), after which nothing more can be submitted
+        self._lock = Lock()   # Guards stopped, so nothing is queued behind the STOP sentinel
+        self._seq = itertools.count()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def is_owner(self):
+        """
+        :return: True if called from the arbiter thread
+        """
+        return current_thread() is self.thread
+
+    def start(self):
+        """
+        Start the arbiter thread
+        """
+        if self.running:
+            return
+        with self._lock:
+            self.stopped = False
+        self.thread = Thread(target=self._run, name='%s arbiter' % self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the arbiter thread, once the current transaction has completed.
+        Any transactions still waiting in the queue will fail, as will any submitted afterwards.
+        """
+        with self._lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            if self.running:
+                self.queue.put((PRIORITY_STOP, next(self._seq), None, None, None, None))
+
+        if self.is_owner():
+            return  # The thread stops once the current transaction returns
+        if self.thread is not None:
+            self.thread.join(timeout)
+        if not self.running:
+            self._fail_pending()
+
+    def submit(self, fn, args=(), kwargs=None, priority=PRIORITY_QUERY):
+        """
+        Queue a transaction to be executed by the arbiter thread
+        :param fn: The function that performs the transaction
+        :param args: Positional arguments for fn
+        :param kwargs: Keyword arguments for fn
+        :param priority: See PRIORITY_* constants
+        :return: BusFuture
+        """
+        future = BusFuture()
+        if self.is_owner():
+            # Already on the arbiter thread (eg. called from a transaction), so just run it
+            self._execute(future, fn, args, kwargs or {})
+            return future
+
+        with self._lock:
+            if not self.stopped:
+                self.queue.put((priority, next(self._seq), future, fn, args, kwargs or {}))
+                return future
+        self._fail(future)
+        return future
+
+    @staticmethod
+    def _fail(future):
+        try:
+            raise RuntimeError("Bus arbiter stopped")
+        except RuntimeError:
+            future.set_exception(sys.exc_info())
+
+    def _fail_pending(self):
+        """
+        Fail anything that was left in the queue
+        """
+        while True:
+            try:
+                priority, _, future, fn, args, kwargs = self.queue.get_nowait()
+            except Empty:
+                break
+            if future is not None:
+                self._fail(future)
+
+    def _execute(self, future, fn, args, kwargs):
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception:
+            future.set_exception(sys.exc_info())
+
+    def _run(self):
+        while True:
+            priority, _, future, fn, args, kwargs = self.queue.get()
+            if fn is None:
+                break
+            self._execute(future, fn, args, kwargs)
+
+        self._fail_pending()
+        self.log.debug('Arbiter stopped')
@@ -0,0 +1,208 @@
+# pyMATE bulk decoder
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Decodes many raw status packets at once using NumPy, eg. to re-analyse the
+# raw_packet column of a year of history.
+# The same decoding as the packet classes (MXStatusPacket.from_buffer(), etc.) is applied,
+# but to whole columns at a time rather than one packet at a time.
+#
+# NumPy is optional, and only required to use this module.
+#
+# Usage:
+#   columns = decode_mx_status(rows)          # list of raw packets, or one contiguous buffer
+#   print columns['bat_voltage'].mean()
+#
+#   array = decode_dc_status(data, structured=True)
+#   print array['bat_power'][:10]
+#
+#   logpages = decode_mx_logpages(archive)    # eg. 128 days of log pages
+#   print logpages['kilowatt_hours'].sum()
+#
+
+__author__ = 'Jared'
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Not installed
+
+from mx import MXStatusPacket, MXLogPagePacket
+from fx import FXStatusPacket
+from flexnetdc import DCStatusPacket
+
+# NumPy type for each struct format character
+_DTYPES = {
+    'B': 'u1',
+    'b': 'i1',
+    'H': 'u2',
+    'h': 'i2',
+    'I': 'u4',
+    'i': 'i4',
+}
+
+
+def _packet_dtype(fmt):
+    """
+    Convert a struct format (eg. '>BbH5B') to a NumPy dtype, with one field per unpacked value
+    """
+    spec = fmt.format
+    byteorder = '<'
+    if spec[0] in '<>!=@':
+        byteorder = '>' if spec[0] in '>!' else '<'
+        spec = spec[1:]
+
+    fields = []
+    count = ''
+    for c in spec:
+        if c.isdigit():
+            count += c
+            continue
+        for _ in range(int(count or 1)):
+            fields.append(('v%d' % len(fields), byteorder + _DTYPES[c]))
+        count = ''
+    return np.dtype(fields)
+
+
+def _unpack(packet_cls, data):
+    """
+    Unpack many raw packets
+    :param data: A contiguous buffer of packets (str/bytearray/memoryview/ndarray), or a list of raw packets
+    :return: list of int32 arrays, one for each unpacked value (same order as fmt.unpack())
+    """
+    if np is None:
+        raise RuntimeError("NumPy is required for bulk decoding")
+
+    if isinstance(data, (list, tuple)):
+        # str() of a memoryview is its repr, so convert each packet through bytearray
+        data = ''.join(packet if isinstance(packet, str) else bytes(bytearray(packet)) for packet in data)
+
+    size = packet_cls.fmt.size
+    if len(data) % size != 0:
+        raise RuntimeError("Error decoding packets - buffer length (%d bytes) is not a multiple of the packet size (%d bytes)"
+                           % (len(data), size))
+
+    records = np.frombuffer(data, dtype=_packet_dtype(packet_cls.fmt))
+    # Widen, so the bit manipulation below doesn't overflow
+    return [records[name].astype(np.int32) for name in records.dtype.names]
+
+
+def _simple_fields(packet_cls, values):
+    """
+    Decode the fields defined with value_field()/int_field()
+    :return: {name: array}
+    """
+    columns = {}
+    for name, f in packet_cls.FIELDS.items():
+        if f.index is None:
+            continue
+        column = values[f.index]
+        if f.is_int:
+            columns[name] = column
+        elif f.divisor is None:
+            columns[name] = column.astype(np.float64)
+        else:
+            columns[name] = column / f.divisor
+    return columns
+
+
+def _result(columns, structured):
+    """
+    :return: The columns as a dict, or as a structured array (columns sorted by name)
+    """
+    if not structured:
+        return columns
+    names = sorted(columns)
+    n = len(columns[names[0]]) if names else 0
+    array = np.empty(n, dtype=[(name, columns[name].dtype) for name in names])
+    for name in names:
+        array[name] = columns[name]
+    return array
+
+
+def decode_mx_status(data, structured=False):
+    """
+    Decode many MX status packets (see MXStatusPacket)
+    :param data: A contiguous buffer of packets, or a list of raw packets
+    :param structured: True to return a structured array rather than a dict of columns
+    :return: {field name: array}, or a structured array
+    """
+    v = _unpack(MXStatusPacket, data)
+    columns = _simple_fields(MXStatusPacket, v)
+
+    columns['amp_hours'] = (((v[0] & 0x70) >> 4) | v[4]).astype(np.float64) # Ignore bit7 (if 0, MATE hides the AH reading)
+    columns['pv_current'] = ((128 + v[1]) % 256).astype(np.float64)
+    columns['bat_current'] = ((128 + v[2]) % 256) + ((v[0] & 0x0F) / 10.0)
+    columns['kilowatt_hours'] = ((v[3] << 8) | v[8]) / 10.0
+    columns['aux_state'] = (v[5] & 0x40) == 0x40
+    columns['aux_mode'] = v[5] & 0x3F
+
+    return _result(columns, structured)
+
+
+def decode_mx_logpages(data, structured=False):
+    """
+    Decode many MX log pages (see MXLogPagePacket)
+    :param data: A contiguous buffer of log pages, or a list of raw log pages
+    :param structured: True to return a structured array rather than a dict of columns
+    :return: {field name: array}, or a structured array
+    """
+    v = _unpack(MXLogPagePacket, data)
+    columns = _simple_fields(MXLogPagePacket, v)
+
+    # Reassemble the 10 and 12-bit values packed across byte boundaries
+    columns['bat_max']        = (((v[1] & 0xFC) >> 2) | ((v[2] & 0x0F) << 6)) / 10.0
+    columns['bat_min']        = (((v[9] & 0xC0) >> 6) | (v[10] << 2) | ((v[11] & 0x03) << 10)) / 10.0
+    columns['kilowatt_hours'] = (((v[2] & 0xF0) >> 4) | (v[3] << 4)) / 10.0
+    columns['amp_hours']      = (v[8] | ((v[9] & 0x3F) << 8)).astype(np.float64)
+    columns['amps_peak']      = (v[0] | ((v[1] & 0x03) << 8)) / 10.0
+    columns['absorb_time']    = (v[5] | ((v[6] & 0x0F) << 8)).astype(np.float64)
+    columns['float_time']     = (((v[6] & 0xF0) >> 4) | (v[7] << 4)).astype(np.float64)
+    columns['kilowatts_peak'] = (((v[12] & 0xFC) >> 2) | (v[11] << 6)) / 1000.0
+
+    return _result(columns, structured)
+
+
+def decode_fx_status(data, structured=False):
+    """
+    Decode many FX status packets (see FXStatusPacket), including the derived power values.
+    Each packet is scaled according to its own 230V flag.
+    :param data: A contiguous buffer of packets, or a list of raw packets
+    :param structured: True to return a structured array rather than a dict of columns
+    :return: {field name: array}, or a structured array
+    """
+    v = _unpack(FXStatusPacket, data)
+    columns = _simple_fields(FXStatusPacket, v)
+
+    misc = v[10]
+    is_230v = (misc & 0x01) == 0x01
+    columns['is_230v'] = is_230v
+    columns['aux_on'] = (misc & 0x80) == 0x80
+
+    # When misc:0 == 1, you must multiply voltages by 2, and divide currents by 2
+    imul = np.where(is_230v, 0.5, 1.0)
+    vmul = np.where(is_230v, 2.0, 1.0)
+    columns['inverter_current'] = v[0] * imul
+    columns['chg_current']      = v[1] * imul
+    columns['buy_current']      = v[2] * imul
+    columns['input_voltage']    = v[3] * vmul
+    columns['output_voltage']   = v[4] * vmul
+    columns['sell_current']     = v[5] * imul
+
+    columns['inv_power']  = columns['inverter_current'] * columns['output_voltage'] / 1000.0
+    columns['sell_power'] = columns['sell_current'] * columns['output_voltage'] / 1000.0
+    columns['chg_power']  = columns['chg_current'] * columns['input_voltage'] / 1000.0
+    columns['buy_power']  = columns['buy_current'] * columns['input_voltage'] / 1000.0
+
+    return _result(columns, structured)
+
+
+def decode_dc_status(data, structured=False):
+    """
+    Decode many FLEXnet DC status packets (see DCStatusPacket).
+    Each packet is the six status pages (0A..0F) joined together.
+    :param data: A contiguous buffer of packets, or a list of raw packets
+    :param structured: True to return a structured array rather than a dict of columns
+    :return: {field name: array}, or a structured array
+    """
+    v = _unpack(DCStatusPacket, data)
+    return _result(_simple_fields(DCStatusPacket, v), structured)
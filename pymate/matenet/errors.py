@@ -0,0 +1,24 @@
+# pyMATE exceptions
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Specific errors raised by the MateNET interfaces.
+# These all derive from RuntimeError, which is what was raised before they were added.
+#
+
+__author__ = 'Jared'
+
+
+class ChecksumError(RuntimeError):
+    """
+    A packet was received with an invalid checksum/CRC
+    """
+    pass
+
+
+class InvalidCommandError(RuntimeError):
+    """
+    The device replied that it did not recognise the command
+    """
+    def __init__(self, command):
+        super(InvalidCommandError, self).__init__("Invalid command 0x%.2x" % command)
+        self.command = command
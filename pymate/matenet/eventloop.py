@@ -0,0 +1,410 @@
+# pyMATE event loop
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Non-blocking MateNET transport, so a single thread can drive several
+# MateNET buses (and anything else with a file descriptor, eg. sockets)
+# without blocking on serial reads.
+#
+# Transactions return a BusFuture (see arbiter.py) which completes when the
+# response arrives. Responses are decoded by the same code as the blocking API.
+#
+# Usage:
+#   loop = EventLoop()
+#   bus1 = AsyncMateNET('/dev/ttyUSB0', loop)
+#   bus2 = AsyncMateNET(MateNETPJON('/dev/ttyACM0'), loop)
+#   mx = MateMXDevice(bus1, port=1)
+#   dc = MateDCDevice(bus2, port=3)
+#
+#   def on_status(f):
+#       print f.result()
+#   mx.get_status_async().add_done_callback(on_status)
+#   dc.get_status_async().add_done_callback(on_status)
+#   loop.run_forever()
+#
+
+__author__ = 'Jared'
+
+from matenet import MateNET, TOPOLOGY_FILE
+from arbiter import BusFuture, PRIORITY_QUERY
+from transaction import TransactionRecord
+from pymate.util import monotonic
+import heapq
+import itertools
+import select
+import logging
+import sys
+
+
+class EventLoop(object):
+    """
+    A minimal select()-based event loop
+    """
+    def __init__(self):
+        self.log = logging.getLogger('mate.loop')
+        self.readers = {}  # {fd: callback}
+        self.timers = []   # heap of [deadline, seq, callback]
+        self.running = False
+        self._seq = itertools.count()
+
+    def add_reader(self, fd, callback):
+        """
+        Call callback() whenever fd is readable
+        """
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def call_later(self, delay, callback):
+        """
+        Call callback() after delay seconds
+        :return: A handle which can be passed to cancel()
+        """
+        timer = [monotonic() + delay, next(self._seq), callback]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancel a timer returned by call_later()
+        """
+        if timer is not None:
+            timer[2] = None
+
+    def run_once(self, timeout=None):
+        """
+        Wait for (at most timeout seconds) and dispatch any events
+        """
+        # Discard cancelled timers
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+
+        if self.timers:
+            delay = max(0, self.timers[0][0] - monotonic())
+            timeout = delay if timeout is None else min(timeout, delay)
+
+        if self.readers:
+            r, _, _ = select.select(list(self.readers), [], [], timeout)
+            for fd in r:
+                callback = self.readers.get(fd)
+                if callback:
+                    self._call(callback)
+        elif timeout is not None:
+            select.select([], [], [], timeout)
+
+        now = monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self.timers)
+            if callback:
+                self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback()
+        except Exception:
+            self.log.exception('Exception in event loop callback')
+
+    def run_until_complete(self, future, timeout=None):
+        """
+        Run the event loop until the future has completed
+        :return: The result of the future
+        """
+        if self.running:
+            raise RuntimeError("Event loop is already running (use the future's callback instead)")
+        t_end = None if timeout is None else (monotonic() + timeout)
+        self.running = True
+        try:
+            while not future.done():
+                remaining = None if t_end is None else (t_end - monotonic())
+                if remaining is not None and remaining <= 0:
+                    break
+                self.run_once(remaining)
+        finally:
+            self.running = False
+        return future.result(0)
+
+    def run_forever(self):
+        """
+        Run the event loop until stop() is called
+        """
+        self.running = True
+        try:
+            while self.running:
+                self.run_once()
+        finally:
+            self.running = False
+
+    def stop(self):
+        self.running = False
+
+
+class _Transaction(object):
+    def __init__(self, priority, seq, packet, response_len, future, timeout, retry_silent=True, record=None,
+                 return_record=False):
+        self.priority = priority
+        self.seq = seq
+        self.packet = packet
+        self.response_len = response_len
+        self.future = future
+        self.timeout = timeout
+        self.retry_silent = retry_silent
+        self.record = record  # TransactionRecord (for statistics)
+        self.return_record = return_record  # Return (response, record) rather than just the response
+        self.attempt = 0
+        self.rx_first_time = None
+        self.rx_last_time = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AsyncMateNET(MateNET):
+    """
+    Non-blocking interface for the MATE RJ45 bus ("MateNET"),
+    driven by an EventLoop.
+
+    Use submit() (or the device get_status_async() methods) to queue transactions.
+    The blocking API (send(), query(), etc.) still works outside of the event loop,
+    by running the loop until the transaction completes.
+    """
+    def __init__(self, port, loop, supports_spacemark=None, tap=None, topology_file=TOPOLOGY_FILE):
+        super(AsyncMateNET, self).__init__(port, supports_spacemark, tap, topology_file)
+        self.loop = loop
+        self.log = logging.getLogger('mate.async')
+
+        # Time to wait for a response
+        self.RESPONSE_TIMEOUT = 1.0 # seconds
+
+        self.queue = []  # heap of _Transaction
+        self.current = None
+        self.timer = None
+        self._seq = itertools.count()
+
+        self.loop.add_reader(self.port.fileno(), self._on_readable)
+
+    def start(self):
+        raise RuntimeError("AsyncMateNET is driven by its event loop, and does not need a bus arbiter")
+
+    def close(self):
+        """
+        Detach from the event loop
+        """
+        self.loop.remove_reader(self.port.fileno())
+        self.loop.cancel(self.timer)
+
+    def submit(self, ptype, addr, param=0, port=0, response_len=None, device_type=None, priority=None, record=False):
+        """
+        Queue a MateNET packet to be sent, without waiting for the response
+        :param priority: See arbiter.PRIORITY_*, or None to choose one based on the packet type
+        :param record: True to also return a TransactionRecord (see MateNET.send())
+        :return: BusFuture, whose result() is the raw response (see MateNET.send())
+        """
+        return self._submit(TransactionRecord(port, ptype, addr, param), response_len, device_type, priority, record)
+
+    def _submit(self, txn_record, response_len=None, device_type=None, priority=None, record=False):
+        """
+        See submit()
+        :param txn_record: TransactionRecord describing the packet to send
+        """
+        port, ptype, addr, param = txn_record.port, txn_record.ptype, txn_record.addr, txn_record.param
+        if priority is None:
+            priority = self.default_priority(ptype)
+        if response_len is None:
+            response_len = self.lookup_response_len(ptype, addr, device_type)
+        if response_len is not None:
+            response_len += 1 # Account for command ack byte
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('Queue [Port%d, Type=0x%.2x, Addr=0x%.4x, Param=0x%.4x]', port, ptype, addr, param)
+
+        packet = MateNET.TxPacket(port, ptype, addr, param).to_buffer()
+        return self._queue(packet, response_len, priority, self.RESPONSE_TIMEOUT,
+                           record=txn_record, return_record=record)
+
+    def _queue(self, packet, response_len, priority, timeout, retry_silent=True, record=None, return_record=False):
+        txn = _Transaction(priority, next(self._seq), packet, response_len, BusFuture(), timeout, retry_silent,
+                           record, return_record)
+        heapq.heappush(self.queue, txn)
+
+        self._next()
+        return txn.future
+
+    def send(self, ptype, addr, param=0, port=0, response_len=None, device_type=None, record=False):
+        """
+        Send a MateNET packet and wait for the response (see MateNET.send()).
+        Can't be used from within an event loop callback.
+        """
+        return self.loop.run_until_complete(
+            self.submit(ptype, addr, param, port, response_len, device_type, record=record)
+        )
+
+    def probe(self, port=0):
+        """
+        Quickly check which device is attached to a hub port (see MateNET.probe()).
+        Can't be used from within an event loop callback.
+        """
+        packet = MateNET.TxPacket(port, MateNET.TYPE_QUERY, 0x0000, 0).to_buffer()
+        future = self._queue(packet, 3, PRIORITY_QUERY, self.SCAN_TIMEOUT, retry_silent=False,
+                             record=TransactionRecord(port, MateNET.TYPE_QUERY, 0x0000))
+        resp = self.loop.run_until_complete(future)
+        if not resp:
+            return None  # Nothing attached
+        return MateNET.QueryResponse.from_buffer(resp).value & 0x00FF
+
+    def send_many(self, requests, record=False):
+        """
+        Send several MateNET packets and wait for their responses (see MateNET.send_many()).
+        Can't be used from within an event loop callback.
+        """
+        txns = []
+        futures = []
+        for request in requests:
+            ptype, addr, param, port, device_type = self._unpack_request(request)
+            txn = TransactionRecord(port, ptype, addr, param)
+            txns.append(txn)
+            futures.append(self._submit(txn, device_type=device_type))
+
+        results = []
+        for txn, future in zip(txns, futures):
+            try:
+                results.append(self.loop.run_until_complete(future))
+            except Exception as e:
+                self.log.warning('Error sending packet [Port%d, Type=0x%.2x, Addr=0x%.4x]: %s', txn.port, txn.ptype, txn.addr, e)
+                results.append(None)
+        return list(zip(results, txns)) if record else results
+
+    def _next(self):
+        """
+        Start the next transaction, if the bus is idle
+        """
+        if self.current is not None or not self.queue:
+            return
+        self.current = heapq.heappop(self.queue)
+        self._transmit()
+
+    def _transmit(self):
+        txn = self.current
+        txn.attempt += 1
+        txn.rx_first_time = None
+        if txn.record:
+            txn.record.sent(len(txn.packet) + 2)  # Including checksum
+        try:
+            packet_id = self.port.send(txn.packet)
+            self.port.recv_start(txn.response_len, packet_id=packet_id)
+        except Exception:
+            exc_info = sys.exc_info()
+            if txn.record:
+                self.stats.error(txn.record.port, txn.record.ptype, exc_info[1])
+            self._complete(exc_info=exc_info)
+            return
+        self._set_timer(txn.timeout, self._on_timeout)
+
+        # The response may already have arrived, along with an earlier one
+        self._feed('')
+
+    def _set_timer(self, delay, callback):
+        self.loop.cancel(self.timer)
+        self.timer = self.loop.call_later(delay, callback)
+
+    def _on_readable(self):
+        data = self.port.read_nonblocking()
+        if not data or self.current is None:
+            return  # Nothing is expecting data
+
+        txn = self.current
+        txn.rx_last_time = monotonic()
+        if txn.rx_first_time is None:
+            txn.rx_first_time = txn.rx_last_time
+
+        self._feed(data)
+
+    def _feed(self, data):
+        """
+        Pass received data to the port, and complete the current transaction if the response is complete
+        """
+        try:
+            packet = self.port.recv_feed(data)
+        except Exception:
+            self._retry(sys.exc_info())
+            return
+
+        if packet is not None:
+            self._complete(packet)
+            return
+        if not data:
+            return
+
+        # Wait for more data, or for the bus to go idle (end of packet)
+        idle_timeout = getattr(self.port, 'END_OF_PACKET_TIMEOUT', None)
+        if idle_timeout is not None:
+            self._set_timer(idle_timeout, self._on_idle)
+
+    def _on_idle(self):
+        self.timer = None
+        try:
+            packet = self.port.recv_end()
+        except Exception:
+            self._retry(sys.exc_info())
+            return
+        if packet is None:
+            self._retry(None)
+        else:
+            self._complete(packet)
+
+    def _on_timeout(self):
+        self.timer = None
+        self._retry(None)
+
+    def _retry(self, exc_info):
+        """
+        The transaction failed (exc_info), or there was no response (None)
+        """
+        record = self.current.record
+        if record:
+            if exc_info is None:
+                self.stats.timeout(record.port, record.ptype)
+            else:
+                self.stats.error(record.port, record.ptype, exc_info[1])
+
+        if exc_info is None and not self.current.retry_silent:
+            self._complete(None)  # No response, and we don't expect one
+        elif self.current.attempt <= self.RETRY_PACKET:
+            self.log.debug('RETRY')
+            self._transmit()
+        elif exc_info:
+            self._complete(exc_info=exc_info)
+        else:
+            self._complete(None)  # No response
+
+    def _complete(self, rxbuf=None, exc_info=None):
+        self.loop.cancel(self.timer)
+        self.timer = None
+        txn, self.current = self.current, None
+
+        if self.tap:
+            # Send the packet to the wireshark tap pipe, if present
+            if rxbuf:
+                self.tap.capture(txn.packet+'\xFF\xFF', rxbuf+'\xFF\xFF')  # Dummy checksums
+            else:
+                self.tap.capture_tx(txn.packet+'\xFF\xFF')
+
+        if txn.record:
+            if rxbuf:
+                txn.record.received(len(rxbuf) + 2, txn.rx_first_time, txn.rx_last_time)
+            self.stats.record(txn.record)
+            self._invalidate_control(txn.record)
+
+        if exc_info is None:
+            try:
+                result = self._parse_response(rxbuf)
+                if txn.return_record:
+                    result = (result, txn.record)
+                txn.future.set_result(result)
+            except Exception:
+                exc_info = sys.exc_info()
+                if txn.record:
+                    self.stats.error(txn.record.port, txn.record.ptype, exc_info[1])
+        if exc_info is not None:
+            txn.future.set_exception(exc_info)
+
+        self._next()
@@ -9,11 +9,14 @@
 
 __author__ = 'Jared'
 
-from pymate.value import Value
 from pymate.cstruct import Struct
 from . import MateDevice, MateNET
+from arbiter import BusFuture
+from regcache import CACHE_STATIC, CACHE_SLOW
+from registers import Register
+from packet import StatusPacket, value_field, int_field
 
-class DCStatusPacket(object):
+class DCStatusPacket(StatusPacket):
     fmt = Struct('>'+
         'hhhhBhh'+      # Page A (7 values)
         'hBBhhhh'+      # Page B (7 values)
@@ -23,121 +26,132 @@ class DCStatusPacket(object):
         'BBBhhhhh'+     # Page E (8 values)
         'hBhhB5B'       # Page F (6 values)
     )
-
-    def __init__(self):
-
-        # User Guide mentions:
-        # Volts for one battery bank (0-80V in 0.1V resolution)
-        # Current range: 2000A (+/- 1000A DC), 0.1A resolution
-
-        self.bat_voltage = None
-        self.state_of_charge = None
-        
-        self.shunta_power = None
-        self.shuntb_power = None
-        self.shuntc_power = None
-        self.shunta_current = None
-        self.shuntb_current = None
-        self.shuntc_current = None
-
-        self.shunta_kwh_today = None
-        self.shuntb_kwh_today = None
-        self.shuntc_kwh_today = None
-        self.shunta_ah_today = None
-        self.shuntb_ah_today = None
-        self.shuntc_ah_today = None
-
-        self.bat_net_kwh = None
-        self.bat_net_ah = None
-        self.min_soc_today = None
-        self.in_ah_today = None
-        self.out_ah_today = None
-        self.bat_ah_today = None
-        self.in_kwh_today = None
-        self.out_kwh_today = None
-        self.bat_kwh_today = None
-
-        self.in_power = None
-        self.out_power = None
-        self.bat_power = None
-        
-        self.in_current = None
-        self.out_current = None
-        self.bat_current = None
-
-        self.days_since_full = None
-
-        self.flags = None
-
-        pass
-
-    @classmethod
-    def from_buffer(cls, data):
-        values = cls.fmt.unpack(data)
-        status = DCStatusPacket()
-
-        # Page A
-        status.shunta_current   = Value(values[0] / 10.0, units='A', resolution=1)
-        status.shuntb_current   = Value(values[1] / 10.0, units='A', resolution=1)
-        status.shuntc_current   = Value(values[2] / 10.0, units='A', resolution=1)
-        status.bat_voltage      = Value(values[3] / 10.0, units='V', resolution=1)
-        status.state_of_charge  = Value(values[4], units='%', resolution=0)
-        status.shunta_power     = Value(values[5] / 100.0, units='kW', resolution=2)
-        status.shuntb_power     = Value(values[6] / 100.0, units='kW', resolution=2)
-
-        # Page B
-        status.shuntc_power     = Value(values[7] / 100.0, units='kW', resolution=2)
-        # unknown values[8]
-        status.flags            = values[9]
-        status.in_current       = Value(values[10] / 10.0, units='A', resolution=1)
-        status.out_current      = Value(values[11] / 10.0, units='A', resolution=1)
-        status.bat_current      = Value(values[12] / 10.0, units='A', resolution=1)
-        status.in_power         = Value(values[13] / 100.0, units='kW', resolution=2)
-        status.out_power        = Value(values[14] / 100.0, units='kW', resolution=2)  # NOTE: Split between Page B/C
-        
-        # Page C
-        status.bat_power        = Value(values[15] / 100.0, units='kW', resolution=2)
-        status.in_ah_today      = Value(values[16], units='Ah', resolution=0)
-        status.out_ah_today     = Value(values[17], units='Ah', resolution=0)
-        status.bat_ah_today     = Value(values[18], units='Ah', resolution=0)
-        status.in_kwh_today     = Value(values[19] / 100.0, units='kWh', resolution=2)
-        status.out_kwh_today    = Value(values[20] / 100.0, units='kWh', resolution=2)
-
-        # Page D
-        status.bat_kwh_today    = Value(values[21] / 100.0, units='kWh', resolution=2)
-        status.days_since_full  = Value(values[22] / 10.0, units='days', resolution=1)
-        # values[23..31] (9 values) unknown
-
-        # Page E
-        # values[32..34] (3 values) unknown
-        status.shunta_kwh_today = Value(values[35] / 100.0, units='kWh', resolution=2)
-        status.shuntb_kwh_today = Value(values[36] / 100.0, units='kWh', resolution=2)
-        status.shuntc_kwh_today = Value(values[37] / 100.0, units='kWh', resolution=2)
-        status.shunta_ah_today  = Value(values[38], units='Ah', resolution=0)
-        status.shuntb_ah_today  = Value(values[39], units='Ah', resolution=0)
-
-        # Page F
-        status.shuntc_ah_today  = Value(values[40], units='Ah', resolution=0)
-        status.min_soc_today    = Value(values[41], units='%', resolution=0)
-        status.bat_net_ah       = Value(values[42], units='Ah', resolution=0)
-        status.bat_net_kwh      = Value(values[43] / 100.0, units='kWh', resolution=2)
-
-        return status
+    size = fmt.size
+
+    # User Guide mentions:
+    # Volts for one battery bank (0-80V in 0.1V resolution)
+    # Current range: 2000A (+/- 1000A DC), 0.1A resolution
+
+    # Page A
+    shunta_current   = value_field(0, 10.0, units='A', resolution=1)
+    shuntb_current   = value_field(1, 10.0, units='A', resolution=1)
+    shuntc_current   = value_field(2, 10.0, units='A', resolution=1)
+    bat_voltage      = value_field(3, 10.0, units='V', resolution=1)
+    state_of_charge  = value_field(4, units='%', resolution=0)
+    shunta_power     = value_field(5, 100.0, units='kW', resolution=2)
+    shuntb_power     = value_field(6, 100.0, units='kW', resolution=2)
+
+    # Page B
+    shuntc_power     = value_field(7, 100.0, units='kW', resolution=2)
+    # unknown values[8]
+    flags            = int_field(9)
+    in_current       = value_field(10, 10.0, units='A', resolution=1)
+    out_current      = value_field(11, 10.0, units='A', resolution=1)
+    bat_current      = value_field(12, 10.0, units='A', resolution=1)
+    in_power         = value_field(13, 100.0, units='kW', resolution=2)
+    out_power        = value_field(14, 100.0, units='kW', resolution=2)  # NOTE: Split between Page B/C
+
+    # Page C
+    bat_power        = value_field(15, 100.0, units='kW', resolution=2)
+    in_ah_today      = value_field(16, units='Ah', resolution=0)
+    out_ah_today     = value_field(17, units='Ah', resolution=0)
+    bat_ah_today     = value_field(18, units='Ah', resolution=0)
+    in_kwh_today     = value_field(19, 100.0, units='kWh', resolution=2)
+    out_kwh_today    = value_field(20, 100.0, units='kWh', resolution=2)
+
+    # Page D
+    bat_kwh_today    = value_field(21, 100.0, units='kWh', resolution=2)
+    days_since_full  = value_field(22, 10.0, units='days', resolution=1)
+    # values[23..31] (9 values) unknown
+
+    # Page E
+    # values[32..34] (3 values) unknown
+    shunta_kwh_today = value_field(35, 100.0, units='kWh', resolution=2)
+    shuntb_kwh_today = value_field(36, 100.0, units='kWh', resolution=2)
+    shuntc_kwh_today = value_field(37, 100.0, units='kWh', resolution=2)
+    shunta_ah_today  = value_field(38, units='Ah', resolution=0)
+    shuntb_ah_today  = value_field(39, units='Ah', resolution=0)
+
+    # Page F
+    shuntc_ah_today  = value_field(40, units='Ah', resolution=0)
+    min_soc_today    = value_field(41, units='%', resolution=0)
+    bat_net_ah       = value_field(42, units='Ah', resolution=0)
+    bat_net_kwh      = value_field(43, 100.0, units='kWh', resolution=2)
 
     def __repr__(self):
         return "<DCStatusPacket>"
 
     def __str__(self):
-        fmt = """DC Status: 
-        
+        fmt = """DC Status:
+    Battery: {bat_voltage} {state_of_charge}
+    In:  {in_power} {in_current}
+    Out: {out_power} {out_current}
+    Bat: {bat_power} {bat_current}
 """
-        return fmt.format(**self.__dict__)
+        return fmt.format(
+            bat_voltage=self.bat_voltage,
+            state_of_charge=self.state_of_charge,
+            in_power=self.in_power,
+            in_current=self.in_current,
+            out_power=self.out_power,
+            out_current=self.out_current,
+            bat_power=self.bat_power,
+            bat_current=self.bat_current
+        )
 
 class MateDCDevice(MateDevice):
     """
     Communicate with a FLEXnet DC unit attached to the MateNET bus
     """
     DEVICE_TYPE = MateNET.DEVICE_DC
+    STATUS_PAGES = tuple(range(0x0A,0x0F+1))
+
+    REGISTERS = (
+        Register('state_of_charge',           0x00D5, scale=1, units='%'),
+
+        ##### METER/DC/SHUNT #####
+        Register('shunt_a_max_charged_amps',  0x0066, scale=0.1, units='A', resolution=1, cache=CACHE_SLOW),
+        Register('shunt_a_max_charged_kw',    0x0068, scale=0.01, units='kW', resolution=2, cache=CACHE_SLOW),
+        Register('shunt_b_max_charged_amps',  0x006A, scale=0.1, units='A', resolution=1, cache=CACHE_SLOW),
+        Register('shunt_b_max_charged_kw',    0x006C, scale=0.01, units='kW', resolution=2, cache=CACHE_SLOW),
+        Register('shunt_c_max_charged_amps',  0x006E, scale=0.1, units='A', resolution=1, cache=CACHE_SLOW),
+        Register('shunt_c_max_charged_kw',    0x0070, scale=0.01, units='kW', resolution=2, cache=CACHE_SLOW),
+        Register('shunt_a_max_removed_amps',  0x0072, scale=0.1, units='A', resolution=1, cache=CACHE_SLOW),
+        Register('shunt_a_max_removed_kw',    0x0074, scale=0.01, units='kW', resolution=2, cache=CACHE_SLOW),
+        Register('shunt_b_max_removed_amps',  0x0076, scale=0.1, units='A', resolution=1, cache=CACHE_SLOW),
+        Register('shunt_b_max_removed_kw',    0x0078, scale=0.01, units='kW', resolution=2, cache=CACHE_SLOW),
+        Register('shunt_c_max_removed_amps',  0x007A, scale=0.1, units='A', resolution=1, cache=CACHE_SLOW),
+        Register('shunt_c_max_removed_kw',    0x007C, scale=0.01, units='kW', resolution=2, cache=CACHE_SLOW),
+
+        ##### STATUS/DC/BATT #####
+        Register('temp_comp_setpoint',        0x0010, scale=0.1, units='V', resolution=1),
+        Register('lifetime_kah_removed',      0x001C, scale=1, units='kAh', cache=CACHE_SLOW),
+        Register('battery_min_today',         0x0058, scale=0.1, units='V', resolution=1, cache=CACHE_SLOW),
+        Register('battery_max_today',         0x005A, scale=0.1, units='V', resolution=1, cache=CACHE_SLOW),
+        Register('days_since_charged',        0x0062, scale=0.1, units='days', resolution=1, cache=CACHE_SLOW),
+        Register('total_days_at_100',         0x0064, scale=1, units='days', cache=CACHE_SLOW),
+        Register('charge_efficiency',         0x00D1, scale=1, units='%', cache=CACHE_SLOW),
+        Register('cycle_charge_factor',       0x00D7, scale=1, units='%', cache=CACHE_SLOW),
+        Register('battery_temp',              0x00F0, doc="System battery temperature (degC, 0xFE: Not present)"),
+
+        ##### ADV/DC (setup) #####
+        Register('battery_capacity',          0x0034, scale=1, units='Ah', cache=CACHE_STATIC),
+        Register('shunt_a_mode',              0x00CA, cache=CACHE_STATIC, doc="0: Enabled, 1: Disabled"),
+        Register('shunt_b_mode',              0x00CB, cache=CACHE_STATIC, doc="0: Enabled, 1: Disabled"),
+        Register('shunt_c_mode',              0x00CC, cache=CACHE_STATIC, doc="0: Enabled, 1: Disabled"),
+        Register('return_amps',               0x005C, scale=0.1, units='A', resolution=1, cache=CACHE_STATIC),
+        Register('charged_voltage',           0x005E, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('parameters_met_time',       0x00DA, scale=1, units='min', cache=CACHE_STATIC),
+        Register('charge_factor',             0x00D4, scale=1, units='%', cache=CACHE_STATIC),
+        Register('aux_control',               0x00D8, cache=CACHE_STATIC, doc="0: Off, 1: Auto, 2: On"),
+        Register('aux_high_volts',            0x0060, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('aux_low_volts',             0x007E, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('aux_soc_high',              0x00D9, scale=1, units='%', cache=CACHE_STATIC),
+        Register('aux_soc_low',               0x00DB, scale=1, units='%', cache=CACHE_STATIC),
+        Register('aux_high_delay',            0x00E0, scale=1, units='min', cache=CACHE_STATIC),
+        Register('aux_low_delay',             0x00E1, scale=1, units='min', cache=CACHE_STATIC),
+        Register('aux_logic_invert',          0x00D3, cache=CACHE_STATIC),
+    )
 
     def scan(self):
         """
@@ -159,18 +173,35 @@ class MateDCDevice(MateDevice):
         return DCStatusPacket.from_buffer(data)
 
     def get_status_raw(self):
-        data = ''
-        for i in range(0x0A,0x0F+1):
-            resp = self.send(MateNET.TYPE_STATUS, addr=i, response_len=(13*6))
+        pages = []
+        for i in self.STATUS_PAGES:
+            resp = self.send(MateNET.TYPE_STATUS, addr=i)
             if not resp:
                 return None
-            data += str(resp)
+            pages.append(resp)
+        data = ''.join(pages)
 
         if len(data) != 13*6:
             raise Exception('Size of status packets invalid')
 
         return data
 
+    def get_status_async(self):
+        """
+        Request a status packet from the FLEXnet DC, without waiting for the response
+        :return: A BusFuture, whose result is a DCStatusPacket (or None)
+        """
+        futures = [self.submit(MateNET.TYPE_STATUS, addr=i) for i in self.STATUS_PAGES]
+        return BusFuture.gather(futures).then(self.parse_status)
+
+    def parse_status(self, pages):
+        if not all(pages):
+            return None
+        data = ''.join(pages)
+        if len(data) != 13*6:
+            raise Exception('Size of status packets invalid')
+        return DCStatusPacket.from_buffer(data)
+
     def get_logpage(self, day):
         """
         Get a log page for the specified day
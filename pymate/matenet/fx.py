@@ -10,34 +10,60 @@ __author__ = 'Jared'
 from pymate.value import Value
 from struct import Struct
 from . import MateDevice, MateNET
+from regcache import CACHE_STATIC
+from registers import Register
+from packet import StatusPacket, field, value_field, int_field
 
 
-class FXStatusPacket(object):
+def _ac_current(index, doc=None):
+    # Currents are halved on 230V models
+    return field(lambda p: Value(p.values[index] * (0.5 if p.is_230v else 1.0), units='A', resolution=1), doc)
+
+def _ac_voltage(index, doc=None):
+    # Voltages are doubled on 230V models
+    return field(lambda p: Value(p.values[index] * (2.0 if p.is_230v else 1.0), units='V', resolution=0), doc)
+
+
+class FXStatusPacket(StatusPacket):
     fmt = Struct('>BBBBBBBBBhBB')
     size = fmt.size
 
-    def __init__(self, misc=None):
-        self.raw = None
-
-        self.misc             = misc
-        self.warnings         = None  # See MateFXDevice.WARN_ enum
-        self.error_mode       = None  # See MateFXDevice.ERROR_ bitfield
-        self.ac_mode          = None  # 0: No AC, 1: AC Drop, 2: AC Use
-        self.operational_mode = None  # See MateFXDevice.STATUS_ enum
-
-        self.is_230v = None
-        self.aux_on  = None
-        if misc is not None:
-            self.is_230v = (misc & 0x01 == 0x01)
-            self.aux_on  = (misc & 0x80 == 0x80)
-
-        self.inverter_current = None  # Ouptut/Inverter AC Current the FX is delivering to loads
-        self.output_voltage   = None  # Output/Inverter AC Voltage (to loads)
-        self.input_voltage    = None  # Input/Line AC Voltage (from grid)
-        self.sell_current     = None  # AC Current the FX is delivering from batteries to AC input (sell)
-        self.chg_current      = None  # AC Current the FX is taking from AC input and delivering to batteries
-        self.buy_current      = None  # AC Current the FX is taking from AC input and delivering to batteries + loads
-        self.battery_voltage  = None  # Battery Voltage
+    # From MATE2 doc the status packet contains:
+    # Inverter address
+    # Inverter current - AC current the FX is delivering to loads
+    # Charger current - AC current the FX is taking from AC input and delivering to batteries
+    # Buy current - AC current the FX is taking from AC input and delivering to batteries AND loads
+    # AC input voltage
+    # AC output voltage
+    # Sell current - AC current the FX is delivering from batteries to AC input
+    # FX operational mode (0..10)
+    # FX error mode
+    # FX AC mode
+    # FX Bat Voltage
+    # FX Misc
+    # FX Warnings
+
+    inverter_current = _ac_current(0, 'Ouptut/Inverter AC Current the FX is delivering to loads')
+    chg_current      = _ac_current(1, 'AC Current the FX is taking from AC input and delivering to batteries')
+    buy_current      = _ac_current(2, 'AC Current the FX is taking from AC input and delivering to batteries + loads')
+    input_voltage    = _ac_voltage(3, 'Input/Line AC Voltage (from grid)')
+    output_voltage   = _ac_voltage(4, 'Output/Inverter AC Voltage (to loads)')
+    sell_current     = _ac_current(5, 'AC Current the FX is delivering from batteries to AC input (sell)')
+    operational_mode = int_field(6, 'See MateFXDevice.STATUS_ enum')
+    error_mode       = int_field(7, 'See MateFXDevice.ERROR_ bitfield')
+    ac_mode          = int_field(8, '0: No AC, 1: AC Drop, 2: AC Use')
+    battery_voltage  = value_field(9, 10.0, units='V', resolution=1)
+    misc             = int_field(10)
+    warnings         = int_field(11, 'See MateFXDevice.WARN_ enum')
+
+    @field
+    def is_230v(self):
+        # When misc:0 == 1, you must multiply voltages by 2, and divide currents by 2
+        return (self.misc & 0x01 == 0x01)
+
+    @field
+    def aux_on(self):
+        return (self.misc & 0x80 == 0x80)
 
     @property
     def inv_power(self):
@@ -46,7 +72,7 @@ class FXStatusPacket(object):
         Power produced by the inverter from the battery
         """
         if self.inverter_current is not None and self.output_voltage is not None:
-            return Value((float(self.inverter_current) * float(self.output_voltage)) / 1000.0, units='kW', resolution=2)
+            return Value(self.inverter_current * self.output_voltage / 1000.0, units='kW', resolution=2)
         return None
 
     @property
@@ -56,7 +82,7 @@ class FXStatusPacket(object):
         Power produced by the inverter from the batteries, sold back to the grid (AC input)
         """
         if self.sell_current is not None and self.output_voltage is not None:
-            return Value((float(self.sell_current) * float(self.output_voltage)) / 1000.0, units='kW', resolution=2)
+            return Value(self.sell_current * self.output_voltage / 1000.0, units='kW', resolution=2)
         return None
 
     @property
@@ -66,7 +92,7 @@ class FXStatusPacket(object):
         Power consumed by the inverter from the AC input to charge the battery bank
         """
         if self.chg_current is not None and self.input_voltage is not None:
-            return Value((float(self.chg_current) * float(self.input_voltage)) / 1000.0, units='kW', resolution=2)
+            return Value(self.chg_current * self.input_voltage / 1000.0, units='kW', resolution=2)
         return None
 
     @property
@@ -75,57 +101,9 @@ class FXStatusPacket(object):
         AC_INPUT -> BATTERIES + AC_OUTPUT
         """
         if self.buy_current is not None and self.input_voltage is not None:
-            return Value((float(self.buy_current) * float(self.input_voltage)) / 1000.0, units='kW', resolution=2)
+            return Value(self.buy_current * self.input_voltage / 1000.0, units='kW', resolution=2)
         return None
 
-    @classmethod
-    def from_buffer(cls, data):
-        values = cls.fmt.unpack(data)
-
-        # Need this to determine whether the system is 230v or 110v
-        misc = values[10]
-
-        status = FXStatusPacket(misc)
-
-        # When misc:0 == 1, you must multiply voltages by 2, and divide currents by 2
-        if status.is_230v:
-            vmul = 2.0; imul = 0.5
-        else:
-            vmul = 1.0; imul = 1.0
-
-        # From MATE2 doc the status packet contains:
-        # Inverter address
-        # Inverter current - AC current the FX is delivering to loads
-        # Charger current - AC current the FX is taking from AC input and delivering to batteries
-        # Buy current - AC current the FX is taking from AC input and delivering to batteries AND loads
-        # AC input voltage
-        # AC output voltage
-        # Sell current - AC current the FX is delivering from batteries to AC input
-        # FX operational mode (0..10)
-        # FX error mode
-        # FX AC mode
-        # FX Bat Voltage
-        # FX Misc
-        # FX Warnings
-
-        status.inverter_current  = Value(values[0] * imul, units='A', resolution=1)
-        status.chg_current       = Value(values[1] * imul, units='A', resolution=1)
-        status.buy_current       = Value(values[2] * imul, units='A', resolution=1)
-        status.input_voltage     = Value(values[3] * vmul, units='V', resolution=0)
-        status.output_voltage    = Value(values[4] * vmul, units='V', resolution=0)
-        status.sell_current      = Value(values[5] * imul, units='A', resolution=1)
-        status.operational_mode  = values[6]
-        status.error_mode        = values[7]
-        status.ac_mode           = values[8]
-        status.battery_voltage   = Value(values[9] / 10.0, units='V', resolution=1)
-        # values[10]: misc byte
-        status.warnings          = values[11]
-
-        # Also add the raw packet, in case any of the above changes
-        status.raw = data
-
-        return status
-
     def __repr__(self):
         return "<FXStatusPacket>"
 
@@ -150,6 +128,88 @@ class MateFXDevice(MateDevice):
     Communicate with an FX unit attached to the MateNET bus
     """
     DEVICE_TYPE = MateNET.DEVICE_FX
+    STATUS_PAGES = (1,)
+
+    REGISTER_CACHE = {
+        0x0001: CACHE_STATIC, # revision (firmware version)
+    }
+
+    REGISTERS = (
+        ##### STATUS/FX #####
+        Register('errors',            0x0039, doc="Errors bit-field (See ERROR_* constants)"),
+        Register('warnings',          0x0059, doc="Warnings bit-field (See WARN_* constants)"),
+        Register('disconn_status',    0x0084),
+        Register('sell_status',       0x008F),
+
+        ##### STATUS/FX/MODE #####
+        # WARNING: Setting inverter_control can turn off the inverter!
+        Register('inverter_control',  0x003D, writable=True, doc="Inverter mode (0: Off, 1: Search, 2: On)"),
+        Register('acin_control',      0x003A, writable=True, doc="AC IN mode (0: Drop, 1: Use)"),
+        Register('charge_control',    0x003C, writable=True, doc="Charger mode (0: Off, 1: Auto, 2: On)"),
+        Register('aux_control',       0x005A, writable=True, doc="AUX mode (0: Off, 1: Auto, 2: On)"),
+        Register('eq_control',        0x0038, writable=True, doc="Equalize mode (0:Off, 1: Auto?, 2: On?)"),
+
+        ##### STATUS/FX/WARN #####
+        # Not verified. I don't have a battery thermometer.
+        Register('temp_battery',      0x0032, doc="Temperature of the battery (Raw, 0..255)"),
+        Register('temp_air',          0x0033, doc="Temperature of the air (Raw, 0..255)"),
+        Register('temp_fets',         0x0034, doc="Temperature of the MOSFET switches (Raw, 0..255)"),
+        Register('temp_capacitor',    0x0035, doc="Temperature of the capacitor (Raw, 0..255)"),
+
+        ##### STATUS/FX/METER #####
+        Register('output_voltage',    0x002D, scale=1, scale_230v=2.0, units='V'),
+        Register('input_voltage',     0x002C, scale=1, scale_230v=2.0, units='V'),
+        Register('inverter_current',  0x006D, scale=1, scale_230v=0.5, units='A', resolution=1),
+        Register('charger_current',   0x006A, scale=1, scale_230v=0.5, units='A', resolution=1),
+        Register('input_current',     0x006C, scale=1, scale_230v=0.5, units='A', resolution=1),
+        Register('sell_current',      0x006B, scale=1, scale_230v=0.5, units='A', resolution=1),
+
+        ##### STATUS/FX/BATT #####
+        Register('battery_actual',            0x0019, scale=0.1, units='V', resolution=1),
+        Register('battery_temp_compensated',  0x0016, scale=0.1, units='V', resolution=1),
+        Register('absorb_setpoint',           0x000B, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('absorb_time_remaining',     0x0070, scale=1, units='h'),
+        Register('float_setpoint',            0x000A, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('float_time_remaining',      0x006E, scale=1, units='h'),
+        Register('refloat_setpoint',          0x000D, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('equalize_setpoint',         0x000C, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('equalize_time_remaining',   0x0071, scale=1, units='h'),
+
+        ##### ADV/FX (settings) #####
+        Register('search_sensitivity',        0x0029, cache=CACHE_STATIC),
+        Register('search_pulse_length',       0x0062, scale=1, units='cycles', cache=CACHE_STATIC),
+        Register('search_pulse_spacing',      0x0063, scale=1, units='cycles', cache=CACHE_STATIC),
+        Register('low_battery_cutout',        0x000E, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('low_battery_cutin',         0x000F, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('output_voltage_adjust',     0x0083, scale=1, units='V', cache=CACHE_STATIC),
+        Register('charger_limit',             0x0028, scale=0.1, units='A', resolution=1, cache=CACHE_STATIC),
+        Register('absorb_time_limit',         0x001F, scale=0.1, units='h', resolution=1, cache=CACHE_STATIC),
+        Register('float_time_period',         0x0021, scale=0.1, units='h', resolution=1, cache=CACHE_STATIC),
+        Register('equalize_time_period',      0x0020, scale=0.1, units='h', resolution=1, cache=CACHE_STATIC),
+        Register('grid_lower_limit',          0x002A, scale=1, units='V', cache=CACHE_STATIC),
+        Register('grid_upper_limit',          0x002B, scale=1, units='V', cache=CACHE_STATIC),
+        Register('grid_input_limit',          0x0027, scale=0.1, units='A', resolution=1, cache=CACHE_STATIC),
+        Register('grid_transfer_delay',       0x004D, scale=1, units='cycles', cache=CACHE_STATIC),
+        Register('gen_connect_delay',         0x0037, scale=0.1, units='min', resolution=1, cache=CACHE_STATIC),
+        Register('gen_lower_limit',           0x0044, scale=1, units='V', cache=CACHE_STATIC),
+        Register('gen_upper_limit',           0x0045, scale=1, units='V', cache=CACHE_STATIC),
+        Register('gen_input_limit',           0x007B, scale=0.1, units='A', resolution=1, cache=CACHE_STATIC),
+        Register('gen_transfer_delay',        0x0022, scale=1, units='cycles', cache=CACHE_STATIC),
+        Register('gen_support',               0x003B, cache=CACHE_STATIC),
+        Register('aux_output_function',       0x003E, cache=CACHE_STATIC),
+        Register('genalert_on_setpoint',      0x0011, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('genalert_on_delay',         0x003F, scale=1, units='min', cache=CACHE_STATIC),
+        Register('genalert_off_setpoint',     0x0010, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('genalert_off_delay',        0x0040, scale=1, units='min', cache=CACHE_STATIC),
+        Register('loadshed_off_setpoint',     0x0012, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('ventfan_on_setpoint',       0x0013, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('ventfan_off_period',        0x0042, scale=1, units='min', cache=CACHE_STATIC),
+        Register('diversion_on_setpoint',     0x0014, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('diversion_off_delay',       0x006F, scale=1, units='s', cache=CACHE_STATIC),
+        Register('power_save_level_master',   0x0075, cache=CACHE_STATIC),
+        Register('power_save_level_slave',    0x0074, cache=CACHE_STATIC),
+        Register('sell_re_volts',             0x001B, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+    )
 
     # Error bit-field
     ERROR_LOW_VAC_OUTPUT = 0x01 # Inverter could not supply enough AC voltage to meet demand
@@ -204,7 +264,7 @@ class MateFXDevice(MateDevice):
 
     def __init__(self, *args, **kwargs):
         super(MateFXDevice, self).__init__(*args, **kwargs)
-        self._is_230v = None
+        self._is_230v = self.matenet.get_identity(self.port, 'is_230v')
 
     def scan(self, *args):
         """
@@ -224,9 +284,29 @@ class MateFXDevice(MateDevice):
         resp = self.send(MateNET.TYPE_STATUS, addr=1, response_len=FXStatusPacket.size)
         if resp:
             status = FXStatusPacket.from_buffer(resp)
-            self._is_230v = status.is_230v
+            self._set_230v(status.is_230v)
             return status
 
+    def get_status_async(self):
+        """
+        Request a status packet from the inverter, without waiting for the response
+        :return: A BusFuture, whose result is a FXStatusPacket (or None)
+        """
+        future = self.submit(MateNET.TYPE_STATUS, addr=1, response_len=FXStatusPacket.size)
+        return future.then(lambda resp: self.parse_status([resp]))
+
+    def parse_status(self, pages):
+        resp = pages[0]
+        if resp:
+            status = FXStatusPacket.from_buffer(resp)
+            self._set_230v(status.is_230v)
+            return status
+
+    def _set_230v(self, is_230v):
+        if is_230v != self._is_230v:
+            self._is_230v = is_230v
+            self.matenet.set_identity(self.port, 'is_230v', is_230v)
+
     @property
     def is_230v(self):
         if self._is_230v is not None:
@@ -244,164 +324,6 @@ class MateFXDevice(MateDevice):
         fw = self.query(0x0001)
         return 'FW:%.3d' % (fw)
 
-    @property
-    def errors(self):
-        """ Errors bit-field (See ERROR_* constants) """
-        return self.query(0x0039)
-
-    @property
-    def warnings(self):
-        """ Warnings bit-field (See WARN_* constants) """
-        return self.query(0x0059)
-
-    @property
-    def inverter_control(self):
-        """ Inverter mode (0: Off, 1: Search, 2: On) """
-        return self.query(0x003D)
-    @inverter_control.setter
-    def inverter_control(self, value):
-        ## WARNING: THIS CAN TURN OFF THE INVERTER! ##
-        self.control(0x003D, value)
-
-    @property
-    def acin_control(self):
-        """ AC IN mode (0: Drop, 1: Use) """
-        return self.query(0x003A)
-    @acin_control.setter
-    def acin_control(self, value):
-        self.control(0x003A, value)
-
-    @property
-    def charge_control(self):
-        """ Charger mode (0: Off, 1: Auto, 2: On) """
-        return self.query(0x003C)
-    @charge_control.setter
-    def charge_control(self, value):
-        self.control(0x003C, value)
-
-    @property
-    def aux_control(self):
-        """ AUX mode (0: Off, 1: Auto, 2: On) """
-        return self.query(0x005A)
-    @aux_control.setter
-    def aux_control(self, value):
-        self.control(0x005A, value)
-
-    @property
-    def eq_control(self):
-        """ Equalize mode (0:Off, 1: Auto?, 2: On?) """
-        return self.query(0x0038)
-    @eq_control.setter
-    def eq_control(self, value):
-        self.control(0x0038, value)
-
-    @property
-    def disconn_status(self):
-        return self.query(0x0084)
-
-    @property
-    def sell_status(self):
-        return self.query(0x008F)
-
-    @property
-    def temp_battery(self):
-        """ Temperature of the battery (Raw, 0..255) """
-        # Not verified. I don't have a battery thermometer.
-        return self.query(0x0032)
-
-    @property
-    def temp_air(self):
-        """ Temperature of the air (Raw, 0..255) """
-        return self.query(0x0033)
-
-    @property
-    def temp_fets(self):
-        """ Temperature of the MOSFET switches (Raw, 0..255) """
-        return self.query(0x0034)
-
-    @property
-    def temp_capacitor(self):
-        """ Temperature of the capacitor (Raw, 0..255) """
-        return self.query(0x0035)
-
-    @property
-    def output_voltage(self):
-        x = self.query(0x002D)
-        if self.is_230v:
-            x *= 2.0
-        return Value(x, units='V', resolution=0)
-
-    @property
-    def input_voltage(self):
-        x = self.query(0x002C)
-        if self.is_230v:
-            x *= 2.0
-        return Value(x, units='V', resolution=0)
-
-    @property
-    def inverter_current(self):
-        x = self.query(0x006D)
-        if self.is_230v:
-            x /= 2.0
-        return Value(x, units='A', resolution=1)
-
-    @property
-    def charger_current(self):
-        x = self.query(0x006A)
-        if self.is_230v:
-            x /= 2.0
-        return Value(x, units='A', resolution=1)
-
-    @property
-    def input_current(self):
-        x = self.query(0x006C)
-        if self.is_230v:
-            x /= 2.0
-        return Value(x, units='A', resolution=1)
-
-    @property
-    def sell_current(self):
-        x = self.query(0x006B)
-        if self.is_230v:
-            x /= 2.0
-        return Value(x, units='A', resolution=1)
-
-    @property
-    def battery_actual(self):
-        return Value(self.query(0x0019) / 10.0, units='V', resolution=1)
-
-    @property
-    def battery_temp_compensated(self):
-        return Value(self.query(0x0016) / 10.0, units='V', resolution=1)
-
-    @property
-    def absorb_setpoint(self):
-        return Value(self.query(0x000B) / 10.0, units='V', resolution=1)
-
-    @property
-    def absorb_time_remaining(self):
-        return Value(self.query(0x0070), units='h', resolution=0)
-
-    @property
-    def float_setpoint(self):
-        return Value(self.query(0x000A) / 10.0, units='V', resolution=1)
-
-    @property
-    def float_time_remaining(self):
-        return Value(self.query(0x006E), units='h', resolution=0)
-
-    @property
-    def refloat_setpoint(self):
-        return Value(self.query(0x000D) / 10.0, units='V', resolution=1)
-
-    @property
-    def equalize_setpoint(self):
-        return Value(self.query(0x000C) / 10.0, units='V', resolution=1)
-
-    @property
-    def equalize_time_remaining(self):
-        return Value(self.query(0x0071), units='h', resolution=0)
-
 # For backwards compatibility
 # DEPRECATED
 def MateFX(comport, supports_spacemark=None, port=0):
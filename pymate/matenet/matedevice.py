@@ -1,4 +1,6 @@
 import datetime
+from regcache import CACHE_STATIC, CACHE_LIVE
+from registers import RegisterMeta
 
 class MateDevice(object):
     """
@@ -8,7 +10,13 @@ class MateDevice(object):
     bus = MateNET('COM1')
     dev = MateDevice(bus, port=0)
     dev.scan()
+
+    Pass port=None to enumerate the bus (once) to find the device:
+    mx = MateMXDevice(bus, port=None)
+    fx = MateFXDevice(bus, port=None)
     """
+    __metaclass__ = RegisterMeta
+
     DEVICE_TYPE = None
 
     DEVICE_HUB = 1
@@ -26,8 +34,33 @@ class MateDevice(object):
     REG_TIME  = 0x4004
     REG_DATE  = 0x4005
 
+    # Register definitions, which generate properties on the device class (see registers.py)
+    REGISTERS = ()
+
+    # Only FX units come in 230V models
+    is_230v = False
+
+    # Status pages (addresses) which make up the device's status packet, see status_requests()
+    STATUS_PAGES = ()
+
+    # How long query() can reuse the value of each register (see regcache.py).
+    # Registers in REGISTERS are added automatically, and any register not listed is CACHE_LIVE.
+    REGISTER_CACHE = {
+        REG_DEVID: CACHE_STATIC,
+        REG_REV_A: CACHE_STATIC,
+        REG_REV_B: CACHE_STATIC,
+        REG_REV_C: CACHE_STATIC,
+    }
+
     def __init__(self, matenet, port=0):
+        """
+        :param matenet: The MateNET bus the device is attached to
+        :param port: The hub port the device is attached to (0 if there is no hub),
+            or None to look it up in the bus topology (see MateNET.find_device())
+        """
         #assert(isinstance(matenet, [MateNET]))
+        if port is None:
+            port = matenet.find_device(self.DEVICE_TYPE) if self.DEVICE_TYPE else 0
         self.matenet = matenet
         self.port    = port
 
@@ -37,11 +70,76 @@ class MateDevice(object):
     def scan(self):
         return self.matenet.scan(self.port)
 
-    def send(self, ptype, addr, param=0, response_len=None):
-        return self.matenet.send(ptype, addr, param=param, port=self.port, response_len=None)
+    def send(self, ptype, addr, param=0, response_len=None, record=False):
+        return self.matenet.send(ptype, addr, param=param, port=self.port,
+            response_len=response_len, device_type=self.DEVICE_TYPE, record=record)
+
+    def submit(self, ptype, addr, param=0, response_len=None, priority=None, record=False):
+        # Non-blocking version of send(), returns a BusFuture (see MateNET.submit())
+        return self.matenet.submit(ptype, addr, param=param, port=self.port,
+            response_len=response_len, device_type=self.DEVICE_TYPE, priority=priority, record=record)
+
+    def status_requests(self):
+        """
+        :return: The requests which fetch the device's status pages, for MateNET.send_many()
+        """
+        return [(self.matenet.TYPE_STATUS, page, 0, self.port, self.DEVICE_TYPE) for page in self.STATUS_PAGES]
+
+    def parse_status(self, pages):
+        """
+        Decode the responses to status_requests()
+        :param pages: list of raw responses (str), None for any page that failed
+        :return: The status packet, or None if any page is missing
+        """
+        raise NotImplementedError()
 
     def query(self, reg, param=0):
-        return self.matenet.query(reg, param=param, port=self.port)
+        if param:
+            # The parameter may change the meaning of the register, so don't cache it
+            return self.matenet.query(reg, param=param, port=self.port)
+
+        cache = self.matenet.cache
+        value = cache.get(self.port, reg, self.REGISTER_CACHE.get(reg, CACHE_LIVE))
+        if value is None:
+            value = self.matenet.query(reg, port=self.port)
+            cache.put(self.port, reg, value)
+        return value
+
+    def read_many(self, registers):
+        """
+        Read several registers in one batch (see MateNET.read_many()).
+        Cached values are reused, and the rest are read from the bus.
+        :param registers: iterable of registers
+        :return: dict of {reg: value}. The value is None for any register that could not be read.
+        """
+        cache = self.matenet.cache
+        values = {}
+        missing = []
+        for reg in set(registers):
+            value = cache.get(self.port, reg, self.REGISTER_CACHE.get(reg, CACHE_LIVE))
+            if value is None:
+                missing.append((self.port, reg))
+            values[reg] = value
+
+        if missing:
+            for (port, reg), value in self.matenet.read_many(missing).items():
+                cache.put(port, reg, value)
+                values[reg] = value
+        return values
+
+    def read_registers(self, names=None):
+        """
+        Read and decode several registers from REGISTERS in one batch (see read_many())
+        :param names: list of register names, or None to read all registers
+        :return: dict of {name: value}. The value is None for any register that could not be read.
+        """
+        if names is None:
+            names = sorted(self.REGISTER_MAP)
+        registers = [self.REGISTER_MAP[name] for name in names]
+
+        raw = self.read_many(reg.addr for reg in registers)
+        is_230v = any(reg.scale_230v is not None for reg in registers) and self.is_230v
+        return dict((reg.name, reg.decode(raw[reg.addr], is_230v)) for reg in registers)
 
     def control(self, reg, value):
         return self.matenet.control(reg, value, port=self.port)
@@ -59,10 +157,15 @@ class MateDevice(object):
         """
         :return: The revision of the attached device (Format "000.000.000")
         """
-        a = self.query(self.REG_REV_A)
-        b = self.query(self.REG_REV_B)
-        c = self.query(self.REG_REV_C)
-        return '%.3d.%.3d.%.3d' % (a, b, c)
+        # The revision doesn't change, so it is cached along with the bus topology
+        revision = self.matenet.get_identity(self.port, 'revision')
+        if revision is None:
+            a = self.query(self.REG_REV_A)
+            b = self.query(self.REG_REV_B)
+            c = self.query(self.REG_REV_C)
+            revision = '%.3d.%.3d.%.3d' % (a, b, c)
+            self.matenet.set_identity(self.port, 'revision', revision)
+        return revision
 
     def update_time(self, dt):
         """
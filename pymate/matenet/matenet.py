@@ -12,8 +12,19 @@ from serial import Serial, PARITY_SPACE, PARITY_MARK, PARITY_ODD, PARITY_EVEN
 from pymate.cstruct import struct
 from matenet_ser import MateNETSerial
 from matenet_pjon import MateNETPJON
+from arbiter import BusArbiter, BusFuture, PRIORITY_CONTROL, PRIORITY_QUERY, PRIORITY_STATUS
+from regcache import RegisterCache
+from transaction import TransactionRecord
+from errors import InvalidCommandError
+from stats import BusStats
 from time import sleep
 import logging
+import json
+import sys
+import os
+
+# Where the bus topology and device identities are cached (per serial port), see MateNET.enumerate()
+TOPOLOGY_FILE = os.path.join(os.path.expanduser('~'), '.pymate', 'topology.json')
 
 class MateNET(object):
     """
@@ -53,7 +64,33 @@ class MateNET(object):
         DEVICE_FLEXNETDC: 'FLEXnet DC',
     }
 
-    def __init__(self, port, supports_spacemark=None, tap=None):
+    # Length of the response payload for each command (excluding the command byte and checksum),
+    # keyed by (device type, packet type, address). None matches any device type / address.
+    # See doc/protocol/Protocol.md and doc/protocol/StatusPages.md
+    RESPONSE_LENGTHS = {
+        # Register commands always respond with the 16-bit register value
+        (None, TYPE_DEC, None): 2,
+        (None, TYPE_INC, None): 2,
+        (None, TYPE_READ, None): 2,
+        (None, TYPE_WRITE, None): 2,
+
+        # Status pages are always 13 bytes
+        # (including the six FLEXnet DC pages 0A..0F, which are combined by the caller)
+        (None, TYPE_STATUS, None): 13,
+
+        # Log pages are 13 bytes, followed by the day (MX only)
+        (DEVICE_MX, TYPE_LOG, None): 14,
+    }
+
+    def __init__(self, port, supports_spacemark=None, tap=None, topology_file=TOPOLOGY_FILE):
+        """
+        :param port: A MateNETSerial/MateNETPJON port, or the name of a serial port
+        :param supports_spacemark: See MateNETSerial
+        :param tap: Optional wireshark tap
+        :param topology_file:
+            Where to cache the bus topology and device identities between sessions (see enumerate()).
+            None to disable.
+        """
         if isinstance(port, (MateNETSerial, MateNETPJON)):
             self.port = port
         else:
@@ -64,35 +101,189 @@ class MateNET(object):
         # Retry command this many times if we read back an invalid packet (eg. bad CRC)
         self.RETRY_PACKET = 2
 
+        # Time to wait for a response when probing hub ports (see enumerate()).
+        # Devices respond within a few milliseconds, so an empty port doesn't need the full timeout.
+        self.SCAN_TIMEOUT = 0.1 # seconds
+
+        # Device type attached to each port, see enumerate()
+        self.topology = None
+        self.topology_file = topology_file
+        self.topology_from_cache = False
+
+        # Cached identity of the device attached to each port (eg. revision), {port: {key: value}}
+        self.identity = {}
+
+        # Cached register values, used by MateDevice.query()
+        self.cache = RegisterCache()
+
+        # Transaction/error counters and latency histograms, see stats.py
+        self.stats = BusStats()
+
         self.tap = tap
 
-    def send(self, ptype, addr, param=0, port=0, response_len=None):
+        # See start()
+        self.arbiter = None
+
+    def start(self):
+        """
+        Start a bus arbiter thread, so the bus can be safely shared between threads.
+        All transactions are then executed by the arbiter thread, one at a time,
+        with controls/writes taking priority over queries and status polls.
+        """
+        if self.arbiter is None:
+            self.arbiter = BusArbiter()
+            self.arbiter.start()
+
+    def poll_cycle(self):
+        """
+        Context manager for a poll cycle, where each register is only read from the bus once.
+        See RegisterCache.poll_cycle()
+        """
+        return self.cache.poll_cycle()
+
+    def stop(self):
+        """
+        Stop the bus arbiter thread (see start())
+        """
+        if self.arbiter is not None:
+            arbiter, self.arbiter = self.arbiter, None
+            arbiter.stop()
+
+    @staticmethod
+    def default_priority(ptype):
+        """
+        :return: The arbiter priority for a packet type (see arbiter.PRIORITY_*)
+        """
+        if ptype in (MateNET.TYPE_DEC, MateNET.TYPE_INC, MateNET.TYPE_WRITE):
+            return PRIORITY_CONTROL
+        if ptype == MateNET.TYPE_READ:
+            return PRIORITY_QUERY
+        return PRIORITY_STATUS
+
+    def _invalidate_control(self, txn):
+        """
+        Discard the cached value of a register after a control packet (write, increment or decrement),
+        since the register may have changed, even if the control failed
+        """
+        if self.default_priority(txn.ptype) == PRIORITY_CONTROL:
+            self.cache.invalidate(txn.port, txn.addr)
+
+    def submit(self, ptype, addr, param=0, port=0, response_len=None, device_type=None, priority=None, record=False):
+        """
+        Queue a MateNET packet to be sent by the bus arbiter (see start()), without waiting for the response.
+        If the arbiter is not running the packet is sent immediately.
+        :param priority: See arbiter.PRIORITY_*, or None to choose one based on the packet type
+        :param record: See send()
+        :return: BusFuture, whose result() is the raw response (see send())
+        """
+        if priority is None:
+            priority = self.default_priority(ptype)
+        args = (ptype, addr, param, port, response_len, device_type, record)
+
+        arbiter = self.arbiter
+        if arbiter is None:
+            future = BusFuture()
+            try:
+                future.set_result(self.send(*args))
+            except Exception:
+                future.set_exception(sys.exc_info())
+            return future
+
+        return arbiter.submit(self.send, args, priority=priority)
+
+    @classmethod
+    def lookup_response_len(cls, ptype, addr, device_type=None):
+        """
+        Look up the expected length of the response to a command
+        :param ptype: Type of the packet
+        :param addr: Address/register of the packet
+        :param device_type: Type of the device the packet is sent to (see MateNET.DEVICE_*), if known
+        :return: Length of the response payload (excluding command byte and checksum), or None if unknown
+        """
+        for key in (
+            (device_type, ptype, addr),
+            (device_type, ptype, None),
+            (None, ptype, addr),
+            (None, ptype, None)
+        ):
+            if key in cls.RESPONSE_LENGTHS:
+                return cls.RESPONSE_LENGTHS[key]
+        return None
+
+    @staticmethod
+    def _unpack_request(request):
+        """
+        :param request: (ptype, addr, param, port) or (ptype, addr, param, port, device_type) tuple (see send_many())
+        :return: (ptype, addr, param, port, device_type)
+        """
+        if len(request) == 4:
+            return tuple(request) + (None,)
+        return tuple(request)
+
+    def send(self, ptype, addr, param=0, port=0, response_len=None, device_type=None, record=False):
         """
         Send a MateNET packet to the bus (as if it was sent by a MATE unit) and return the response
         :param port: Port to send to, if a hub is present (0 if no hub or talking to the hub)
         :param ptype: Type of the packet
         :param param: Optional parameter (16-bit uint)
+        :param response_len: Expected length of the response, or None to look it up in RESPONSE_LENGTHS
+        :param device_type: Type of the device attached to the port, if known (see MateNET.DEVICE_*)
+        :param record: True to also return a TransactionRecord, with the timing of the transaction
+        :return: The raw response (str), or (response, TransactionRecord) if record is True
+        """
+        arbiter = self.arbiter
+        if arbiter is not None and not arbiter.is_owner():
+            # Let the arbiter thread perform the transaction
+            return self.submit(ptype, addr, param, port, response_len, device_type, record=record).result()
+
+        if response_len is None:
+            response_len = self.lookup_response_len(ptype, addr, device_type)
+
+        txn = TransactionRecord(port, ptype, addr, param)
+        try:
+            data = self._send(txn, response_len)
+        finally:
+            self._invalidate_control(txn)
+
+        if record:
+            return data, txn
+        return data
+
+    def _send(self, txn, response_len):
+        """
+        Perform a transaction, retrying if necessary (see send())
+        :param txn: TransactionRecord for the transaction.
+            May already contain an earlier attempt (see send_many()), which is counted as a retry.
+        :param response_len: Expected length of the response (excluding command ack byte), or None if unknown
         :return: The raw response (str)
         """
+        port, ptype = txn.port, txn.ptype
         if self.log.isEnabledFor(logging.DEBUG):
-            self.log.debug('Send [Port%d, Type=0x%.2x, Addr=0x%.4x, Param=0x%.4x]', port, ptype, addr, param)
+            self.log.debug('Send [Port%d, Type=0x%.2x, Addr=0x%.4x, Param=0x%.4x]', port, ptype, txn.addr, txn.param)
 
         if response_len is not None:
             response_len += 1 # Account for command ack byte
 
-        packet = MateNET.TxPacket(port, ptype, addr, param)
+        packet = MateNET.TxPacket(port, ptype, txn.addr, txn.param)
         data = None
         for i in range(self.RETRY_PACKET+1):
             try:
                 txbuf = packet.to_buffer()
-                self.port.send(txbuf)
+                txn.sent(len(txbuf) + 2)  # Including checksum
+                packet_id = self.port.send(txbuf)
 
-                rxbuf = self.port.recv(response_len)
+                # Only accept the response to this packet, not a late response to an earlier one
+                rxbuf = self.port.recv(response_len, packet_id=packet_id)
                 if not rxbuf:
+                    self.stats.timeout(port, ptype)
                     self.log.debug('RETRY')
                     continue  # No response - try again
                     #return None
 
+                txn.received(len(rxbuf) + 2,  # Including checksum
+                             getattr(self.port, 'rx_first_time', None),
+                             getattr(self.port, 'rx_last_time', None))
+
                 if self.tap:
                     # Send the packet to the wireshark tap pipe, if present
                     
@@ -103,6 +294,7 @@ class MateNET(object):
                     
                 break # Received successfully
             except:
+                self.stats.error(port, ptype, sys.exc_info()[1])
                 if i < self.RETRY_PACKET:
                     self.log.debug('RETRY')
                     continue  # Transmission error - try again
@@ -111,8 +303,22 @@ class MateNET(object):
                     # No response, just capture the TX packet for wireshark
                     self.tap.capture_tx(txbuf+'\xFF\xFF')
 
+                self.stats.record(txn)
                 raise         # Retry limit reached
 
+        self.stats.record(txn)
+        try:
+            data = self._parse_response(rxbuf)
+        except InvalidCommandError as e:
+            self.stats.error(port, ptype, e)
+            raise
+        return data
+
+    def _parse_response(self, rxbuf):
+        """
+        Validate a raw response, and strip the command ack byte
+        :return: The raw response (str), or None if no response
+        """
         if not rxbuf:
             return None
 
@@ -121,10 +327,107 @@ class MateNET(object):
             raise RuntimeError("Error receiving packet - not enough data received")
 
         if ord(rxbuf[0]) & 0x80 == 0x80:
-            raise RuntimeError("Invalid command 0x%.2x" % (ord(rxbuf[0]) & 0x7F))
+            raise InvalidCommandError(ord(rxbuf[0]) & 0x7F)
             
         return rxbuf[1:]
 
+    def send_many(self, requests, record=False):
+        """
+        Send several MateNET packets and return their responses.
+
+        If the port supports pipelining (eg. MateNETPJON with use_packet_id=True),
+        all packets are queued up before waiting for any responses,
+        so the latency to the bridge overlaps with time spent on the bus.
+        Otherwise the packets are sent one at a time.
+
+        A failure does not affect the other packets.
+
+        :param requests: list of (ptype, addr, param, port) tuples,
+            or (ptype, addr, param, port, device_type) to look up the response length for a specific device type
+        :param record: True to also return a TransactionRecord for each packet (see send())
+        :return: list of raw responses (str), in the same order as requests.
+            None for any packet that failed or had no response.
+            If record is True, a list of (response, TransactionRecord) tuples.
+        """
+        arbiter = self.arbiter
+        if arbiter is not None and not arbiter.is_owner():
+            # Execute the whole batch on the arbiter thread
+            priority = min(self.default_priority(request[0]) for request in requests) if requests else PRIORITY_STATUS
+            return arbiter.submit(self.send_many, (requests, record), priority=priority).result()
+
+        txns = []
+        response_lens = []
+        for request in requests:
+            ptype, addr, param, port, device_type = self._unpack_request(request)
+            txns.append(TransactionRecord(port, ptype, addr, param))
+            response_lens.append(self.lookup_response_len(ptype, addr, device_type))
+
+        if not getattr(self.port, 'supports_pipelining', False):
+            results = [self._send_or_none(txn, response_len) for txn, response_len in zip(txns, response_lens)]
+            return list(zip(results, txns)) if record else results
+
+        # Queue up all packets
+        packet_ids = []
+        for txn in txns:
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug('Send [Port%d, Type=0x%.2x, Addr=0x%.4x, Param=0x%.4x]', txn.port, txn.ptype, txn.addr, txn.param)
+            txbuf = MateNET.TxPacket(txn.port, txn.ptype, txn.addr, txn.param).to_buffer()
+            txn.sent(len(txbuf) + 2)  # Including checksum
+            self._invalidate_control(txn)
+            packet_ids.append(self.port.send(txbuf))
+
+        # Collect the responses as they arrive
+        results = []
+        for txn, packet_id, response_len in zip(txns, packet_ids, response_lens):
+            port, ptype = txn.port, txn.ptype
+            try:
+                rxbuf = self.port.recv(None if response_len is None else (response_len + 1),  # Command ack byte
+                                       packet_id=packet_id)
+                if not rxbuf:
+                    self.stats.timeout(port, ptype)
+            except Exception as e:
+                self.stats.error(port, ptype, e)
+                self.log.debug('Pipelined packet failed: %s', e)
+                rxbuf = None
+
+            if not rxbuf:
+                # Fall back to stop-and-wait (with retries)
+                self.log.debug('RETRY')
+                results.append(self._send_or_none(txn, response_len))
+                continue
+
+            txn.received(len(rxbuf) + 2,  # Including checksum
+                         getattr(self.port, 'rx_first_time', None),
+                         getattr(self.port, 'rx_last_time', None))
+            try:
+                data = self._parse_response(rxbuf)
+            except Exception as e:
+                # The device answered (eg. rejected the command), so don't re-send it
+                self.stats.error(port, ptype, e)
+                self.stats.record(txn)
+                self.log.warning('Error sending packet [Port%d, Type=0x%.2x, Addr=0x%.4x]: %s', port, ptype, txn.addr, e)
+                results.append(None)
+                continue
+
+            self.stats.record(txn)
+            results.append(data)
+
+        return list(zip(results, txns)) if record else results
+
+    def _send_or_none(self, txn, response_len):
+        """
+        Same as send(), but returns None instead of raising an exception
+        :param txn: TransactionRecord describing the packet to send
+        :param response_len: Expected length of the response, or None if unknown
+        """
+        try:
+            return self._send(txn, response_len)
+        except Exception as e:
+            self.log.warning('Error sending packet [Port%d, Type=0x%.2x, Addr=0x%.4x]: %s', txn.port, txn.ptype, txn.addr, e)
+            return None
+        finally:
+            self._invalidate_control(txn)
+
 ### Higher level protocol functions ###
 
     def query(self, reg, param=0, port=0):
@@ -134,11 +437,27 @@ class MateNET(object):
         :param param: Optional parameter
         :return: The value (16-bit uint)
         """
-        resp = self.send(MateNET.TYPE_QUERY, addr=reg, param=param, port=port, response_len=MateNET.QueryResponse.size)
+        resp = self.send(MateNET.TYPE_QUERY, addr=reg, param=param, port=port)
         if resp:
             response = MateNET.QueryResponse.from_buffer(resp)
             return response.value
 
+    def read_many(self, registers):
+        """
+        Read several registers, across any number of ports, in one batch.
+        Duplicates are only read once, and the reads are grouped by port
+        and sent back to back (see send_many()).
+        :param registers: iterable of (port, reg) tuples
+        :return: dict of {(port, reg): value}. The value is None for any register that could not be read.
+        """
+        keys = sorted(set(registers))
+        requests = [(MateNET.TYPE_QUERY, reg, 0, port) for port, reg in keys]
+
+        values = {}
+        for key, resp in zip(keys, self.send_many(requests)):
+            values[key] = MateNET.QueryResponse.from_buffer(resp).value if resp else None
+        return values
+
     def control(self, reg, value, port=0):
         """
         Control a register
@@ -147,7 +466,7 @@ class MateNET(object):
         :param port: Port (0-10)
         :return: ???
         """
-        resp = self.send(MateNET.TYPE_CONTROL, addr=reg, param=value, port=port, response_len=MateNET.QueryResponse.size)
+        resp = self.send(MateNET.TYPE_CONTROL, addr=reg, param=value, port=port)
         if resp:
             return None  # TODO: What kind of response do we get from a control packet?
 
@@ -175,15 +494,69 @@ class MateNET(object):
             result = result & 0x00FF
         return result
 
-    def enumerate(self):
+    def probe(self, port=0):
+        """
+        Quickly check which device is attached to a hub port.
+        Unlike scan(), this only waits SCAN_TIMEOUT for a response,
+        and a silent port is not retried (a corrupted response still is).
+        :param port: int, 0-10 (root:0)
+        :return: int, the type of device that is attached (see MateNET.DEVICE_*), or None if nothing responded
+        """
+        arbiter = self.arbiter
+        if arbiter is not None and not arbiter.is_owner():
+            return arbiter.submit(self.probe, (port,), priority=PRIORITY_QUERY).result()
+
+        ptype = MateNET.TYPE_QUERY
+        txn = TransactionRecord(port, ptype, 0x0000)
+        txbuf = MateNET.TxPacket(port, ptype, 0x0000, 0).to_buffer()
+        for i in range(self.RETRY_PACKET+1):
+            try:
+                txn.sent(len(txbuf) + 2)  # Including checksum
+                packet_id = self.port.send(txbuf)
+                rxbuf = self.port.recv(3, self.SCAN_TIMEOUT, packet_id=packet_id)  # Command ack + 16-bit register value
+                if rxbuf:
+                    txn.received(len(rxbuf) + 2,  # Including checksum
+                                 getattr(self.port, 'rx_first_time', None),
+                                 getattr(self.port, 'rx_last_time', None))
+                else:
+                    self.stats.timeout(port, ptype)
+                break
+            except:
+                self.stats.error(port, ptype, sys.exc_info()[1])
+                if i < self.RETRY_PACKET:
+                    self.log.debug('RETRY')
+                    continue  # Transmission error - try again
+                self.stats.record(txn)
+                raise
+
+        self.stats.record(txn)
+        resp = self._parse_response(rxbuf)
+        if not resp:
+            return None  # Nothing attached
+        return MateNET.QueryResponse.from_buffer(resp).value & 0x00FF
+
+    def enumerate(self, rescan=False):
         """
         Scan for device(s) on the bus.
-        Returns a list of device types at each port location
+        Returns a list of device types at each port location (0 if nothing is attached),
+        which is also kept in self.topology for find_device() and the device constructors.
+
+        Hub ports are probed in a single pass with a short timeout (see probe()),
+        so a hub with empty ports only takes about a second to scan.
+
+        The result is cached in topology_file. On the next session, each occupied port
+        in the cache is checked with a single query, and the bus is only rescanned
+        if something has changed.
+
+        :param rescan: True to ignore the cached topology
         """
+        if not rescan and self.load_topology():
+            return self.topology
+
         devices = [0]*10
         
         # Port 0 will either be a device or a hub.
-        devices[0] = self.query(0x00, port=0)
+        devices[0] = self.scan(port=0)
         if not devices[0]:
             raise Exception('No devices found on the bus')
         
@@ -191,17 +564,113 @@ class MateNET(object):
         if devices[0] == MateNET.DEVICE_HUB:
             for i in range(1,len(devices)):
                 self.log.info('Scanning port %d', i)
-                devices[i] = self.query(0x00, port=i)
-        
+                try:
+                    devices[i] = self.probe(port=i) or 0
+                except Exception as e:
+                    self.log.warning('Error scanning port %d: %s', i, e)
+
+        # Forget the identity of any device that has moved
+        old_devices = self.topology or [0]*len(devices)
+        for i in range(len(devices)):
+            if devices[i] != old_devices[i]:
+                self.identity.pop(i, None)
+                self.cache.invalidate(port=i)
+
+        self.topology = devices
+        self.topology_from_cache = False
+        self.save_topology()
         return devices
 
-    def find_device(self, device_type):
+    def _topology_key(self):
+        """
+        :return: The name of the serial port, which the cached topology is stored under
+        """
+        ser = getattr(self.port, 'ser', None)
+        return getattr(ser, 'port', None)
+
+    def _read_topology_file(self):
+        if not self.topology_file or not os.path.exists(self.topology_file):
+            return {}
+        try:
+            with open(self.topology_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            self.log.warning('Could not load topology from %s: %s', self.topology_file, e)
+            return {}
+
+    def load_topology(self):
+        """
+        Load the topology cached by a previous session, and check that it still matches
+        the devices attached to the bus (one query per occupied port).
+        :return: True if the cached topology was loaded
+        """
+        key = self._topology_key()
+        if key is None:
+            return False
+        cached = self._read_topology_file().get(key)
+        if not cached:
+            return False
+
+        devices = cached['ports']
+        for i, dtype in enumerate(devices):
+            if not dtype:
+                continue
+            try:
+                found = self.probe(port=i)
+            except Exception:
+                found = None
+            if found != dtype:
+                self.log.info('Cached topology does not match (port %d: expected %s, found %s), rescanning',
+                    i, dtype, found)
+                return False
+
+        self.topology = devices
+        self.topology_from_cache = True
+        self.identity = dict((int(port), ident) for port, ident in cached.get('identity', {}).items())
+        self.log.info('Using cached topology: %s', devices)
+        return True
+
+    def save_topology(self):
+        """
+        Store the current topology and device identities, so later sessions can use them
+        """
+        key = self._topology_key()
+        if not self.topology_file or key is None or self.topology is None:
+            return
+
+        cache = self._read_topology_file()
+        cache[key] = {
+            'ports': self.topology,
+            'identity': dict((str(port), ident) for port, ident in self.identity.items()),
+        }
+
+        path = os.path.dirname(self.topology_file)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        with open(self.topology_file, 'w') as f:
+            json.dump(cache, f, indent=4)
+
+    def get_identity(self, port, key):
+        """
+        :return: A cached property of the device attached to a port (eg. 'revision'), or None if unknown
+        """
+        return self.identity.get(port, {}).get(key)
+
+    def set_identity(self, port, key, value):
+        """
+        Cache a property of the device attached to a port, which doesn't change between sessions
+        """
+        ident = self.identity.setdefault(port, {})
+        if ident.get(key) != value:
+            ident[key] = value
+            self.save_topology()
+
+    def find_device(self, device_type, rescan=False):
         """
         Find which port a device is connected to.
 
-        Note: If you have a hub, you should fill the ports starting from 1,
-        not leaving any gaps. Any empty ports will introduce delay as we wait 
-        for a timeout.
+        The bus is enumerated on the first call (or the cached topology is used),
+        and the result is reused by subsequent calls (pass rescan=True to enumerate again).
 
         KeyError is thrown if the device is not connected.
 
@@ -209,8 +678,14 @@ class MateNET(object):
         port = bus.find_device(MateNET.DEVICE_MX)
         mx = MateMXDevice(bus, port)
         """
-        for i in range(0,10):
-            dtype = self.scan(port=i)
+        if rescan or self.topology is None:
+            self.enumerate(rescan)
+
+        if device_type not in self.topology and self.topology_from_cache:
+            # The device may have been connected since the topology was cached
+            self.enumerate(rescan=True)
+
+        for i, dtype in enumerate(self.topology):
             if dtype and dtype == device_type:
                 self.log.info('Found %s device at port %d',
                     MateNET.DEVICE_TYPES[dtype],
@@ -8,27 +8,143 @@
 # PJON v3.1 - https://github.com/gioblu/PJON/blob/master/specification/PJON-protocol-specification-v3.1.md
 
 from serial import Serial
-from time import sleep, time
+from pymate.util import monotonic
+from errors import ChecksumError
+from struct import pack
 import logging
+import zlib
 
 SFSP_START = 0x95
 SFSP_END   = 0xEA
 SFSP_ESC   = 0xBB
 
+# (byte, escaped bytes) for each byte that must be escaped within a frame.
+# SFSP_ESC must come first, so the escape bytes inserted by the others aren't escaped again.
+SFSP_ESCAPES = [
+    (chr(b), chr(SFSP_ESC) + chr(b ^ SFSP_ESC))
+    for b in (SFSP_ESC, SFSP_START, SFSP_END)
+]
+
 # [START:8][H:8][I:8][END:8]...[ACK:8]
 
 TSDL_ACK        = 6
 
-RX_IDLE = 0
-RX_RECV = 1
-
 ID_BROADCAST = 0
 
 TARGET_DEVICE = 0x0A
 TARGET_MATE = 0x0B
 
+
+def _crc8_table():
+    """
+    See PJON\src\utils\crc\PJON_CRC8.h
+    """
+    table = []
+    for b in range(256):
+        crc = 0
+        for i in range(8):
+            odd = ((b ^ crc) & 1) == 1
+            crc >>= 1
+            b   >>= 1
+            if odd: crc ^= 0x97
+        table.append(crc)
+    return tuple(table)
+
+CRC8_TABLE = _crc8_table()
+
+
+class SFSPDecoder(object):
+    """
+    Incremental SFSP frame decoder.
+    Feed it whatever data is available, and it returns any complete frames.
+    Partial frames are carried over to the next call,
+    so frames can be split across (or packed into) reads in any way.
+
+    Usage:
+    decoder = SFSPDecoder()
+    for frame in decoder.feed(data):
+        ...
+    """
+    # Anything larger than this without an SFSP_END is discarded
+    MAX_FRAME_LEN = 1024
+
+    def __init__(self):
+        self.log = logging.getLogger('mate.pjon')
+        self.buffer = ''  # Always empty, or starting with SFSP_START
+
+    def reset(self):
+        """
+        Discard any partially received frame
+        """
+        self.buffer = ''
+
+    @staticmethod
+    def unescape(data):
+        """
+        :param data: Escaped contents of a frame (str, excluding SFSP_START/SFSP_END)
+        :return: bytearray
+        """
+        parts = data.split(chr(SFSP_ESC))
+        for i in range(1, len(parts)):
+            part = parts[i]
+            if part:
+                parts[i] = chr(ord(part[0]) ^ SFSP_ESC) + part[1:]
+        return bytearray(''.join(parts))
+
+    def feed(self, data):
+        """
+        Decode a chunk of received data
+        :param data: str
+        :return: list of unescaped frames (list of bytearray)
+        """
+        start_byte = chr(SFSP_START)
+        end_byte = chr(SFSP_END)
+
+        buffer = self.buffer + data
+        frames = []
+        while True:
+            # Locate start of frame
+            start = buffer.find(start_byte)
+            if start < 0:
+                buffer = ''
+                break
+
+            # Locate end of frame
+            end = buffer.find(end_byte, start+1)
+            if end < 0:
+                buffer = buffer[start:]
+                if len(buffer) > self.MAX_FRAME_LEN:
+                    self.log.debug('RX FRAME TOO LONG')
+                    # Resynchronise on the last SFSP_START, unless that is the start of this frame
+                    # (eg. a lost SFSP_END or garbage), in which case the whole buffer is discarded.
+                    restart = buffer.rfind(start_byte)
+                    buffer = buffer[restart:] if restart > 0 else ''
+                break
+
+            # A frame that was interrupted by another SFSP_START is discarded
+            restart = buffer.rfind(start_byte, start+1, end)
+            if restart >= 0:
+                self.log.debug('RX UNEXPECTED START')
+                start = restart
+
+            frames.append(self.unescape(buffer[start+1:end]))
+            buffer = buffer[end+1:]
+
+        self.buffer = buffer
+        return frames
+
+
 class MateNETPJON(object):
-    def __init__(self, comport, baud=9600, target=TARGET_DEVICE):
+    def __init__(self, comport, baud=9600, target=TARGET_DEVICE, use_packet_id=False):
+        """
+        :param comport: The serial port the PJON bridge is attached to (eg. /dev/ttyUSB0 or COM1)
+        :param baud: Baud rate of the bridge
+        :param target: PJON device ID of the bridge
+        :param use_packet_id:
+            Tag each packet with a PJON packet ID, so several packets can be in flight at once
+            and their responses matched up as they arrive (see MateNET.send_many()).
+            The bridge must echo the packet ID back in its responses.
+        """
         if isinstance(comport, Serial):
             self.ser = comport
         else:
@@ -37,33 +153,61 @@ class MateNETPJON(object):
         
         self.device_id = 1
         self.log = logging.getLogger('mate.pjon')
-        self.rx_buffer = []
-        self.rx_state = RX_IDLE
+        self.decoder = SFSPDecoder()
+        self.rx_frames = []  # Frames that have been received but not yet processed
         self.target = target
 
+        self.use_packet_id = use_packet_id
+        self.packet_id = 0
+        self.rx_responses = {}  # Responses received for other packet IDs {packet_id: payload}
+
+        # When the first/last byte of the last frame was received from the bridge (monotonic, see recv()).
+        # Responses which were held while waiting for another packet keep the time of that read.
+        self.rx_first_time = None
+        self.rx_last_time = None
+
+    @property
+    def supports_pipelining(self):
+        """
+        True if more than one packet can be in flight at a time
+        """
+        return self.use_packet_id
+
     def _build_frame(self, data):
-        yield SFSP_START
-        for b in data:
-            if b in [SFSP_START, SFSP_END, SFSP_ESC]:
-                b ^= SFSP_ESC
-                yield SFSP_ESC
-            yield b
-        yield SFSP_END
-        
+        """
+        Escape & frame data
+        :param data: bytearray or str
+        :return: str
+        """
+        data = bytes(data)
+        for b, escaped in SFSP_ESCAPES:
+            data = data.replace(b, escaped)
+        return chr(SFSP_START) + data + chr(SFSP_END)
+
     def send(self, data, target_device_id=0):
         """
         Send a packet to PJON bus
+        :return: The packet ID if use_packet_id is enabled (pass this to recv()), otherwise None
         """
-        data = [self.target] + [ord(c) for c in data] # TODO: Hacky
+        data = chr(self.target) + data
 
         # NOTE: We are using a very watered down version of the PJON spec
         # since this is intended to be used as a 1:1 communication over a USB serial bus.
 
         header_len = 5
+        packet_id = None
+        if self.use_packet_id:
+            header_len += 2
+            self.packet_id = (self.packet_id % 0xFFFF) + 1  # 1..65535
+            packet_id = self.packet_id
+            self.rx_responses.pop(packet_id, None)  # Discard any stale response with the same ID
+
         total_len = len(data) + header_len
         use_crc32 = ((len(data) + header_len) > 15)
 
         header = 0x02 # PJON_TX_INFO_BIT
+        if packet_id is not None:
+            header |= 0b10000000 # PJON_PACKET_ID_BIT
         if use_crc32:
             header |= 0b00100000 # PJON_CRC_BIT
             total_len += 4
@@ -71,200 +215,278 @@ class MateNETPJON(object):
             total_len += 1
 
         # Prepare header
-        buffer = []
+        buffer = bytearray()
         buffer.append(target_device_id)
         buffer.append(header)
         buffer.append(total_len)
         crc_h = self._crc8(buffer)
         buffer.append(crc_h)
         buffer.append(self.device_id)  # PJON_TX_INFO_BIT in header must be set
+        if packet_id is not None:
+            buffer += pack('>H', packet_id)
 
         # Add payload
-        buffer += list(data)
+        buffer += data
 
         # Compute CRC(Header + Payload)
         if use_crc32:
             # If packet > 15 bytes then we must use a 32-bit CRC
             crc_p = self._crc32(buffer)
-            buffer.append((crc_p >> 24) & 0xFF)
-            buffer.append((crc_p >> 16) & 0xFF)
-            buffer.append((crc_p >> 8) & 0xFF)
-            buffer.append((crc_p) & 0xFF)
+            buffer += pack('>I', crc_p)
         else:
             crc_p = self._crc8(buffer)
             buffer.append(crc_p)
 
         if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug('TX: %s', (' '.join('%.2x' % c for c in buffer)))
-        
-        # Escape & Frame data
-        buffer = list(self._build_frame(buffer))
 
-        self.ser.write(buffer)
+        self.ser.write(self._build_frame(buffer))
+
+        return packet_id
 
     def _crc8(self, data):
+        """
+        :param data: bytearray or list of int
+        """
         crc = 0
         for b in data:
-            if b < 0: b += 256
-            for i in range(8):
-                odd = ((b ^ crc) & 1) == 1
-                crc >>= 1
-                b   >>= 1
-                if odd: crc ^= 0x97
+            crc = CRC8_TABLE[crc ^ (b & 0xFF)]
         return crc
 
     def _crc32(self, data):
         """
         See PJON\src\utils\crc\PJON_CRC32.h
+        (Same as the standard CRC-32, so zlib can do the work)
+        :param data: bytearray or list of int
         """
-        crc = 0xFFFFFFFF
-        for b in data:
-            crc ^= (b & 0xFF)
-            for i in range(8):
-                odd = crc & 1
-                crc >>= 1
-                if odd:
-                    crc ^= 0xEDB88320
-        return crc ^ 0xFFFFFFFF
+        return zlib.crc32(bytes(bytearray(data))) & 0xFFFFFFFF
 
     def _recv_frame(self, timeout=1.0):
         """
         Receive an escaped frame from PJON bus
         :param timeout: seconds to wait until returning, 0 to return immediately, None to block indefinitely
-        :return: bytes if packet received, None if timeout
+        :return: bytearray if packet received, None if timeout
         """
         # Example RX packet:
         # 149 0 2 11 226 44 72 69 76 76 79 69 234
-        buffer = []
-        escape_next = False
-        t_start = time()
-
-        self.ser.timeout = 0.01
-        self.rx_state = RX_IDLE
-
-        while (time() - t_start < timeout):
-            if self.rx_state == RX_IDLE:
-                # Locate start of frame
-                data = self.ser.read(1)
-                if data:
-                    b = ord(data[0])
-                    if b == SFSP_START:
-                        self.rx_state = RX_RECV
-                        self.log.debug('RX START')
-                        continue
-
-            elif self.rx_state == RX_RECV:
-                # Read until SFSP_END encountered
-                data = self.ser.read()
-                if data:
-                    for c in data:
-                        b = ord(c)
-                        if b == SFSP_END:
-                            return buffer  # Complete frame received!
-
-                        else:
-                            # Unescape
-                            if b == SFSP_ESC:
-                                escape_next = True
-                                continue
-
-                            elif b == SFSP_START:
-                                self.log.debug('RX UNEXPECTED START')
-                                self.rx_state = RX_IDLE
-                                buffer = []
-                                escape_next = False
-                                continue
-
-                            if escape_next:
-                                b ^= SFSP_ESC
-                                escape_next = False
-
-                            buffer.append(b)
+
+        # Back-to-back frames may already have been received
+        if self.rx_frames:
+            return self.rx_frames.pop(0)
+
+        if timeout is not None:
+            t_end = monotonic() + timeout
+        self.ser.timeout = timeout
+
+        while True:
+            # Wait for some data, then take everything that has arrived so far
+            data = self.ser.read(1)
+            if data:
+                if not self.decoder.buffer:
+                    self.rx_first_time = monotonic()
+                n = self.ser.in_waiting
+                if n:
+                    data += self.ser.read(n)
+                self.rx_last_time = monotonic()
+
+                self.rx_frames.extend(self.decoder.feed(data))
+                if self.rx_frames:
+                    return self.rx_frames.pop(0)
+
+            if timeout is not None:
+                remaining = t_end - monotonic()
+                if remaining <= 0:
+                    break
+                self.ser.timeout = remaining
 
         self.log.info('RX TIMEOUT')
         return None
 
-    def recv(self, expected_len=None, timeout=1.0):
+    def _parse_frame(self, data):
+        """
+        Parse & validate a PJON packet
+        :param data: Unescaped frame (bytearray)
+        :return: (packet_id, payload) tuple, or None if the packet is not addressed to us.
+            packet_id is None if the packet does not have one.
+        """
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('RX: %s', (' '.join('%.2x' % b for b in data)))
+
+        if len(data) < 5:
+            raise RuntimeError('PJON error: Not enough bytes')
+
+        # [ID:8][Header:8][Length:8][CRC:8][Data...][CRC:8]
+
+        i = 0
+
+        device_id  = data[i]; i += 1
+        header     = data[i]; i += 1
+        packet_len = data[i]; i += 1
+
+        if device_id != ID_BROADCAST and device_id != self.device_id:
+            self.log.debug('PJON: Ignoring packet for ID:0x%.2x', device_id)
+            return None  # Not addressed to us
+
+        if packet_len < 4:
+            raise RuntimeError('PJON error: Invalid length')
+        if packet_len > len(data):
+            raise RuntimeError('PJON error: Not enough bytes')
+
+        use_crc32 = (header & 0b00100000)
+
+        # Validate header CRC
+        header_crc_actual = self._crc8(data[0:i])
+        header_crc        = data[i]; i += 1
+        if header_crc != header_crc_actual:
+            raise ChecksumError('PJON error: Bad header CRC (%.2x != %.2x)' % (header_crc, header_crc_actual))
+        
+        # Header bits change how the packet is parsed
+        packet_id = None
+        if header & 0b00000001:
+            raise RuntimeError('PJON error: Shared mode not supported')
+        if header & 0b00000010:
+            tx_id = data[i]; i += 1
+        if header & 0b00010000:
+            raise RuntimeError('PJON error: Network services not supported')
+        if header & 0b01000000:
+            raise RuntimeError('PJON error: Extended length (>=200 bytes) not supported')
+        if header & 0b10000000:
+            packet_id = (data[i] << 8) | data[i+1]; i += 2
+
+        payload     = data[i:packet_len-1];
+
+        # Validate CRC(Header + Payload)
+        if use_crc32:
+            payload_crc_actual = self._crc32(data[0:-4])
+            payload_crc        = (data[-4]<<24) | (data[-3]<<16) | (data[-2]<<8) | data[-1]
+            if payload_crc != payload_crc_actual:
+                raise ChecksumError('PJON error: Bad CRC32 (%.8x != %.8x)' % (payload_crc, payload_crc_actual))
+        else:
+            payload_crc_actual = self._crc8(data[0:-1])
+            payload_crc        = data[packet_len-1]
+            if payload_crc != payload_crc_actual:
+                raise ChecksumError('PJON error: Bad CRC8 (%.2x != %.2x)' % (payload_crc, payload_crc_actual))
+
+        if header & 0b00000100:
+            # Synchronous acknowledgement requested (TSDL)
+            self.ser.write(chr(TSDL_ACK))
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('RX: [I:%.2X, H:%.2X, Len:%d, PID:%s, Data:[%s]]',
+                device_id,
+                header,
+                packet_len,
+                packet_id,
+                (' '.join('%.2x' % b for b in payload))
+            )
+
+        return packet_id, payload
+
+    def recv(self, expected_len=None, timeout=1.0, packet_id=None):
         """
         Receive a packet from PJON bus
         :param timeout: seconds to wait until returning, 0 to return immediately, None to block indefinitely
+        :param packet_id: Wait for the response to the packet with this ID (as returned by send()).
+            Responses to other packets are held until they are asked for.
+            None to return the next response received.
         :return: bytes if packet received, None if timeout
         """
-        data = self._recv_frame(timeout)
-        if data:
-            if self.log.isEnabledFor(logging.DEBUG):
-                self.log.debug('RX: %s', (' '.join('%.2x' % b for b in data)))
-
-            if len(data) < 5:
-                raise RuntimeError('PJON error: Not enough bytes')
-
-            # [ID:8][Header:8][Length:8][CRC:8][Data...][CRC:8]
-
-            i = 0
-
-            device_id  = data[i]; i += 1
-            header     = data[i]; i += 1
-            packet_len = data[i]; i += 1
-
-            if device_id != ID_BROADCAST and device_id != self.device_id:
-                self.log.debug('PJON: Ignoring packet for ID:0x%.2x', device_id)
-                return None  # Not addressed to us
-
-            if packet_len < 4:
-                raise RuntimeError('PJON error: Invalid length')
-            if packet_len > len(data):
-                raise RuntimeError('PJON error: Not enough bytes')
-
-            use_crc32 = (header & 0b00100000)
-
-            # Validate header CRC
-            header_crc_actual = self._crc8(data[0:i])
-            header_crc        = data[i]; i += 1
-            if header_crc != header_crc_actual:
-                raise RuntimeError('PJON error: Bad header CRC (%.2x != %.2x)' % (header_crc, header_crc_actual))
-            
-            # Header bits change how the packet is parsed
-            if header & 0b00000001:
-                raise RuntimeError('PJON error: Shared mode not supported')
-            if header & 0b00000010:
-                tx_id = data[i]; i += 1
-            if header & 0b00000100:
-                raise RuntimeError('PJON error: ACK requested but not supported')
-            if header & 0b00010000:
-                raise RuntimeError('PJON error: Network services not supported')
-            if header & 0b01000000:
-                raise RuntimeError('PJON error: Extended length (>=200 bytes) not supported')
-            if header & 0b10000000:
-                raise RuntimeError('PJON error: Packet identification not supported')
-
-            payload     = data[i:packet_len-1];
-
-            # Validate CRC(Header + Payload)
-            if use_crc32:
-                payload_crc_actual = self._crc32(data[0:-4])
-                payload_crc        = (data[-4]<<24) | (data[-3]<<16) | (data[-2]<<8) | data[-1]
-                if payload_crc != payload_crc_actual:
-                    raise RuntimeError('PJON error: Bad CRC32 (%.8x != %.8x)' % (payload_crc, payload_crc_actual))
-            else:
-                payload_crc_actual = self._crc8(data[0:-1])
-                payload_crc        = data[packet_len-1]
-                if payload_crc != payload_crc_actual:
-                    raise RuntimeError('PJON error: Bad CRC8 (%.2x != %.2x)' % (payload_crc, payload_crc_actual))
-
-            if self.log.isEnabledFor(logging.DEBUG):
-                self.log.debug('RX: [I:%.2X, H:%.2X, Len:%d, Data:[%s]]',
-                    device_id,
-                    header,
-                    packet_len,
-                    (' '.join('%.2x' % b for b in payload))
-                )
-
-            if len(payload) == 1:
-                raise RuntimeError("PJON error: Error returned from controller: %.2x" % (payload[0]))
-
-            # TODO: Validate payload length against expected_len
-
-            return ''.join(chr(c) for c in payload) # TODO: Hacky
+        if packet_id is not None and packet_id in self.rx_responses:
+            # Already arrived while we were waiting for another packet
+            payload = self.rx_responses.pop(packet_id)
+        else:
+            if timeout is not None:
+                t_end = monotonic() + timeout
+
+            while True:
+                data = self._recv_frame(timeout)
+                if not data:
+                    return None
+
+                result = self._parse_frame(data)
+                if result is not None:
+                    rx_packet_id, payload = result
+                    if (packet_id is None) or (rx_packet_id == packet_id):
+                        break
+
+                    # Response to another packet that is in flight
+                    self.rx_responses[rx_packet_id] = payload
+
+                if timeout is not None:
+                    timeout = t_end - monotonic()
+                    if timeout <= 0:
+                        return None
+
+        return self._check_payload(payload, expected_len)
+
+    def _check_payload(self, payload, expected_len=None):
+        """
+        Validate the payload of a received packet
+        :return: bytes
+        """
+        if len(payload) == 1:
+            raise RuntimeError("PJON error: Error returned from controller: %.2x" % (payload[0]))
+
+        if expected_len is not None and len(payload) != expected_len:
+            raise RuntimeError('PJON error: Unexpected payload length (%d bytes, expected %d)' % (len(payload), expected_len))
+
+        return bytes(payload)
+
+### Non-blocking interface (see eventloop.py) ###
+
+    def fileno(self):
+        """
+        :return: File descriptor of the serial port, for use with select()
+        """
+        return self.ser.fileno()
+
+    def read_nonblocking(self):
+        """
+        :return: Any data that has already been received (str, may be empty)
+        """
+        n = self.ser.in_waiting
+        if not n:
+            return ''
+        return self.ser.read(n)
+
+    def recv_start(self, expected_len=None, packet_id=None):
+        """
+        Prepare to receive a packet with recv_feed()
+        (call recv_feed('') to check for a response that has already been received)
+        :param expected_len: Expected length of the payload, or None if unknown
+        :param packet_id: Only accept the response to the packet with this ID (see recv())
+        """
+        self.rx_expected_len = expected_len
+        self.rx_packet_id = packet_id
+
+    def recv_feed(self, data):
+        """
+        Add received data to the packet started by recv_start()
+        :param data: str
+        :return: bytes if the packet is complete (see recv()), None if more data is needed
+        """
+        if self.rx_packet_id is not None and self.rx_packet_id in self.rx_responses:
+            # Already arrived while we were waiting for another packet
+            return self._check_payload(self.rx_responses.pop(self.rx_packet_id), self.rx_expected_len)
+
+        # Any frames after the one we're waiting for are kept for later (as in recv())
+        self.rx_frames.extend(self.decoder.feed(data))
+        while self.rx_frames:
+            result = self._parse_frame(self.rx_frames.pop(0))
+            if result is not None:
+                rx_packet_id, payload = result
+                if (self.rx_packet_id is not None) and (rx_packet_id != self.rx_packet_id):
+                    # Response to another packet
+                    self.rx_responses[rx_packet_id] = payload
+                    continue
+                return self._check_payload(payload, self.rx_expected_len)
+        return None
+
+    def recv_end(self):
+        """
+        PJON frames are self-delimiting, so there is never a partial packet to complete
+        """
+        return None
 
 if __name__ == "__main__":
     ch = logging.StreamHandler()
@@ -24,8 +24,28 @@ __author__ = 'Jared'
 
 from serial import Serial, PARITY_SPACE, PARITY_MARK, PARITY_ODD, PARITY_EVEN
 from pymate.cstruct import struct
+from pymate.util import monotonic
+from errors import ChecksumError
 from time import sleep
 import logging
+import json
+import os
+
+# Where the results of MateNETSerial.calibrate() are stored (per serial port)
+CALIBRATION_FILE = os.path.join(os.path.expanduser('~'), '.pymate', 'calibration.json')
+
+# Contents of each calibration file, so it is only read once per process {path: {port: delay}}
+_calibrations = {}
+
+# Odd parity of every byte value (1 if an odd number of bits are set)
+PARITY_TABLE = tuple(bin(b).count('1') & 1 for b in range(256))
+
+# The EVEN/ODD parity setting that emulates SPACE/MARK parity for every byte value
+# EMULATED_PARITY[bit8][b]
+EMULATED_PARITY = (
+    tuple((PARITY_ODD if p else PARITY_EVEN) for p in PARITY_TABLE),      # SPACE (bit8 cleared)
+    tuple((PARITY_EVEN if p else PARITY_ODD) for p in PARITY_TABLE),      # MARK (bit8 set)
+)
 
 class MateNETSerial(object):
     """
@@ -33,13 +53,16 @@ class MateNETSerial(object):
     This class only handles the low level protocol,
     it does not care what is attached to the bus.
     """
-    def __init__(self, comport, supports_spacemark=None):
+    def __init__(self, comport, supports_spacemark=None, calibration_file=CALIBRATION_FILE):
         """
         :param comport: The hardware serial port to use (eg. /dev/ttyUSB0 or COM1)
         :param supports_spacemark: 
             True-Port supports Space/Mark parity. 
             False-Port does not support Space/Mark parity. 
             None-Try detect whether the port supports Space/Mark parity.
+        :param calibration_file:
+            Where to load/store the per-byte delay measured by calibrate().
+            None to disable.
         """
         if isinstance(comport, Serial):
             self.ser = comport
@@ -52,13 +75,24 @@ class MateNETSerial(object):
         # Delay between bytes when space/mark is not supported
         # This is needed to ensure changing the parity between even/odd only affects one byte at a time
         # (Essentially forces 1 byte in the TX buffer at a time)
+        # Use calibrate() to measure the smallest safe value for your serial adapter.
         self.FUDGE_FACTOR = 0.002 # seconds
 
         # Amount of time with no communication that signifies the end of the packet
         self.END_OF_PACKET_TIMEOUT = 0.02 # seconds
 
-        # Set to true to workaround issue where some received packets are too large
-        self.TRIM_LARGE_PACKETS = True
+        # Time taken to transmit one byte on the wire (start bit + 9 data bits + stop bit)
+        self.BYTE_TIME = 11.0 / self.ser.baudrate # seconds
+
+        # Return as soon as the expected number of bytes has arrived,
+        # rather than waiting for END_OF_PACKET_TIMEOUT of silence.
+        # Only applies when the caller knows the length of the response.
+        self.EARLY_COMPLETION = True
+
+        # Set to true to trim packets that are too large down to the expected length, without checking them
+        # (old workaround for stray bytes before a packet, which recv() now discards itself).
+        # Otherwise a packet that is larger than expected is rejected.
+        self.TRIM_LARGE_PACKETS = False
 
         self.supports_spacemark = supports_spacemark
         if self.supports_spacemark is None:
@@ -67,16 +101,104 @@ class MateNETSerial(object):
                 (PARITY_MARK in self.ser.PARITIES)
             )
 
+        self.calibration_file = calibration_file
+        self.load_calibration()
+
+        # When the first/last byte of the last packet was received (monotonic, see recv())
+        self.rx_first_time = None
+        self.rx_last_time = None
+
+    def load_calibration(self):
+        """
+        Load the per-byte delay previously measured by calibrate() for this port, if any
+        :return: True if a calibration was loaded
+        """
+        if not self.calibration_file:
+            return False
+
+        calibration = _calibrations.get(self.calibration_file)
+        if calibration is None:
+            calibration = {}
+            if os.path.exists(self.calibration_file):
+                try:
+                    with open(self.calibration_file, 'r') as f:
+                        calibration = json.load(f)
+                except (IOError, ValueError) as e:
+                    self.log.warning('Could not load calibration from %s: %s', self.calibration_file, e)
+            _calibrations[self.calibration_file] = calibration
+
+        if self.ser.port not in calibration:
+            return False
+
+        self.FUDGE_FACTOR = float(calibration[self.ser.port])
+        self.log.debug('Loaded calibration for %s: %.6fs', self.ser.port, self.FUDGE_FACTOR)
+        return True
+
+    def save_calibration(self):
+        """
+        Store the current per-byte delay for this port, so later sessions can use it
+        """
+        if not self.calibration_file:
+            return
+
+        calibration = {}
+        if os.path.exists(self.calibration_file):
+            try:
+                with open(self.calibration_file, 'r') as f:
+                    calibration = json.load(f)
+            except (IOError, ValueError):
+                pass # Overwrite the corrupt file
+
+        calibration[self.ser.port] = self.FUDGE_FACTOR
+
+        path = os.path.dirname(self.calibration_file)
+        if path and not os.path.exists(path):
+            os.makedirs(path)
+        with open(self.calibration_file, 'w') as f:
+            json.dump(calibration, f, indent=4)
+        _calibrations[self.calibration_file] = calibration
+
+    def calibrate(self, samples=20, margin=1.5, save=True):
+        """
+        Measure how long the serial adapter takes to drain a single byte,
+        and use that as the delay between bytes (FUDGE_FACTOR) when emulating space/mark parity.
+
+        Bytes are transmitted with the 9th bit cleared (data bytes),
+        so they are ignored by any attached devices.
+
+        :param samples: Number of bytes to measure
+        :param margin: Safety margin applied to the slowest measurement
+        :param save: Store the result in calibration_file
+        :return: The new per-byte delay (seconds)
+        """
+        worst = 0.0
+        for i in range(samples):
+            # 0x00 has even parity, so EVEN parity gives a cleared 9th bit
+            self.ser.parity = PARITY_EVEN
+
+            t_start = monotonic()
+            self.ser.write('\x00')
+            self.ser.flush() # Waits for the OS to drain its buffer (tcdrain)
+            while self.ser.out_waiting:
+                sleep(self.BYTE_TIME / 10.0)  # Poll, rather than spinning on the CPU
+            worst = max(worst, monotonic() - t_start)
+
+        # A byte can't be sent any faster than the baud rate allows,
+        # regardless of what the adapter reports.
+        self.FUDGE_FACTOR = max(worst, self.BYTE_TIME) * margin
+        self.log.info('Calibrated %s: %.6fs per byte (worst drain: %.6fs)', self.ser.port, self.FUDGE_FACTOR, worst)
+
+        if save:
+            self.save_calibration()
+
+        return self.FUDGE_FACTOR
+
     def _odd_parity(self, b):
-        p = False
-        while b:
-            p = not p
-            b = b & (b - 1)
-        return p
+        return PARITY_TABLE[b]
 
     def _write_9b(self, data, bit8):
         if self.log.isEnabledFor(logging.DEBUG):
-            self.log.debug('TX: [%d] %s', bit8, (' '.join('%.2x' % ord(c) for c in data)))
+            self.log.debug('TX: [%d] %s', bit8, (' '.join('%.2x' % b for b in bytearray(data))))
 
         if self.supports_spacemark:
             self.ser.parity = (PARITY_MARK if bit8 else PARITY_SPACE)
@@ -84,9 +206,9 @@ class MateNETSerial(object):
             sleep(self.FUDGE_FACTOR)
         else:
             # Emulate SPACE/MARK parity using EVEN/ODD parity
+            parities = EMULATED_PARITY[bit8]
             for b in data:
-                p = self._odd_parity(ord(b)) ^ bit8
-                self.ser.parity = (PARITY_ODD if p else PARITY_EVEN)
+                self.ser.parity = parities[ord(b)]
                 self.ser.write(b)
                 sleep(self.FUDGE_FACTOR)
 
@@ -97,7 +219,46 @@ class MateNETSerial(object):
         The checksum is a simple 16-bit sum over all the bytes in the packet,
         including the 9-bit start-of-packet byte (though the 9th bit is not counted)
         """
-        return sum(ord(c) for c in data) % 0xFFFF
+        return sum(bytearray(data)) % 0xFFFF
+
+    @staticmethod
+    def encode_packet(data):
+        """
+        Append the checksum to a packet
+        :param data: Raw string data (excluding checksum)
+        :return: Raw string data, including checksum
+        """
+        checksum = MateNETSerial._calc_checksum(data)
+        return data + chr((checksum >> 8) & 0xFF) + chr(checksum & 0xFF)
+
+    @staticmethod
+    def encode_packets(packets):
+        """
+        Frame many packets into one buffer, each followed by its checksum.
+        Useful for emulators and for replaying captured traffic.
+        :param packets: iterable of raw string data (excluding checksum)
+        :return: str
+        """
+        return ''.join(MateNETSerial.encode_packet(data) for data in packets)
+
+    @staticmethod
+    def decode_packets(data, lengths):
+        """
+        Split a buffer of framed packets (see encode_packets) back into packets,
+        validating the checksum of each one.
+        :param data: Raw string data
+        :param lengths: iterable of packet lengths (excluding checksum)
+        :return: list of str (excluding checksum)
+        """
+        packets = []
+        offset = 0
+        for n in lengths:
+            end = offset + n + 2
+            if end > len(data):
+                raise RuntimeError("Error decoding mate packets - Buffer too small (%d bytes, expected at least %d)" % (len(data), end))
+            packets.append(MateNETSerial._parse_packet(data[offset:end], n + 2))
+            offset = end
+        return packets
 
     @staticmethod
     def _parse_packet(data, expected_len=None):
@@ -116,14 +277,14 @@ class MateNETSerial(object):
             if len(data) < expected_len:
                 raise RuntimeError("Error receiving mate packet - Received packet too small (%d bytes, expected %d)" % (len(data), expected_len))
             if len(data) > expected_len:
-                RuntimeError("Error receiving mate packet - Received packet too large (%d bytes, expected %d)" % (len(data), expected_len)) 
+                raise RuntimeError("Error receiving mate packet - Received packet too large (%d bytes, expected %d)" % (len(data), expected_len)) 
 
         # Checksum
         packet = data[0:-2]
         expected_chksum = (ord(data[-2]) << 8) | ord(data[-1])
         actual_chksum = MateNETSerial._calc_checksum(packet)
         if actual_chksum != expected_chksum:
-            raise RuntimeError("Error receiving mate packet - Invalid checksum (Expected:%.4x, Actual:%.4x)"
+            raise ChecksumError("Error receiving mate packet - Invalid checksum (Expected:%.4x, Actual:%.4x)"
                                % (expected_chksum, actual_chksum))
         return packet
 
@@ -132,20 +293,26 @@ class MateNETSerial(object):
         Send a packet to the MateNET bus
         :param data: str containing the raw data to send (excluding checksum)
         """
+        packet = self.encode_packet(data)
 
-        checksum = self._calc_checksum(data)
-        footer = chr((checksum >> 8) & 0xFF) + chr(checksum & 0xFF)
+        # Discard anything left over from a previous response
+        # (eg. a response that arrived after recv() timed out)
+        if self.ser.in_waiting:
+            self.log.debug('Discarding %d unexpected bytes', self.ser.in_waiting)
+            self.ser.reset_input_buffer()
 
         # First byte has bit8 set (address byte)
-        self._write_9b(data[0], 1)
+        self._write_9b(packet[0], 1)
 
         # Rest of the bytes have bit8 cleared (data byte)
-        self._write_9b(data[1:] + footer, 0)
+        self._write_9b(packet[1:], 0)
 
-    def recv(self, expected_len=None, timeout=1.0):
+    def recv(self, expected_len=None, timeout=1.0, packet_id=None):
         """
         Receive a packet from the MateNET bus, waiting if necessary
+        :param expected_len: Expected length of the packet (excluding checksum), or None if unknown
         :param timeout: seconds to wait until returning, 0 to return immediately, None to block indefinitely
+        :param packet_id: Ignored, the MateNET bus only has one packet in flight at a time
         :return: str if packet received, None if timeout
         """
         # Wait for packet
@@ -154,21 +321,135 @@ class MateNETSerial(object):
         rawdata = self.ser.read(1)
         if not rawdata:
             return None
+        self.rx_first_time = self.rx_last_time = monotonic()
+
+        if expected_len is not None:
+            expected_len += 2 # Account for checksum
+
+        if expected_len is not None and self.EARLY_COMPLETION:
+            # We know how big the packet is, so read exactly that many bytes
+            # and return as soon as the last one arrives.
+            # Allow for the wire time of the remaining bytes, plus some slack.
+            remaining = expected_len - len(rawdata)
+            if remaining > 0:
+                self.ser.timeout = (remaining * self.BYTE_TIME) + self.END_OF_PACKET_TIMEOUT
+                rawdata += self.ser.read(remaining)
+                self.rx_last_time = monotonic()
+
+            # A stray byte before the packet (eg. line noise) shifts everything along,
+            # so keep reading until the last expected_len bytes have a valid checksum,
+            # or the bus goes idle.
+            if len(rawdata) == expected_len and not self._checksum_ok(rawdata):
+                self.ser.timeout = self.END_OF_PACKET_TIMEOUT
+                while not self._checksum_ok(rawdata[-expected_len:]):
+                    b = self.ser.read()
+                    if not b:
+                        break
+                    rawdata += b
+                    self.rx_last_time = monotonic()
 
-        # Get rest of packet (timeout set to ~10ms to detect end of packet)
+            # Anything straight after the packet means it was larger than expected.
+            # Read the rest of it, so _finish_packet() rejects it (rather than it being
+            # mistaken for part of the next response).
+            self.ser.timeout = 2 * self.BYTE_TIME
+            b = self.ser.read()
+            if b:
+                rawdata = self._read_until_idle(rawdata + b)
+        else:
+            # Get rest of packet (timeout set to ~10ms to detect end of packet)
+            rawdata = self._read_until_idle(rawdata)
+
+        return self._finish_packet(rawdata, expected_len)
+
+    def _read_until_idle(self, rawdata):
+        """
+        Keep reading until there has been no communication for END_OF_PACKET_TIMEOUT
+        :param rawdata: The data received so far
+        :return: str
+        """
         self.ser.timeout = self.END_OF_PACKET_TIMEOUT
         b = 1
         while b:
             b = self.ser.read()
-            rawdata += b
-
-        if self.log.isEnabledFor(logging.DEBUG):
-            self.log.debug('RX: %s', (' '.join('%.2x' % ord(c) for c in rawdata)))
+            if b:
+                rawdata += b
+                self.rx_last_time = monotonic()
+        return rawdata
 
-        if expected_len is not None:
-            expected_len += 2 # Account for checksum
+    @staticmethod
+    def _checksum_ok(data):
+        """
+        :param data: Raw string data, including checksum
+        :return: True if the checksum matches
+        """
+        if len(data) < 3:
+            return False
+        return MateNETSerial._calc_checksum(data[:-2]) == ((ord(data[-2]) << 8) | ord(data[-1]))
 
-            if self.TRIM_LARGE_PACKETS and (len(rawdata) > expected_len):
+    def _finish_packet(self, rawdata, expected_len):
+        """
+        Validate a received packet
+        :param rawdata: Raw string data, including checksum
+        :param expected_len: Expected length of the packet (including checksum), or None if unknown
+        :return: str (excluding checksum)
+        """
+        if (expected_len is not None) and (len(rawdata) > expected_len):
+            # Discard anything before the start of the packet, as long as what's left is a valid packet.
+            # (or unconditionally, with TRIM_LARGE_PACKETS)
+            if self.TRIM_LARGE_PACKETS or self._checksum_ok(rawdata[-expected_len:]):
+                self.log.debug('Discarding %d bytes before the packet', len(rawdata) - expected_len)
                 rawdata = rawdata[-expected_len:]
 
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('RX: %s', (' '.join('%.2x' % b for b in bytearray(rawdata))))
+
         return MateNETSerial._parse_packet(rawdata, expected_len)
+
+### Non-blocking interface (see eventloop.py) ###
+
+    def fileno(self):
+        """
+        :return: File descriptor of the serial port, for use with select()
+        """
+        return self.ser.fileno()
+
+    def read_nonblocking(self):
+        """
+        :return: Any data that has already been received (str, may be empty)
+        """
+        n = self.ser.in_waiting
+        if not n:
+            return ''
+        return self.ser.read(n)
+
+    def recv_start(self, expected_len=None, packet_id=None):
+        """
+        Prepare to receive a packet with recv_feed()
+        :param expected_len: Expected length of the packet (excluding checksum), or None if unknown
+        :param packet_id: Ignored (see recv())
+        """
+        self.rx_data = ''
+        self.rx_expected_len = None if expected_len is None else (expected_len + 2)
+
+    def recv_feed(self, data):
+        """
+        Add received data to the packet started by recv_start()
+        :param data: str
+        :return: str if the packet is complete (see recv()), None if more data is needed
+        """
+        self.rx_data += data
+        if (self.rx_expected_len is not None) and self.EARLY_COMPLETION:
+            # Complete once the last expected_len bytes are a valid packet (see recv()),
+            # otherwise wait for the bus to go idle (recv_end())
+            if len(self.rx_data) >= self.rx_expected_len and self._checksum_ok(self.rx_data[-self.rx_expected_len:]):
+                return self._finish_packet(self.rx_data, self.rx_expected_len)
+        return None
+
+    def recv_end(self):
+        """
+        Called when there has been no communication for END_OF_PACKET_TIMEOUT
+        :return: str if a packet was received (see recv()), None if nothing was received
+        """
+        if not self.rx_data:
+            return None
+        return self._finish_packet(self.rx_data, self.rx_expected_len)
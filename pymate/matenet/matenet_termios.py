@@ -0,0 +1,299 @@
+# pyMATE serial interface (native 9-bit, Linux only)
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Linux serial drivers support "sticky" parity (CMSPAR), where the parity bit
+# is always 1 (mark) or always 0 (space). This lets us drive the 9th bit directly,
+# instead of switching between even/odd parity for every byte.
+#
+# The 9th bit of received bytes is recovered using PARMRK:
+# the port is left in space parity, so any byte with the 9th bit set
+# (ie. the start of a packet) is reported as a parity error, and the kernel
+# inserts a '\xFF\x00' marker before it. A literal 0xFF is escaped as '\xFF\xFF'.
+#
+# pyserial is only used to open the port and set the baud rate.
+# All other termios settings are managed here, since pyserial will clear
+# CMSPAR/PARMRK whenever it reconfigures the port (eg. when changing the timeout or parity).
+# If that happens anyway, the settings are restored before the next packet is sent.
+#
+
+__author__ = 'Jared'
+
+from serial import Serial, PARITY_NONE
+from matenet_ser import MateNETSerial
+from pymate.util import monotonic
+import termios
+import select
+import os
+import logging
+
+# Not exposed by the termios module on older versions of Python
+CMSPAR = getattr(termios, 'CMSPAR', 0o10000000000)
+
+BIT8 = 0x100
+
+
+class MateNETTermios(MateNETSerial):
+    """
+    Interface for the MATE RJ45 bus ("MateNET"),
+    using native mark/space parity (Linux only)
+
+    Usage:
+    port = MateNETTermios('/dev/ttyUSB0')
+    bus = MateNET(port)
+    """
+    def __init__(self, comport):
+        """
+        :param comport: The hardware serial port to use (eg. /dev/ttyUSB0)
+        """
+        if not isinstance(comport, Serial):
+            comport = Serial(comport, 9600, parity=PARITY_NONE)
+
+        # No per-byte delay is needed, so there is nothing to calibrate (see calibrate())
+        super(MateNETTermios, self).__init__(comport, supports_spacemark=True, calibration_file=None)
+
+        self.log = logging.getLogger('mate.termios')
+
+        self.fd = self.ser.fileno()
+        self.rx_raw = ''      # Raw bytes that haven't been decoded yet (incomplete PARMRK sequence)
+        self.rx_symbols = []  # Decoded 9-bit symbols that haven't been consumed yet
+
+        iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(self.fd)
+
+        # Sticky parity, starting with space (bit8 cleared)
+        cflag |= termios.PARENB | CMSPAR
+        cflag &= ~termios.PARODD
+
+        # Report parity errors inline, so we can recover the 9th bit
+        iflag |= termios.INPCK | termios.PARMRK
+        iflag &= ~(termios.IGNPAR | termios.ISTRIP)
+
+        self.attrs = [iflag, oflag, cflag, lflag, ispeed, ospeed, cc]
+        termios.tcsetattr(self.fd, termios.TCSANOW, self.attrs)
+        self.bit8 = 0
+
+    def calibrate(self, *args, **kwargs):
+        """
+        Not supported: the 9th bit is driven directly, so there is no per-byte delay to measure.
+        (MateNETSerial.calibrate() would also clear CMSPAR by changing the parity through pyserial)
+        """
+        raise RuntimeError("MateNETTermios uses native mark/space parity, and does not need calibrating")
+
+    def _check_attrs(self):
+        """
+        Restore the termios settings if pyserial has reconfigured the port
+        (eg. because ser.parity or ser.timeout was changed), which clears CMSPAR/PARMRK
+        """
+        iflag, _, cflag = termios.tcgetattr(self.fd)[:3]
+        if (cflag & (termios.PARENB | CMSPAR)) == (termios.PARENB | CMSPAR) and (iflag & termios.PARMRK):
+            return
+        self.log.warning('Serial port was reconfigured, restoring mark/space parity')
+        termios.tcsetattr(self.fd, termios.TCSANOW, self.attrs)
+        self.bit8 = 0
+
+    def _set_bit8(self, bit8):
+        """
+        Switch between mark (bit8 set) and space (bit8 cleared) parity
+        """
+        if bit8 == self.bit8:
+            return
+        attrs = list(self.attrs)
+        if bit8:
+            attrs[2] |= termios.PARODD
+        else:
+            attrs[2] &= ~termios.PARODD
+        termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+        self.bit8 = bit8
+
+    def _write_9b(self, data, bit8):
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('TX: [%d] %s', bit8, (' '.join('%.2x' % ord(c) for c in data)))
+
+        self._set_bit8(bit8)
+        while data:
+            n = os.write(self.fd, data)
+            data = data[n:]
+
+        # Wait for the data to be transmitted before the parity can be changed
+        termios.tcdrain(self.fd)
+
+    def _decode(self, data):
+        """
+        Decode a stream of PARMRK-escaped bytes into 9-bit symbols.
+        Any incomplete escape sequence at the end of the stream is held until more data arrives.
+        :param data: Raw bytes read from the port (str)
+        :return: list of int (bit8 is set for bytes received with a parity error)
+        """
+        data = self.rx_raw + data
+        symbols = []
+        n = len(data)
+        i = 0
+        while i < n:
+            j = data.find('\xFF', i)
+            if j < 0:
+                symbols.extend(bytearray(data[i:]))
+                i = n
+                break
+            symbols.extend(bytearray(data[i:j]))
+            i = j
+
+            if i+1 >= n:
+                break  # Incomplete escape sequence
+            c = data[i+1]
+            if c == '\xFF':
+                # Escaped 0xFF
+                symbols.append(0xFF)
+                i += 2
+            elif c == '\x00':
+                # Byte received with the 9th bit set
+                if i+2 >= n:
+                    break  # Incomplete escape sequence
+                symbols.append(BIT8 | ord(data[i+2]))
+                i += 3
+            else:
+                # Not a valid escape sequence, treat as a literal
+                symbols.append(0xFF)
+                i += 1
+
+        self.rx_raw = data[i:]
+        return symbols
+
+    def _read_symbols(self, timeout):
+        """
+        Wait for data to arrive and decode it
+        :param timeout: seconds to wait, None to block indefinitely
+        :return: True if any data was received
+        """
+        if timeout is not None and timeout < 0:
+            timeout = 0
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return False
+        data = os.read(self.fd, 256)
+        if not data:
+            return False
+        self.rx_symbols.extend(self._decode(data))
+        return True
+
+    def send(self, data):
+        """
+        Send a packet to the MateNET bus
+        :param data: str containing the raw data to send (excluding checksum)
+        """
+        # Discard anything left over from a previous response
+        self.rx_raw = ''
+        self.rx_symbols = []
+
+        self._check_attrs()
+
+        super(MateNETTermios, self).send(data)
+
+    def recv(self, expected_len=None, timeout=1.0, packet_id=None):
+        """
+        Receive a packet from the MateNET bus, waiting if necessary
+        :param expected_len: Expected length of the packet (excluding checksum), or None if unknown
+        :param timeout: seconds to wait until returning, 0 to return immediately, None to block indefinitely
+        :param packet_id: Ignored, the MateNET bus only has one packet in flight at a time
+        :return: str if packet received, None if timeout
+        """
+        if expected_len is not None:
+            expected_len += 2 # Account for checksum
+
+        if timeout is not None:
+            t_end = monotonic() + timeout
+
+        # Wait for start of packet (9th bit set), discarding anything else
+        while True:
+            i = 0
+            while i < len(self.rx_symbols) and not (self.rx_symbols[i] & BIT8):
+                i += 1
+            del self.rx_symbols[:i]
+            if self.rx_symbols:
+                break
+
+            remaining = None if timeout is None else (t_end - monotonic())
+            if not self._read_symbols(remaining):
+                if remaining is not None and (t_end - monotonic()) <= 0:
+                    return None
+
+        packet = [self.rx_symbols.pop(0) & 0xFF]
+        self.rx_first_time = self.rx_last_time = monotonic()
+
+        # Read the rest of the packet, which ends when:
+        # - the expected number of bytes has arrived,
+        # - the start of another packet is seen, or
+        # - there is no more communication for END_OF_PACKET_TIMEOUT
+        while (expected_len is None) or (len(packet) < expected_len):
+            if not self.rx_symbols:
+                if not self._read_symbols(self.END_OF_PACKET_TIMEOUT):
+                    break
+                continue
+
+            b = self.rx_symbols[0]
+            if b & BIT8:
+                break
+            packet.append(b)
+            del self.rx_symbols[0]
+            self.rx_last_time = monotonic()
+
+        rawdata = ''.join(chr(b) for b in packet)
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('RX: %s', (' '.join('%.2x' % b for b in packet)))
+
+        return MateNETSerial._parse_packet(rawdata, expected_len)
+
+### Non-blocking interface (see eventloop.py) ###
+
+    def read_nonblocking(self):
+        """
+        :return: Any data that has already been received (str, may be empty)
+        """
+        r, _, _ = select.select([self.fd], [], [], 0)
+        if not r:
+            return ''
+        return os.read(self.fd, 256)
+
+    def recv_start(self, expected_len=None, packet_id=None):
+        """
+        Prepare to receive a packet with recv_feed()
+        :param expected_len: Expected length of the packet (excluding checksum), or None if unknown
+        :param packet_id: Ignored (see recv())
+        """
+        self.rx_packet = None
+        self.rx_expected_len = None if expected_len is None else (expected_len + 2)
+
+    def recv_feed(self, data):
+        """
+        Add received data to the packet started by recv_start()
+        :param data: str
+        :return: str if the packet is complete (see recv()), None if more data is needed
+        """
+        for b in self._decode(data):
+            if b & BIT8:
+                if self.rx_packet:
+                    # Start of the next packet, so this one is complete
+                    return self.recv_end()
+                self.rx_packet = []
+
+            if self.rx_packet is None:
+                continue  # Waiting for start of packet
+
+            self.rx_packet.append(b & 0xFF)
+            if (self.rx_expected_len is not None) and (len(self.rx_packet) >= self.rx_expected_len):
+                return self.recv_end()
+        return None
+
+    def recv_end(self):
+        """
+        Called when there has been no communication for END_OF_PACKET_TIMEOUT
+        :return: str if a packet was received (see recv()), None if nothing was received
+        """
+        packet, self.rx_packet = self.rx_packet, None
+        if not packet:
+            return None
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('RX: %s', (' '.join('%.2x' % b for b in packet)))
+
+        rawdata = ''.join(chr(b) for b in packet)
+        return MateNETSerial._parse_packet(rawdata, self.rx_expected_len)
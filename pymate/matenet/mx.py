@@ -9,9 +9,12 @@ __author__ = 'Jared'
 from struct import Struct
 from pymate.value import Value
 from . import MateDevice, MateNET
+from regcache import CACHE_STATIC, CACHE_SLOW
+from registers import Register
+from packet import StatusPacket, field, value_field, int_field
 
 
-class MXStatusPacket(object):
+class MXStatusPacket(StatusPacket):
     fmt = Struct('>BbbbBBBBBHH')
     size = fmt.size
 
@@ -33,42 +36,42 @@ class MXStatusPacket(object):
     AUX_MODE_LOW_BATTERY = 3
     AUX_MODE_MANUAL = 0x3F  # If Aux is not configured for Auto on MX unit.
 
-    def __init__(self):
-        self.amp_hours = None
-        self.kilowatt_hours = None
-        self.pv_current = None
-        self.bat_current = None
-        self.pv_voltage = None
-        self.bat_voltage = None
-        self.status = None
-        self.errors = None
-        self.aux_state = None
-        self.aux_mode = None
-        self.raw = None
-
-    @classmethod
-    def from_buffer(cls, data):
-        values = cls.fmt.unpack(data)
-        status = MXStatusPacket()
-        # The following was determined by poking values at the MATE unit...
+    # The following was determined by poking values at the MATE unit...
+
+    @field
+    def amp_hours(self):
+        values = self.values
         raw_ah = ((values[0] & 0x70) >> 4) | values[4] # Ignore bit7 (if 0, MATE hides the AH reading)
+        return Value(raw_ah, units='Ah', resolution=0)
+
+    @field
+    def pv_current(self):
+        return Value((128 + self.values[1]) % 256, units='A', resolution=0)
+
+    @field
+    def bat_current(self):
+        values = self.values
         bat_current_milli = (values[0] & 0x0F) / 10.0
-        status.amp_hours = Value(raw_ah, units='Ah', resolution=0)
-        status.pv_current = Value((128 + values[1]) % 256, units='A', resolution=0)
-        status.bat_current = Value(((128 + values[2]) % 256 + bat_current_milli), units='A', resolution=1)
+        return Value(((128 + values[2]) % 256 + bat_current_milli), units='A', resolution=1)
+
+    @field
+    def kilowatt_hours(self):
+        values = self.values
         raw_kwh = (values[3] << 8) | values[8]
-        status.kilowatt_hours = Value(raw_kwh / 10.0, units='kWh', resolution=1)
-        status.aux_state = ((values[5] & 0x40) == 0x40)  # 0: Off, 1: On
-        status.aux_mode = (values[5] & 0x3F)
-        status.status = values[6]
-        status.errors = values[7]
-        status.bat_voltage = Value(values[9] / 10.0, units='V', resolution=1)
-        status.pv_voltage = Value(values[10] / 10.0, units='V', resolution=1)
+        return Value(raw_kwh / 10.0, units='kWh', resolution=1)
+
+    @field
+    def aux_state(self):
+        return ((self.values[5] & 0x40) == 0x40)  # 0: Off, 1: On
 
-        # Also add the raw packet, in case any of the above changes
-        status.raw = data
+    @field
+    def aux_mode(self):
+        return (self.values[5] & 0x3F)
 
-        return status
+    status = int_field(6)
+    errors = int_field(7)
+    bat_voltage = value_field(9, 10.0, units='V', resolution=1)
+    pv_voltage = value_field(10, 10.0, units='V', resolution=1)
 
     def __repr__(self):
         return "<MXStatusPacket>"
@@ -79,58 +82,65 @@ class MXStatusPacket(object):
     Bat: {bat_voltage} {bat_current}
     Today: {kilowatt_hours} {amp_hours}
 """
-        return fmt.format(**self.__dict__)
+        return fmt.format(
+            pv_voltage=self.pv_voltage,
+            pv_current=self.pv_current,
+            bat_voltage=self.bat_voltage,
+            bat_current=self.bat_current,
+            kilowatt_hours=self.kilowatt_hours,
+            amp_hours=self.amp_hours
+        )
 
 
-class MXLogPagePacket(object):
+class MXLogPagePacket(StatusPacket):
     fmt = Struct('>BBBBBBBBBBBBBB')
     size = fmt.size
 
-    def __init__(self):
-        self.day = None
-        self.amp_hours = None
-        self.kilowatt_hours = None
-        self.volts_peak = None
-        self.amps_peak = None
-        self.kilowatts_peak = None
-        self.bat_min = None
-        self.bat_max = None
-        self.absorb_time = None
-        self.float_time = None
-        self.raw = None
-
-    @classmethod
-    def from_buffer(cls, data):
-        values = cls.fmt.unpack(data)
-        page = MXLogPagePacket()
-
-        # Parse the mess of binary values
-        page.bat_max = ((values[1] & 0xFC) >> 2) | ((values[2] & 0x0F) << 6)
-        page.bat_min = ((values[9] & 0xC0) >> 6) | (values[10] << 2) | ((values[11] & 0x03) << 10)
-        page.kilowatt_hours = ((values[2] & 0xF0) >> 4) | (values[3] << 4)
-        page.amp_hours = values[8] | ((values[9] & 0x3F) << 8)
-        page.volts_peak = values[4]
-        page.amps_peak = values[0] | ((values[1] & 0x03) << 8)
-        page.absorb_time = values[5] | ((values[6] & 0x0F) << 8)
-        page.float_time = ((values[6] & 0xF0) >> 4) | (values[7] << 4)
-        page.kilowatts_peak = ((values[12] & 0xFC) >> 2) | (values[11] << 6)
-        page.day = values[13]
-
-        # Convert to human-readable values
-        page.bat_max = Value(page.bat_max / 10.0, units='V', resolution=1)
-        page.bat_min = Value(page.bat_min / 10.0, units='V', resolution=1)
-        page.volts_peak = Value(page.volts_peak, units='Vpk')
-        page.amps_peak = Value(page.amps_peak / 10.0, units='Apk', resolution=1)
-        page.kilowatts_peak = Value(page.kilowatts_peak / 1000.0, units='kWpk', resolution=3)
-        page.amp_hours = Value(page.amp_hours, units='Ah')
-        page.kilowatt_hours = Value(page.kilowatt_hours / 10.0, units='kWh', resolution=1)
-        page.absorb_time = Value(page.absorb_time, units='min')
-        page.float_time = Value(page.float_time, units='min')
-
-        # Also add the raw packet
-        page.raw = data
-
-        return page
+    # Parse the mess of binary values, and convert to human-readable values
+
+    @field
+    def bat_max(self):
+        values = self.values
+        return Value((((values[1] & 0xFC) >> 2) | ((values[2] & 0x0F) << 6)) / 10.0, units='V', resolution=1)
+
+    @field
+    def bat_min(self):
+        values = self.values
+        return Value((((values[9] & 0xC0) >> 6) | (values[10] << 2) | ((values[11] & 0x03) << 10)) / 10.0, units='V', resolution=1)
+
+    @field
+    def kilowatt_hours(self):
+        values = self.values
+        return Value((((values[2] & 0xF0) >> 4) | (values[3] << 4)) / 10.0, units='kWh', resolution=1)
+
+    @field
+    def amp_hours(self):
+        values = self.values
+        return Value(values[8] | ((values[9] & 0x3F) << 8), units='Ah')
+
+    volts_peak = value_field(4, units='Vpk')
+
+    @field
+    def amps_peak(self):
+        values = self.values
+        return Value((values[0] | ((values[1] & 0x03) << 8)) / 10.0, units='Apk', resolution=1)
+
+    @field
+    def absorb_time(self):
+        values = self.values
+        return Value(values[5] | ((values[6] & 0x0F) << 8), units='min')
+
+    @field
+    def float_time(self):
+        values = self.values
+        return Value(((values[6] & 0xF0) >> 4) | (values[7] << 4), units='min')
+
+    @field
+    def kilowatts_peak(self):
+        values = self.values
+        return Value((((values[12] & 0xFC) >> 2) | (values[11] << 6)) / 1000.0, units='kWpk', resolution=3)
+
+    day = int_field(13)
 
     def __str__(self):
         fmt = """MX Log Page:
@@ -140,15 +150,84 @@ class MXLogPagePacket(object):
     Min: {bat_min} Max: {bat_max}
     Absorb: {absorb_time} Float: {float_time}
 """
-        return fmt.format(**self.__dict__)
+        return fmt.format(
+            day=self.day,
+            amp_hours=self.amp_hours,
+            kilowatt_hours=self.kilowatt_hours,
+            volts_peak=self.volts_peak,
+            amps_peak=self.amps_peak,
+            kilowatts_peak=self.kilowatts_peak,
+            bat_min=self.bat_min,
+            bat_max=self.bat_max,
+            absorb_time=self.absorb_time,
+            float_time=self.float_time
+        )
+
+
+def _aux_relay_mode(x):
+    """
+    :return: (mode, on)
+    """
+    mode = x & 0x7F
+    on = (x & 0x80 == 0x80)
+    return mode, on
 
 
 class MateMXDevice(MateDevice):
     DEVICE_TYPE = MateNET.DEVICE_MX
+    STATUS_PAGES = (1,)
 
     """
     Communicate with an MX unit attached to the MateNET bus
     """
+    REGISTERS = (
+        ##### STATUS/CC/METER #####
+        Register('charger_watts',     0x016A, scale=1, units='W'),
+        Register('charger_kwh',       0x01EA, scale=0.1, units='kWh', resolution=1),
+        Register('charger_amps_dc',   0x01C7, scale=1, offset=-128, units='A'),
+        Register('bat_voltage',       0x0008, scale=0.1, units='V', resolution=1),
+        Register('panel_voltage',     0x01C6, scale=1, units='V'),
+
+        ##### STATUS/CC/MODE #####
+        Register('status',            0x01C8),
+        Register('aux_relay_mode',    0x01C9, convert=_aux_relay_mode),
+
+        ##### STATUS/CC/STAT #####
+        Register('max_battery',       0x000F, scale=0.1, units='V', resolution=1, cache=CACHE_SLOW),
+        Register('voc',               0x0010, scale=0.1, resolution=1),
+        Register('max_voc',           0x0012, scale=0.1, resolution=1, cache=CACHE_SLOW),
+        Register('total_kwh_dc',      0x0013, scale=1, units='kWh', cache=CACHE_SLOW),
+        Register('total_kah',         0x0014, scale=1, units='kAh', resolution=1, cache=CACHE_SLOW),
+        Register('max_wattage',       0x0015, scale=1, units='W', cache=CACHE_SLOW),
+
+        ##### STATUS/CC/SETPT #####
+        Register('setpt_absorb',      0x0170, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('setpt_float',       0x0172, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+
+        Register('battery_temp_raw',  0x4000),
+
+        ##### ADV/CC (settings) #####
+        Register('output_current_limit', 0x0017, scale=0.1, units='A', resolution=1, cache=CACHE_STATIC),
+        Register('float_voltage',     0x0018, scale=1, units='V', cache=CACHE_STATIC),
+        Register('absorb_voltage',    0x0019, scale=1, units='V', cache=CACHE_STATIC),
+        Register('eq_voltage',        0x001E, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('eq_time',           0x00D2, scale=1, units='h', cache=CACHE_STATIC),
+        Register('auto_eq_interval',  0x00D3, scale=1, units='days', cache=CACHE_STATIC),
+        Register('aux_mode',          0x00CB, cache=CACHE_STATIC),
+        Register('absorb_end_amps',   0x0020, scale=1, units='A', cache=CACHE_STATIC),
+        Register('snooze_mode',       0x00D4, scale=0.1, units='A', resolution=1, cache=CACHE_STATIC),
+        Register('wakeup_voc_change', 0x0021, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('wakeup_time',       0x0022, scale=1, units='min', cache=CACHE_STATIC),
+        Register('mppt_mode',         0x00D5, cache=CACHE_STATIC),
+        Register('grid_tie_mode',     0x00D6, cache=CACHE_STATIC),
+        Register('park_mpp',          0x0023, scale=0.1, units='%', resolution=1, cache=CACHE_STATIC),
+        Register('absorb_time',       0x00D9, scale=0.1, units='h', resolution=1, cache=CACHE_STATIC),
+        Register('rebulk_voltage',    0x001F, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('rts_compensation',  0x00DB, cache=CACHE_STATIC),
+        Register('rts_comp_upper',    0x0025, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+        Register('rts_comp_lower',    0x0024, scale=0.1, units='V', resolution=1, cache=CACHE_STATIC),
+    )
+
     def scan(self, *args):
         """
         Query the attached device to make sure we're communicating with an MX unit
@@ -168,6 +247,19 @@ class MateMXDevice(MateDevice):
         if resp:
             return MXStatusPacket.from_buffer(resp)
 
+    def get_status_async(self):
+        """
+        Request a status packet from the controller, without waiting for the response
+        :return: A BusFuture, whose result is a MXStatusPacket (or None)
+        """
+        future = self.submit(MateNET.TYPE_STATUS, addr=1, param=0x00, response_len=MXStatusPacket.size)
+        return future.then(lambda resp: self.parse_status([resp]))
+
+    def parse_status(self, pages):
+        resp = pages[0]
+        if resp:
+            return MXStatusPacket.from_buffer(resp)
+
     def get_logpage(self, day):
         """
         Get a log page for the specified day
@@ -178,73 +270,6 @@ class MateMXDevice(MateDevice):
         if resp:
             return MXLogPagePacket.from_buffer(resp)
 
-    @property
-    def charger_watts(self):
-        return Value(self.query(0x016A), units='W', resolution=0)
-
-    @property
-    def charger_kwh(self):
-        return Value(self.query(0x01EA) / 10.0, units='kWh', resolution=1)
-
-    @property
-    def charger_amps_dc(self):
-        return Value(self.query(0x01C7) - 128, units='A', resolution=0)
-
-    @property
-    def bat_voltage(self):
-        return Value(self.query(0x0008) / 10.0, units='V', resolution=1)
-
-    @property
-    def panel_voltage(self):
-        return Value(self.query(0x01C6), units='V', resolution=0)
-
-    @property
-    def status(self):
-        return self.query(0x01C8)
-
-    @property
-    def aux_relay_mode(self):
-        x = self.query(0x01C9)
-        mode = x & 0x7F
-        on = (x & 0x80 == 0x80)
-        return mode, on
-
-    @property
-    def max_battery(self):
-        return Value(self.query(0x000F) / 10.0, units='V', resolution=1)
-
-    @property
-    def voc(self):
-        return Value(self.query(0x0010) / 10.0, resolution=1)
-
-    @property
-    def max_voc(self):
-        return Value(self.query(0x0012) / 10.0, resolution=1)
-
-    @property
-    def total_kwh_dc(self):
-        return Value(self.query(0x0013), units='kWh', resolution=0)
-
-    @property
-    def total_kah(self):
-        return Value(self.query(0x0014), units='kAh', resolution=1)
-
-    @property
-    def max_wattage(self):
-        return Value(self.query(0x0015), units='W', resolution=0)
-
-    @property
-    def setpt_absorb(self):
-        return Value(self.query(0x0170) / 10.0, units='V', resolution=1)
-
-    @property
-    def setpt_float(self):
-        return Value(self.query(0x0172) / 10.0, units='V', resolution=1)
-
-    @property
-    def battery_temp_raw(self):
-        return self.query(0x4000)
-
     @staticmethod
     def convert_battery_temp(raw_temp):
         return Value((-0.3576 * raw_temp) + 70.1, units='C', resolution=0)
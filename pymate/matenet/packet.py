@@ -0,0 +1,177 @@
+# pyMATE status packets
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Base class for the packets returned by the devices (status, log pages).
+#
+# A packet only unpacks its raw buffer when it is created. Each field is decoded
+# the first time it is accessed, and cached in a slot, so reading a few fields
+# (or only .raw / .raw_view) doesn't pay for building a Value for every field.
+#
+# Usage:
+#   class MyPacket(StatusPacket):
+#       fmt = Struct('>hB')
+#       size = fmt.size
+#
+#       voltage = value_field(0, 10.0, units='V', resolution=1)
+#       flags = int_field(1)
+#
+#       @field
+#       def charging(self):
+#           return (self.values[1] & 0x01) == 0x01
+#
+
+__author__ = 'Jared'
+
+from pymate.value import Value
+from struct import error as StructError
+
+
+class field(object):
+    """
+    A packet field which is decoded on first access, and then cached.
+    Can be used as a decorator on a method which decodes the field from self.values.
+    The field can also be assigned, which replaces the decoded value.
+    """
+    def __init__(self, decode, doc=None):
+        self.decode = decode
+        self.name = None
+        self.index = None   # Index of the unpacked value, for simple fields (see value_field/int_field)
+        self.divisor = None
+        self.is_int = False
+        self.slot = None  # Member descriptor of the slot that caches the value, see PacketMeta
+        self.__doc__ = doc or decode.__doc__
+
+    def __get__(self, packet, owner):
+        if packet is None:
+            return self
+        try:
+            return self.slot.__get__(packet, owner)
+        except AttributeError:
+            pass  # Not decoded yet
+
+        if packet.values is None:
+            return None  # No data
+        value = self.decode(packet)
+        self.slot.__set__(packet, value)
+        return value
+
+    def __set__(self, packet, value):
+        self.slot.__set__(packet, value)
+
+
+def value_field(index, divisor=None, units=None, resolution=0, doc=None):
+    """
+    A field which is a Value, decoded from a single unpacked value
+    :param index: Index of the value in the unpacked packet
+    :param divisor: The raw value is divided by this (eg. 10.0 for tenths), None to leave it unscaled
+    """
+    if divisor is None:
+        f = field(lambda p: Value(p.values[index], units=units, resolution=resolution), doc)
+    else:
+        f = field(lambda p: Value(p.values[index] / divisor, units=units, resolution=resolution), doc)
+    f.index = index
+    f.divisor = divisor
+    return f
+
+
+def int_field(index, doc=None):
+    """
+    A field which is a raw unpacked value (eg. an enum or bit-field)
+    """
+    f = field(lambda p: p.values[index], doc)
+    f.index = index
+    f.is_int = True
+    return f
+
+
+class PacketMeta(type):
+    """
+    Metaclass for StatusPacket, which adds a slot to cache each field
+    """
+    def __new__(mcs, name, bases, attrs):
+        fields = dict((key, value) for key, value in attrs.items() if isinstance(value, field))
+        attrs['__slots__'] = tuple(attrs.get('__slots__', ())) + tuple('_' + key for key in fields)
+
+        cls = super(PacketMeta, mcs).__new__(mcs, name, bases, attrs)
+        for key, f in fields.items():
+            f.name = key
+            f.slot = cls.__dict__['_' + key]
+
+        all_fields = {}
+        for base in reversed(cls.__mro__[1:]):
+            all_fields.update(getattr(base, 'FIELDS', {}))
+        all_fields.update(fields)
+        cls.FIELDS = all_fields  # {name: field}
+        return cls
+
+
+class StatusPacket(object):
+    """
+    A packet received from a device, which is decoded on demand
+    """
+    __metaclass__ = PacketMeta
+    __slots__ = ('buffer', 'offset', 'values')
+
+    fmt = None  # struct.Struct describing the raw packet
+    size = 0
+
+    def __init__(self, data=None, offset=0):
+        """
+        :param data: The raw packet (str, bytearray or memoryview), or None to create an empty packet
+        :param offset: Where the packet starts within data.
+            If 0, data must be exactly the size of the packet.
+        """
+        if data is not None and offset == 0 and len(data) != self.fmt.size:
+            raise StructError("unpack requires a string argument of length %d" % self.fmt.size)
+        self._decode(data, offset)
+
+    def _decode(self, data, offset):
+        # The values are unpacked in place, without copying the packet out of the buffer
+        self.buffer = data
+        self.offset = offset
+        self.values = None if data is None else self.fmt.unpack_from(data, offset)
+
+    @property
+    def raw(self):
+        """
+        The raw packet (str), which is only copied out of the buffer it was decoded from if needed
+        """
+        data = self.buffer
+        if data is None:
+            return None
+        if isinstance(data, str):
+            if self.offset == 0 and len(data) == self.fmt.size:
+                return data
+            return data[self.offset:self.offset+self.fmt.size]
+        return self.raw_view.tobytes()
+
+    @property
+    def raw_view(self):
+        """
+        The raw packet as a memoryview of the buffer it was decoded from, without copying it.
+        Only valid until the buffer is reused.
+        """
+        data = self.buffer
+        if data is None:
+            return None
+        return memoryview(data)[self.offset:self.offset+self.fmt.size]
+
+    @classmethod
+    def from_buffer(cls, data, offset=0):
+        return cls(data, offset)
+
+    @classmethod
+    def iter_from_buffer(cls, data, offset=0):
+        """
+        Decode a buffer containing several packets, one after the other (eg. for replaying stored packets).
+        Each packet is decoded in place, and refers back to the buffer.
+        :return: iterator of packets
+        """
+        size = cls.fmt.size
+        if (len(data) - offset) % size != 0:
+            raise RuntimeError("Error decoding packets - buffer length (%d bytes) is not a multiple of the packet size (%d bytes)"
+                               % (len(data) - offset, size))
+        for i in xrange(offset, len(data), size):
+            packet = cls.__new__(cls)
+            packet._decode(data, i)
+            yield packet
@@ -0,0 +1,105 @@
+# pyMATE register cache
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Many registers (setpoints, lifetime totals, firmware revisions) rarely change,
+# but reading them still costs a full bus transaction.
+# Each register is assigned a cache class, which determines how long its value is reused:
+#
+#   CACHE_STATIC - Configuration/identity, only changes when written (TTL['static'])
+#   CACHE_SLOW   - Totals and daily min/max values (TTL['slow'])
+#   CACHE_LIVE   - Measurements. Only reused within a poll cycle (see poll_cycle())
+#
+# Any control packet sent to a register (write, increment or decrement) invalidates it.
+#
+
+__author__ = 'Jared'
+
+from pymate.util import monotonic
+from contextlib import contextmanager
+
+CACHE_STATIC = 'static'
+CACHE_SLOW   = 'slow'
+CACHE_LIVE   = 'live'
+
+
+class RegisterCache(object):
+    """
+    Cache of register values, keyed by (port, register)
+
+    Usage:
+    with bus.cache.poll_cycle():
+        v = mx.bat_voltage   # Read from the bus
+        v = mx.bat_voltage   # Reused
+    """
+    def __init__(self):
+        # Maximum age of a cached value (seconds) for each cache class
+        self.TTL = {
+            CACHE_STATIC: 3600.0,
+            CACHE_SLOW:   60.0,
+            CACHE_LIVE:   0.0,
+        }
+
+        self.entries = {}  # {(port, reg): (value, timestamp, cycle)}
+        self.cycle = 0     # Incremented at the start of every poll cycle
+        self.depth = 0     # >0 while inside a poll cycle
+
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def poll_cycle(self):
+        """
+        Any live register read more than once within the cycle is only read from the bus once.
+        Cycles can be nested, in which case the outermost cycle applies.
+        """
+        if self.depth == 0:
+            self.cycle += 1
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+
+    def get(self, port, reg, cache_class=CACHE_LIVE):
+        """
+        :return: The cached value of a register, or None if it has not been read or has expired
+        """
+        entry = self.entries.get((port, reg))
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, timestamp, cycle = entry
+        if self.depth and cycle == self.cycle:
+            # Already read during this poll cycle
+            self.hits += 1
+            return value
+
+        ttl = self.TTL.get(cache_class, 0.0)
+        if ttl and (monotonic() - timestamp) < ttl:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        return None
+
+    def put(self, port, reg, value):
+        """
+        Store a value that has just been read from the bus
+        """
+        if value is None:
+            return
+        self.entries[(port, reg)] = (value, monotonic(), self.cycle if self.depth else None)
+
+    def invalidate(self, port=None, reg=None):
+        """
+        Discard cached values
+        :param port: The port to invalidate, or None for all ports
+        :param reg: The register to invalidate, or None for all registers
+        """
+        if port is None and reg is None:
+            self.entries.clear()
+            return
+        for key in list(self.entries):
+            if (port is None or key[0] == port) and (reg is None or key[1] == reg):
+                self.entries.pop(key, None)
@@ -0,0 +1,121 @@
+# pyMATE registers
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Declarative register definitions.
+#
+# Each device class lists its registers in REGISTERS, and a property is generated
+# for each one (unless the class already defines a property with the same name).
+# The same table provides the cache class of each register (see regcache.py),
+# and is used for batch reads (MateDevice.read_registers()) and by the emulators (tester.py).
+#
+# See doc/protocol/*Registers.md
+#
+
+__author__ = 'Jared'
+
+from pymate.value import Value
+from regcache import CACHE_LIVE
+
+
+class Register(object):
+    """
+    Definition of a 16-bit device register, which also acts as a property on the device
+    """
+    def __init__(self, name, addr, scale=None, offset=0, signed=False, units=None, resolution=0,
+                 scale_230v=None, cache=CACHE_LIVE, writable=False, convert=None, doc=None):
+        """
+        :param name: Name of the generated property
+        :param addr: Register address
+        :param scale: Multiplier applied to the raw value (eg. 0.1 for tenths),
+            or None to return the raw integer (enums, bit-fields)
+        :param offset: Added to the scaled value
+        :param signed: True if the raw value is a signed 16-bit integer
+        :param units: Units of the value
+        :param resolution: Number of decimal places of the value
+        :param scale_230v: Additional multiplier applied if the device is a 230V model (FX)
+        :param cache: Cache class, see regcache.py
+        :param writable: True to allow setting the (raw) value through the property
+        :param convert: Function which decodes the raw value instead of scaling it (eg. to split a bit-field)
+        :param doc: Docstring for the property
+        """
+        self.name = name
+        self.addr = addr
+        self.scale = scale
+        self.offset = offset
+        self.signed = signed
+        self.units = units
+        self.resolution = resolution
+        self.scale_230v = scale_230v
+        self.cache = cache
+        self.writable = writable
+        self.convert = convert
+        self.__doc__ = doc
+
+        # Divide rather than multiply, so decimal scales are exact (eg. 123/10.0 == 12.3)
+        self._divisor = (1.0 / scale) if scale not in (None, 1) else None
+
+    def decode(self, raw, is_230v=False):
+        """
+        Convert a raw register value
+        :param raw: The raw 16-bit value (int), or None
+        :param is_230v: True if the device is a 230V model
+        :return: Value (or int if the register is not scaled, or the result of convert), None if raw is None
+        """
+        if raw is None:
+            return None
+        if self.signed and raw & 0x8000:
+            raw -= 0x10000
+        if self.convert is not None:
+            return self.convert(raw)
+        if self.scale is None:
+            return raw
+
+        x = raw
+        if self._divisor is not None:
+            x = raw / self._divisor
+        if self.offset:
+            x += self.offset
+        if is_230v and self.scale_230v is not None:
+            x *= self.scale_230v
+        return Value(x, units=self.units, resolution=self.resolution)
+
+    def __get__(self, device, owner):
+        if device is None:
+            return self
+        is_230v = (self.scale_230v is not None) and device.is_230v
+        return self.decode(device.query(self.addr), is_230v)
+
+    def __set__(self, device, value):
+        if not self.writable:
+            raise AttributeError("Register %s is read-only" % self.name)
+        device.control(self.addr, value)
+
+    def __repr__(self):
+        return 'Register(%s, 0x%.4x)' % (self.name, self.addr)
+
+
+class RegisterMeta(type):
+    """
+    Metaclass for MateDevice, which generates properties from the REGISTERS table
+    and collects the cache class of each register into REGISTER_CACHE
+    """
+    def __init__(cls, name, bases, attrs):
+        super(RegisterMeta, cls).__init__(name, bases, attrs)
+
+        # Inherit registers from the base classes
+        register_map = {}
+        register_cache = {}
+        for base in reversed(cls.__mro__[1:]):
+            register_map.update(getattr(base, 'REGISTER_MAP', {}))
+            register_cache.update(getattr(base, 'REGISTER_CACHE', {}))
+        register_cache.update(attrs.get('REGISTER_CACHE', {}))
+
+        for reg in attrs.get('REGISTERS', ()):
+            register_map[reg.name] = reg
+            register_cache[reg.addr] = reg.cache
+            if reg.name not in attrs:
+                setattr(cls, reg.name, reg)
+
+        cls.REGISTER_MAP = register_map      # {name: Register}
+        cls.REGISTER_CACHE = register_cache  # {addr: cache class}
+        cls.REGISTER_ADDRS = dict((reg.addr, reg) for reg in register_map.values())  # {addr: Register}
@@ -0,0 +1,157 @@
+# pyMATE snapshot polling
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Fetches the status of several devices back to back, so their readings can be
+# compared with each other (eg. FX load against FLEXnet DC battery power).
+# Each device's readings are timestamped with a monotonic clock,
+# so the skew between devices can be measured.
+#
+# Usage:
+#   snapshot = poll_snapshot([mx, fx, dc])
+#   print snapshot.skew
+#   mx_status = snapshot[mx]
+#
+
+__author__ = 'Jared'
+
+from pymate.util import monotonic
+from arbiter import PRIORITY_STATUS
+from datetime import datetime, timedelta
+import logging
+
+log = logging.getLogger('mate.snapshot')
+
+
+class DeviceSample(object):
+    """
+    The status of a single device within a Snapshot
+    """
+    def __init__(self, device):
+        self.device = device
+        self.status = None  # Decoded status packet, or None if the device didn't respond
+        self.pages = None   # Raw responses to the device's status requests
+        self.raw = None     # Raw status data (str)
+        self.error = None   # Exception raised while polling the device, if any
+        self.t_start = None # Monotonic time the first request was sent
+        self.t_end = None   # Monotonic time the last response was received
+
+    @property
+    def t_mid(self):
+        return (self.t_start + self.t_end) / 2.0
+
+    def __repr__(self):
+        return 'DeviceSample(%s@%d, %.1fms)' % (
+            type(self.device).__name__, self.device.port, (self.t_end - self.t_start) * 1000.0)
+
+
+class Snapshot(object):
+    """
+    The status of several devices, collected in one bus window
+    """
+    def __init__(self):
+        self.samples = []
+        self.timestamp = None  # Wall-clock time (UTC) of t_start
+        self.t_start = None    # Monotonic time the snapshot started
+        self.t_end = None      # Monotonic time the snapshot finished
+
+    @property
+    def duration(self):
+        """
+        :return: Total time taken to collect the snapshot (seconds)
+        """
+        return self.t_end - self.t_start
+
+    @property
+    def skew(self):
+        """
+        :return: Time between the first and last device's readings (seconds),
+            measured between the middle of each device's bus transactions
+        """
+        mids = [sample.t_mid for sample in self.samples]
+        if not mids:
+            return 0.0
+        return max(mids) - min(mids)
+
+    def wall_time(self, sample):
+        """
+        :return: Wall-clock time (UTC) of a sample
+        """
+        return self.timestamp + timedelta(seconds=(sample.t_mid - self.t_start))
+
+    def __getitem__(self, device):
+        """
+        :return: The status of the specified device, or None
+        """
+        for sample in self.samples:
+            if sample.device is device:
+                return sample.status
+        raise KeyError(device)
+
+    def __iter__(self):
+        return iter(self.samples)
+
+    def __repr__(self):
+        return 'Snapshot(%d devices, duration=%.1fms, skew=%.1fms)' % (
+            len(self.samples), self.duration * 1000.0, self.skew * 1000.0)
+
+
+def _poll_bus(samples):
+    """
+    Fetch the status pages for devices on a single bus, back to back
+    """
+    for sample in samples:
+        device = sample.device
+        sample.t_start = monotonic()
+        try:
+            sample.pages = device.matenet.send_many(device.status_requests())
+        except Exception as e:
+            sample.pages = None
+            sample.error = e
+        sample.t_end = monotonic()
+
+
+def poll_snapshot(devices):
+    """
+    Collect the status of several devices in the shortest possible bus window.
+    All status pages are requested back to back, and decoded afterwards.
+    A device that fails does not affect the others.
+    :param devices: list of MateDevice (MX, FX, DC)
+    :return: Snapshot
+    """
+    snapshot = Snapshot()
+    snapshot.samples = [DeviceSample(device) for device in devices]
+
+    # Group devices by bus, keeping the requested order
+    buses = []
+    for sample in snapshot.samples:
+        for bus, group in buses:
+            if bus is sample.device.matenet:
+                group.append(sample)
+                break
+        else:
+            buses.append((sample.device.matenet, [sample]))
+
+    snapshot.timestamp = datetime.utcnow()
+    snapshot.t_start = monotonic()
+    for bus, group in buses:
+        arbiter = getattr(bus, 'arbiter', None)
+        if arbiter is not None and not arbiter.is_owner():
+            # Make sure nothing else uses the bus during the snapshot
+            arbiter.submit(_poll_bus, (group,), priority=PRIORITY_STATUS).result()
+        else:
+            _poll_bus(group)
+    snapshot.t_end = monotonic()
+
+    # Decode outside of the bus window
+    for sample in snapshot.samples:
+        if not sample.pages:
+            continue
+        try:
+            sample.status = sample.device.parse_status(sample.pages)
+            if sample.status is not None:
+                sample.raw = ''.join(sample.pages)
+        except Exception as e:
+            log.warning('Error decoding status from %r: %s', sample, e)
+            sample.error = e
+
+    return snapshot
@@ -0,0 +1,166 @@
+# pyMATE bus statistics
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Counts transactions, retries and errors on the bus, and records a histogram of
+# response latencies, for each (port, packet type).
+# Use this to spot a hub port that is degrading, or to tune timeouts from measured data.
+#
+# Usage:
+#   s = bus.stats.get(port=1, ptype=MateNET.TYPE_STATUS)
+#   print s.transactions, s.retries, s.timeouts, s.mean_latency
+#
+#   # Prometheus text exposition format, eg. for a /metrics endpoint
+#   print bus.stats.to_prometheus()
+#
+
+__author__ = 'Jared'
+
+from errors import ChecksumError, InvalidCommandError
+from bisect import bisect_left
+
+# Upper bounds of the latency histogram buckets (seconds).
+# Devices usually respond within a few milliseconds, the last buckets catch slow hubs and timeouts.
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+# Counters, and the description of each one (see PortStats)
+COUNTERS = (
+    ('transactions',     'Transactions completed (with or without a response)'),
+    ('retries',          'Packets re-sent after a failed attempt'),
+    ('timeouts',         'Attempts that received no response'),
+    ('checksum_errors',  'Responses with an invalid checksum'),
+    ('invalid_commands', 'Responses rejecting the command as invalid'),
+    ('errors',           'Attempts that failed for any other reason'),
+    ('tx_bytes',         'Bytes sent, including checksums'),
+    ('rx_bytes',         'Bytes received, including checksums'),
+)
+
+
+class PortStats(object):
+    """
+    Statistics for one (port, packet type)
+    """
+    __slots__ = tuple(name for name, _ in COUNTERS) + ('port', 'ptype', 'buckets', 'latency_sum', 'latency_count')
+
+    def __init__(self, port, ptype):
+        self.port = port
+        self.ptype = ptype
+        for name, _ in COUNTERS:
+            setattr(self, name, 0)
+
+        # Latency histogram, buckets[i] counts responses within LATENCY_BUCKETS[i]
+        # (the last entry counts anything slower)
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+    def add_latency(self, latency):
+        self.buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+        self.latency_count += 1
+
+    @property
+    def mean_latency(self):
+        return (self.latency_sum / self.latency_count) if self.latency_count else None
+
+    def to_dict(self):
+        d = dict((name, getattr(self, name)) for name, _ in COUNTERS)
+        d['latency_buckets'] = list(zip(LATENCY_BUCKETS + (float('inf'),), self.buckets))
+        d['latency_sum'] = self.latency_sum
+        d['latency_count'] = self.latency_count
+        return d
+
+    def __repr__(self):
+        return 'PortStats(Port%d, Type=0x%.2x, transactions=%d, retries=%d, timeouts=%d, errors=%d)' % (
+            self.port, self.ptype, self.transactions, self.retries, self.timeouts,
+            self.checksum_errors + self.invalid_commands + self.errors)
+
+
+class BusStats(object):
+    """
+    Statistics for a MateNET bus, keyed by (port, packet type)
+    """
+    def __init__(self):
+        self.entries = {}  # {(port, ptype): PortStats}
+
+    def get(self, port, ptype):
+        """
+        :return: The PortStats for a port and packet type (created if necessary)
+        """
+        key = (port, ptype)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = PortStats(port, ptype)
+        return entry
+
+    def __iter__(self):
+        # Copy, since the bus may add entries from another thread
+        return iter(sorted(list(self.entries.values()), key=lambda s: (s.port, s.ptype)))
+
+    def reset(self):
+        self.entries = {}
+
+    def record(self, txn):
+        """
+        Record a completed transaction
+        :param txn: TransactionRecord
+        """
+        s = self.get(txn.port, txn.ptype)
+        s.transactions += 1
+        s.retries += txn.retries
+        s.tx_bytes += txn.tx_bytes
+        s.rx_bytes += txn.rx_bytes
+        if txn.t_first_byte is not None:
+            s.add_latency(txn.latency)
+
+    def timeout(self, port, ptype):
+        """
+        Record an attempt that received no response
+        """
+        self.get(port, ptype).timeouts += 1
+
+    def error(self, port, ptype, exc):
+        """
+        Record an attempt that failed with an exception
+        """
+        s = self.get(port, ptype)
+        if isinstance(exc, ChecksumError):
+            s.checksum_errors += 1
+        elif isinstance(exc, InvalidCommandError):
+            s.invalid_commands += 1
+        else:
+            s.errors += 1
+
+    def to_dict(self):
+        """
+        :return: {(port, ptype): {counter: value, ...}}
+        """
+        return dict(((s.port, s.ptype), s.to_dict()) for s in self)
+
+    def to_prometheus(self, prefix='pymate_matenet'):
+        """
+        Export the statistics in the Prometheus text exposition format
+        :return: str
+        """
+        entries = list(self)
+        lines = []
+        for name, description in COUNTERS:
+            metric = '%s_%s_total' % (prefix, name)
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % metric)
+            for s in entries:
+                lines.append('%s{port="%d",ptype="%d"} %d' % (metric, s.port, s.ptype, getattr(s, name)))
+
+        metric = '%s_response_latency_seconds' % prefix
+        lines.append('# HELP %s Time from sending a packet to the first byte of the response' % metric)
+        lines.append('# TYPE %s histogram' % metric)
+        for s in entries:
+            labels = 'port="%d",ptype="%d"' % (s.port, s.ptype)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + (None,), s.buckets):
+                cumulative += count
+                le = '+Inf' if bound is None else repr(bound)
+                lines.append('%s_bucket{%s,le="%s"} %d' % (metric, labels, le, cumulative))
+            lines.append('%s_sum{%s} %r' % (metric, labels, s.latency_sum))
+            lines.append('%s_count{%s} %d' % (metric, labels, s.latency_count))
+
+        return '\n'.join(lines) + '\n'
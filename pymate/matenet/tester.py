@@ -13,7 +13,7 @@
 #
 __author__ = 'Jared'
 
-from pymate.matenet import MateNET, MateNETPJON, MateDevice
+from pymate.matenet import MateNET, MateNETPJON, MateDevice, MateMXDevice, MateFXDevice, MateDCDevice
 from struct import pack
 import settings
 import time
@@ -30,6 +30,14 @@ class MateTester(MateNET):
     (PC connected to MATE)
     EXPERIMENTAL
     """
+    # The device class being emulated.
+    # Any register in its REGISTERS table can be read/written (see process_read())
+    DEVICE_CLASS = MateDevice
+
+    def __init__(self, *args, **kwargs):
+        super(MateTester, self).__init__(*args, **kwargs)
+        self.registers = {}  # Raw register values, {addr: value}
+
     def send_packet(self, byte0, payload):
         """
         Send a MateNET packet
@@ -157,10 +165,21 @@ class MateTester(MateNET):
         Query a register, and return the value to the MATE
         (Override this in your subclass)
         """
+        if query.reg in self.DEVICE_CLASS.REGISTER_ADDRS:
+            reg = self.DEVICE_CLASS.REGISTER_ADDRS[query.reg]
+            log.info('%s = %d', reg.name, self.registers.get(query.reg, 0))
+            return self.registers.get(query.reg, 0)
+
         print "Unknown query! (0x%.4x, port:%d)" % (query.reg, port)
         return 0
 
     def process_write(self, port, query):
+        reg = self.DEVICE_CLASS.REGISTER_ADDRS.get(query.reg)
+        if reg is not None and reg.writable:
+            log.info('%s := %d', reg.name, query.param)
+            self.registers[query.reg] = query.param
+            return query.param
+
         print "Unknown control! (0x%.4x, port:%d)" % (query.reg, port)
         return 0
 
@@ -193,6 +212,7 @@ class MXEmulator(MateTester):
     so we can see how the MATE unit responds
     """
     DEVICE = MateNET.DEVICE_MX
+    DEVICE_CLASS = MateMXDevice
 
     def packet_received(self, packet):
         # Let the superclass handle packets first
@@ -345,6 +365,7 @@ class FXEmulator(MateTester):
     so we can see how the MATE unit responds
     """
     DEVICE = MateNET.DEVICE_FX
+    DEVICE_CLASS = MateFXDevice
 
     def packet_received(self, packet):
         # Let the superclass handle packets first
@@ -507,6 +528,7 @@ class FlexNETDCEmulator(MateTester):
     so we can see how the MATE unit responds
     """
     DEVICE = MateNET.DEVICE_FLEXNETDC
+    DEVICE_CLASS = MateDCDevice
 
     def packet_received(self, packet):
         # Let the superclass handle packets first
@@ -0,0 +1,111 @@
+# pyMATE transaction records
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Records when each part of a bus transaction happened, so that samples can be
+# timestamped with when the device actually responded, rather than when Python
+# got around to decoding them (eg. for integrating power over time).
+#
+# Times are taken from a monotonic clock. Each record also has a wall-clock anchor
+# (taken when the packet was sent), which is used to convert them to wall-clock time.
+#
+# Usage:
+#   resp, txn = bus.send(MateNET.TYPE_STATUS, addr=1, port=1, record=True)
+#   print txn.latency, txn.rx_time
+#
+
+__author__ = 'Jared'
+
+from pymate.util import monotonic
+from datetime import datetime, timedelta
+
+
+class TransactionRecord(object):
+    """
+    Timing of a single MateNET transaction (including any retries)
+    """
+    def __init__(self, port, ptype, addr, param=0):
+        self.port = port
+        self.ptype = ptype
+        self.addr = addr
+        self.param = param
+
+        self.t_send = None        # Monotonic time the (last) packet was sent
+        self.t_first_byte = None  # Monotonic time the first byte of the response arrived
+        self.t_last_byte = None   # Monotonic time the last byte of the response arrived
+        self.retries = 0          # Number of times the packet was re-sent
+        self.tx_bytes = 0         # Bytes sent, including checksums and retries
+        self.rx_bytes = 0         # Bytes received, including checksum
+
+        # Wall-clock anchor (UTC), and the monotonic time it corresponds to
+        self.wall_anchor = None
+        self.mono_anchor = None
+
+    def sent(self, nbytes):
+        """
+        Called each time the packet is sent
+        """
+        self.t_send = monotonic()
+        if self.mono_anchor is None:
+            self.wall_anchor = datetime.utcnow()
+            self.mono_anchor = self.t_send
+        else:
+            self.retries += 1
+        self.tx_bytes += nbytes
+
+        # Discard the timing of a previous (failed) attempt
+        self.t_first_byte = None
+        self.t_last_byte = None
+        self.rx_bytes = 0
+
+    def received(self, nbytes, t_first_byte=None, t_last_byte=None):
+        """
+        Called when the response has been received
+        :param t_first_byte: When the first byte arrived, if known by the port
+        :param t_last_byte: When the last byte arrived, if known by the port
+        """
+        now = monotonic()
+        self.t_first_byte = t_first_byte if t_first_byte is not None else now
+        self.t_last_byte = t_last_byte if t_last_byte is not None else now
+        self.rx_bytes = nbytes
+
+    @property
+    def latency(self):
+        """
+        :return: Time from sending the packet to the first byte of the response (seconds), or None
+        """
+        if self.t_first_byte is None:
+            return None
+        return self.t_first_byte - self.t_send
+
+    @property
+    def duration(self):
+        """
+        :return: Time taken to receive the response (seconds), or None
+        """
+        if self.t_first_byte is None:
+            return None
+        return self.t_last_byte - self.t_first_byte
+
+    def wall_time(self, t):
+        """
+        Convert a monotonic time from this record to wall-clock time
+        :return: datetime (UTC)
+        """
+        if t is None:
+            return None
+        return self.wall_anchor + timedelta(seconds=(t - self.mono_anchor))
+
+    @property
+    def rx_time(self):
+        """
+        :return: Wall-clock time (UTC) that the response started arriving, or None if there was no response.
+            This is the closest time to when the device sampled its readings.
+        """
+        return self.wall_time(self.t_first_byte)
+
+    def __repr__(self):
+        if self.t_first_byte is None:
+            return 'TransactionRecord(Port%d, Type=0x%.2x, Addr=0x%.4x, no response, retries=%d)' % (
+                self.port, self.ptype, self.addr, self.retries)
+        return 'TransactionRecord(Port%d, Type=0x%.2x, Addr=0x%.4x, latency=%.1fms, duration=%.1fms, retries=%d)' % (
+            self.port, self.ptype, self.addr, self.latency * 1000.0, self.duration * 1000.0, self.retries)
@@ -0,0 +1,208 @@
+# pyMATE adaptive polling scheduler
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# Polls each source (eg. a device status, or a single register) at a rate
+# that depends on how much its value is changing:
+#  - When the value changes, the poll interval is shortened (down to min_interval)
+#  - When the value is stable, the poll interval is lengthened (up to max_interval)
+#
+# The bus is shared by all sources, so the total time spent polling is limited
+# to a fraction of the bus time (budget). If the sources would exceed it,
+# all intervals are stretched, so the bus is never saturated.
+# If that still isn't enough (every source is at its max_interval),
+# polls are deferred beyond max_interval.
+#
+# Usage:
+#   sched = AdaptiveScheduler(budget=0.5)
+#   sched.add('mx-status', mx.get_status, min_interval=2.0, max_interval=60.0, key=lambda s: s.raw)
+#   sched.add('fx-inv-current', lambda: fx.inverter_current, min_interval=1.0, max_interval=30.0, tolerance=0.5)
+#
+#   def on_change(source, value):
+#       print source.name, value
+#   sched.run(on_change)
+#
+
+__author__ = 'Jared'
+
+from pymate.util import monotonic
+from time import sleep
+import logging
+
+log = logging.getLogger('mate.scheduler')
+
+
+class PollSource(object):
+    """
+    A value that is polled by the AdaptiveScheduler
+    """
+    def __init__(self, name, poll, min_interval, max_interval, key=None, tolerance=None):
+        """
+        :param name: Name of the source
+        :param poll: Function which reads the value from the bus (returns None on failure)
+        :param min_interval: Shortest time between polls (seconds)
+        :param max_interval: Longest time between polls (seconds)
+        :param key: Function which extracts the part of the value to compare (eg. lambda s: s.raw)
+        :param tolerance: For numeric values, changes smaller than this are ignored
+        """
+        self.name = name
+        self.poll = poll
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        self.key = key
+        self.tolerance = tolerance
+
+        self.interval = self.min_interval  # Current poll interval (seconds)
+        self.due = monotonic()             # When the next poll is due
+        self.last_poll = None              # When the source was last polled
+        self.cost = 0.0                    # Average bus time used by one poll (seconds)
+        self.value = None                  # Last value read
+        self.polls = 0
+        self.changes = 0
+        self._last_key = None
+
+    def changed(self, new_key):
+        """
+        :return: True if the value has changed significantly since the last poll
+        """
+        old_key = self._last_key
+        if old_key is None:
+            return True
+        if self.tolerance is not None:
+            try:
+                return abs(new_key - old_key) > self.tolerance
+            except TypeError:
+                pass  # Not numeric
+        return new_key != old_key
+
+    def __repr__(self):
+        return 'PollSource(%s, interval=%.1fs)' % (self.name, self.interval)
+
+
+class AdaptiveScheduler(object):
+    """
+    Polls several sources, adapting the rate of each one to how quickly it is changing
+    """
+    def __init__(self, budget=0.5):
+        """
+        :param budget: Fraction of bus time that polling may use (0..1)
+        """
+        self.budget = budget
+        self.sources = []
+
+        # Poll interval is multiplied by this after a change
+        self.SPEEDUP = 0.5
+        # Poll interval is multiplied by this after a poll with no change
+        self.BACKOFF = 1.5
+        # Weight of the latest poll in the average cost of a source
+        self.COST_WEIGHT = 0.2
+
+        # True while the sources can't be polled within the budget, even at their max_interval
+        # (polls are then deferred, see _apply_budget())
+        self.overloaded = False
+
+    def add(self, name, poll, min_interval, max_interval, key=None, tolerance=None):
+        """
+        Add a source to poll (see PollSource)
+        :return: PollSource
+        """
+        source = PollSource(name, poll, min_interval, max_interval, key, tolerance)
+        self.sources.append(source)
+        return source
+
+    @property
+    def load(self):
+        """
+        :return: Estimated fraction of bus time used by polling, at the current intervals
+        """
+        return sum(source.cost / source.interval for source in self.sources)
+
+    def poll(self, source):
+        """
+        Poll a source now, and adjust its interval
+        :return: True if the value changed
+        """
+        t_start = monotonic()
+        try:
+            value = source.poll()
+        except Exception:
+            log.exception('Error polling %s', source.name)
+            value = None
+        t_end = monotonic()
+
+        source.polls += 1
+        source.last_poll = t_start
+        source.cost += (t_end - t_start - source.cost) * self.COST_WEIGHT
+        source.due = t_start + source.interval
+
+        if value is None:
+            return False  # No response, try again at the same rate
+
+        new_key = source.key(value) if source.key else value
+        changed = source.changed(new_key)
+        source.value = value
+        if changed:
+            source._last_key = new_key
+            source.changes += 1
+            source.interval = max(source.min_interval, source.interval * self.SPEEDUP)
+        else:
+            source.interval = min(source.max_interval, source.interval * self.BACKOFF)
+        source.due = t_start + source.interval
+        return changed
+
+    def _apply_budget(self):
+        """
+        Stretch all intervals if polling would use more than the budgeted bus time.
+        Intervals are limited to max_interval, so if the load is still too high,
+        the next poll of each source is deferred (without changing its interval).
+        """
+        load = self.load
+        if load > self.budget and load > 0:
+            factor = load / self.budget
+            for source in self.sources:
+                source.interval = min(source.max_interval, source.interval * factor)
+                if source.last_poll is not None:
+                    source.due = source.last_poll + source.interval
+            load = self.load
+
+        overloaded = (load > self.budget) and (load > 0)
+        if overloaded != self.overloaded:
+            self.overloaded = overloaded
+            if overloaded:
+                log.warning('Polling needs %.0f%% of the bus (budget %.0f%%), even at the longest intervals. '
+                            'Deferring polls.', load * 100.0, self.budget * 100.0)
+            else:
+                log.info('Polling is within budget again (%.0f%% of the bus)', load * 100.0)
+
+        if overloaded:
+            factor = load / self.budget
+            for source in self.sources:
+                if source.last_poll is not None:
+                    source.due = source.last_poll + source.interval * factor
+
+    def run_pending(self, callback=None):
+        """
+        Poll any sources which are due
+        :param callback: Called with (source, value) whenever a value changes
+        :return: Seconds until the next source is due
+        """
+        now = monotonic()
+        for source in sorted(self.sources, key=lambda s: s.due):
+            if source.due > now:
+                break
+            if self.poll(source) and callback:
+                callback(source, source.value)
+
+        self._apply_budget()
+
+        if not self.sources:
+            return None
+        return max(0.0, min(source.due for source in self.sources) - monotonic())
+
+    def run(self, callback=None):
+        """
+        Poll forever
+        :param callback: Called with (source, value) whenever a value changes
+        """
+        while True:
+            delay = self.run_pending(callback)
+            sleep(1.0 if delay is None else delay)
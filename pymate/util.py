@@ -5,3 +5,42 @@ def hexstr2bin(s):
 
 def bin2hexstr(s):
     return ' '.join('%.2x' % ord(x) for x in s)
+
+
+def _monotonic_clock():
+    """
+    Find the best available monotonic clock.
+    (Python 2 doesn't provide time.monotonic, so use clock_gettime directly where possible)
+    """
+    import time
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_MONOTONIC = 1  # Linux
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+
+        def monotonic():
+            t = timespec()
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t))
+            return t.tv_sec + (t.tv_nsec * 1e-9)
+        return monotonic
+
+    except (ImportError, OSError, AttributeError, TypeError):
+        # No monotonic clock available (eg. Windows), fall back to wall-clock time
+        return time.time
+
+# Seconds since an arbitrary point in time, unaffected by changes to the system clock
+monotonic = _monotonic_clock()
@@ -1,26 +1,49 @@
 __author__ = 'Jared'
 
-class Value(object):
+class Value(float):
     """
     Formatted value with units
     Provides a way to represent a number with units such as Volts and Watts.
+
+    A Value is a float, so it can be used directly in arithmetic and comparisons
+    (the result of arithmetic is a plain float).
+    The units and resolution are only used when the value is converted to a string.
     """
-    def __init__(self, value, units=None, resolution=0):
-        self.value = float(value)
+    __slots__ = ('units', 'resolution')
+
+    def __new__(cls, value, units=None, resolution=0):
+        self = float.__new__(cls, value)
         self.units = units
         self.resolution = resolution
-        self.fmt = "%%.%df" % resolution
-        if self.units:
-            self.fmt += str(self.units)
+        return self
+
+    @property
+    def value(self):
+        # For compatibility, a Value used to wrap a float
+        return float(self)
 
     def __str__(self):
-        return self.fmt % self.value
+        s = '%.*f' % (self.resolution, self)
+        if self.units:
+            s += str(self.units)
+        return s
 
     def __repr__(self):
         return self.__str__()
 
-    def __float__(self):
-        return float(self.value)
+    def __format__(self, spec):
+        if not spec:
+            return self.__str__()
+        return float.__format__(self, spec)
 
-    def __int__(self):
-        return int(self.value)
+    def __reduce__(self):
+        return (Value, (float(self), self.units, self.resolution))
+
+
+def to_floats(values):
+    """
+    Convert many values (Value, int, str, etc.) to plain floats at once
+    :param values: iterable of values, any of which may be None
+    :return: list of float (None where the value was None)
+    """
+    return [None if v is None else float(v) for v in values]
@@ -71,9 +71,13 @@ print_device(d0)
 # Child devices attached to a hub
 # (Only valid if the root device is a hub)
 if dtype == MateNET.DEVICE_HUB:
+    topology = bus.enumerate()  # Quickly find which ports are in use
     for i in range(1,10):
-        subdev = MateDevice(bus, port=i)
-        print_device(subdev)
+        if topology[i]:
+            subdev = MateDevice(bus, port=i)
+            print_device(subdev)
+        else:
+            print('Port%d: -' % i)
 
 print
 print('Finished!')
\ No newline at end of file
@@ -23,5 +23,8 @@ setup(
     ],
     packages=['pymate', 'pymate.matenet'],
     install_requires=['pyserial'],
+    extras_require={
+        'bulk': ['numpy'],  # pymate.matenet.bulk
+    },
     python_requires='>=2.7,!=3.*',
 )
@@ -0,0 +1,112 @@
+# pyMATE test helpers
+# Author: Jared Sanson <jared@jared.geek.nz>
+#
+# A pseudo-terminal stands in for the serial port, and a background thread on the
+# master side plays the part of the hardware (a MateNET device, or a PJON bridge).
+#
+
+__author__ = 'Jared'
+
+from pymate.matenet import MateNETSerial
+from serial import Serial, PARITY_NONE
+from struct import unpack
+import threading
+import select
+import pty
+import os
+
+
+class PtyPeer(object):
+    """
+    The far end of a pseudo-terminal.
+    handler(data) is called from a background thread with whatever is written to the port,
+    and returns any data to write back (or None).
+
+    Usage:
+    peer = PtyPeer(handler)
+    port = MateNETSerial(Serial(peer.name, 9600))
+    ...
+    peer.close()
+    """
+    def __init__(self, handler=None):
+        self.master, self.slave = pty.openpty()
+        self.name = os.ttyname(self.slave)
+        self.handler = handler
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='pty %s' % self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        with self.lock:
+            os.write(self.master, data)
+
+    def _run(self):
+        while not self._stop.is_set():
+            r, _, _ = select.select([self.master], [], [], 0.02)
+            if not r:
+                continue
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+            if self.handler:
+                response = self.handler(data)
+                if response:
+                    self.write(response)
+
+    def close(self):
+        self._stop.set()
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class PtySerial(Serial):
+    """
+    A serial port on a pseudo-terminal.
+    A pty has no parity bit (and some kernels reject parity settings on one),
+    so parity changes are only recorded, not applied.
+    """
+    def _reconfigure_port(self, force_update=False):
+        parity, self._parity = self._parity, PARITY_NONE
+        try:
+            super(PtySerial, self)._reconfigure_port(force_update)
+        finally:
+            self._parity = parity
+
+
+class MateResponder(object):
+    """
+    Emulates a MateNET device (for PtyPeer).
+    Collects the request packets as they arrive, and answers each one with
+    respond(port, ptype, addr, param), which returns the raw response (excluding checksum),
+    or None to not respond.
+    """
+    REQUEST_LEN = 6 + 2  # [port][ptype][addr:16][param:16] + checksum
+
+    def __init__(self, respond, frame=None):
+        """
+        :param frame: Function which converts an encoded response into what is written to the port
+            (eg. to add PARMRK markers), None to write it as-is
+        """
+        self.respond = respond
+        self.frame = frame
+        self.buffer = ''
+        self.requests = []  # (port, ptype, addr, param)
+
+    def __call__(self, data):
+        self.buffer += data
+        output = ''
+        while len(self.buffer) >= self.REQUEST_LEN:
+            packet = MateNETSerial._parse_packet(self.buffer[:self.REQUEST_LEN], self.REQUEST_LEN)
+            self.buffer = self.buffer[self.REQUEST_LEN:]
+
+            request = unpack('>BBHH', packet)
+            self.requests.append(request)
+            response = self.respond(*request)
+            if response is not None:
+                response = MateNETSerial.encode_packet(response)
+                output += self.frame(response) if self.frame else response
+        return output
@@ -0,0 +1,25 @@
+# Tests for CollectionEngine
+#
+
+__author__ = 'Jared'
+
+from pymate.engine import CollectionEngine
+import unittest
+
+
+class EngineTest(unittest.TestCase):
+    def test_stats_running_task(self):
+        # The running task (taken off the heap) is still included in the statistics
+        engine = CollectionEngine()
+        reports = []
+        engine.add('a', lambda: reports.append(sorted(engine.stats())), interval=0.01, delay=0)
+        engine.add('b', lambda: None, interval=0.01, delay=1.0)
+
+        engine.run_once()
+        self.assertEqual(reports, [['a', 'b']])
+        self.assertEqual(sorted(engine.stats()), ['a', 'b'])
+        self.assertEqual(engine.stats()['a'].runs, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+# Round-trip tests for AsyncMateNET/EventLoop over pseudo-terminals
+#
+
+__author__ = 'Jared'
+
+from ptyhelper import PtyPeer, MateResponder
+from test_pjon import Bridge, pjon_frame, register_value
+from pymate.matenet import MateNET, MateNETSerial, MateNETPJON, EventLoop, AsyncMateNET
+from pymate.matenet.arbiter import BusFuture
+from serial import Serial
+import unittest
+
+
+class EventLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+        self.peers = []
+        self.buses = []
+
+    def tearDown(self):
+        for bus in self.buses:
+            bus.close()
+            bus.port.ser.close()
+        for peer in self.peers:
+            peer.close()
+
+    def add_bus(self, handler, port_class=MateNETSerial):
+        peer = PtyPeer(handler)
+        self.peers.append(peer)
+        if port_class is MateNETPJON:
+            port = MateNETPJON(Serial(peer.name, 9600), use_packet_id=True)
+        else:
+            port = MateNETSerial(Serial(peer.name, 9600), supports_spacemark=True, calibration_file=None)
+        bus = AsyncMateNET(port, self.loop, topology_file=None)
+        bus.RESPONSE_TIMEOUT = 0.2
+        self.buses.append(bus)
+        return bus
+
+    def test_two_buses(self):
+        # Both buses are driven by the same loop, and their transactions overlap
+        responder1 = MateResponder(lambda port, ptype, addr, param: '\x02\x00\x01')
+        responder2 = MateResponder(lambda port, ptype, addr, param: '\x02\x00\x02')
+        bus1 = self.add_bus(responder1)
+        bus2 = self.add_bus(responder2)
+
+        futures = [
+            bus1.submit(MateNET.TYPE_QUERY, 0x0010, port=1),
+            bus2.submit(MateNET.TYPE_QUERY, 0x0020, port=2),
+            bus1.submit(MateNET.TYPE_QUERY, 0x0030, port=1),
+        ]
+        results = self.loop.run_until_complete(BusFuture.gather(futures), timeout=5.0)
+        self.assertEqual(results, ['\x00\x01', '\x00\x02', '\x00\x01'])
+        self.assertEqual([r[2] for r in responder1.requests], [0x0010, 0x0030])
+        self.assertEqual([r[2] for r in responder2.requests], [0x0020])
+
+    def test_blocking(self):
+        # The blocking API runs the loop until the transaction completes
+        bus = self.add_bus(MateResponder(lambda port, ptype, addr, param: '\x02\x12\x34'))
+        self.assertEqual(bus.query(0x0010), 0x1234)
+
+        resp, txn = bus.send(MateNET.TYPE_QUERY, 0x0010, record=True)
+        self.assertEqual(resp, '\x12\x34')
+        self.assertIsNotNone(txn.latency)
+        self.assertEqual(bus.stats.get(0, MateNET.TYPE_QUERY).transactions, 2)
+
+    def test_priority(self):
+        # Controls jump ahead of queued queries (the first query has already been sent)
+        responder = MateResponder(lambda port, ptype, addr, param: '\x02\x00\x00')
+        bus = self.add_bus(responder)
+        futures = [
+            bus.submit(MateNET.TYPE_QUERY, 0x0001),
+            bus.submit(MateNET.TYPE_QUERY, 0x0002),
+            bus.submit(MateNET.TYPE_CONTROL, 0x0003, 1),
+        ]
+        self.loop.run_until_complete(BusFuture.gather(futures), timeout=5.0)
+        self.assertEqual([r[2] for r in responder.requests], [0x0001, 0x0003, 0x0002])
+
+    def test_retry(self):
+        # The first attempt gets no response
+        attempts = []
+        def respond(port, ptype, addr, param):
+            attempts.append(addr)
+            if len(attempts) > 1:
+                return '\x02\x00\x10'
+        bus = self.add_bus(MateResponder(respond))
+
+        self.assertEqual(bus.query(0x0010), 0x0010)
+        self.assertEqual(attempts, [0x0010, 0x0010])
+        s = bus.stats.get(0, MateNET.TYPE_QUERY)
+        self.assertEqual(s.timeouts, 1)
+        self.assertEqual(s.transactions, 1)
+
+    def test_no_response(self):
+        responder = MateResponder(lambda port, ptype, addr, param: None)
+        bus = self.add_bus(responder)
+        self.assertEqual(bus.send(MateNET.TYPE_QUERY, 0x0010), None)
+        self.assertEqual(len(responder.requests), bus.RETRY_PACKET + 1)
+
+        # The bus is free for the next transaction
+        responder.respond = lambda port, ptype, addr, param: '\x02\x00\x20'
+        self.assertEqual(bus.query(0x0020), 0x0020)
+
+    def test_send_many(self):
+        # Same signature and results as MateNET.send_many()
+        def respond(port, ptype, addr, param):
+            if ptype == MateNET.TYPE_STATUS:
+                return '\x02' + '\x00' * 13
+            if addr != 0x0002:
+                return '\x02\x00\x01'
+        bus = self.add_bus(MateResponder(respond))
+        requests = [(MateNET.TYPE_QUERY, addr, 0, 1) for addr in (0x0001, 0x0002)]
+        requests.append((MateNET.TYPE_STATUS, 0x0001, 0, 1, MateNET.DEVICE_MX))
+        results = bus.send_many(requests, record=True)
+
+        self.assertEqual([resp for resp, txn in results], ['\x00\x01', None, '\x00' * 13])
+        self.assertEqual([txn.addr for resp, txn in results], [0x0001, 0x0002, 0x0001])
+        self.assertIsNotNone(results[0][1].latency)
+        self.assertIsNone(results[1][1].latency)
+        self.assertEqual(bus.stats.get(1, MateNET.TYPE_QUERY).transactions, 2)
+
+    def test_probe(self):
+        responder = MateResponder(lambda port, ptype, addr, param: '\x02\x00\x03' if port == 1 else None)
+        bus = self.add_bus(responder)
+        self.assertEqual(bus.probe(1), MateNET.DEVICE_MX)
+        self.assertEqual(bus.probe(2), None)
+        self.assertEqual(len(responder.requests), 2)  # A silent port is not retried
+
+        self.assertEqual(bus.stats.get(1, MateNET.TYPE_QUERY).transactions, 1)
+        self.assertEqual(bus.stats.get(1, MateNET.TYPE_QUERY).latency_count, 1)
+        self.assertEqual(bus.stats.get(2, MateNET.TYPE_QUERY).transactions, 1)
+        self.assertEqual(bus.stats.get(2, MateNET.TYPE_QUERY).timeouts, 1)
+
+    def test_end_of_packet(self):
+        # Without early completion, the response ends when the bus goes idle
+        bus = self.add_bus(MateResponder(lambda port, ptype, addr, param: '\x02\x12\x34'))
+        bus.port.EARLY_COMPLETION = False
+        self.assertEqual(bus.query(0x0010), 0x1234)
+
+    def test_pjon_late_response(self):
+        # A late response to the first attempt arrives just before the response to the retry
+        dropped = []
+        def respond(packet_id, port, ptype, addr, param):
+            if not dropped:
+                dropped.append(packet_id)
+                return ''
+            return pjon_frame(dropped[0], '\x02\xEE\xEE') + pjon_frame(packet_id, register_value(addr))
+        bridge = Bridge(respond)
+        bus = self.add_bus(bridge, MateNETPJON)
+
+        self.assertEqual(bus.query(0x0010), 0x0010)
+        self.assertEqual([r[0] for r in bridge.requests], [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# Tests for StatusPacket decoding from different buffer types
+#
+
+__author__ = 'Jared'
+
+from pymate.matenet.mx import MXStatusPacket
+import unittest
+
+
+class PacketTest(unittest.TestCase):
+    def setUp(self):
+        self.data = ''.join(chr(i) for i in range(MXStatusPacket.size))
+
+    def test_raw_str(self):
+        packet = MXStatusPacket.from_buffer(self.data)
+        self.assertIs(packet.raw, self.data)  # Not copied
+        self.assertEqual(packet.raw_view.tobytes(), self.data)
+
+    def test_raw_buffer(self):
+        # raw is always a str, which doesn't change if the buffer is reused
+        for buffer in (bytearray(self.data), memoryview(bytearray(self.data))):
+            packet = MXStatusPacket.from_buffer(buffer)
+            raw = packet.raw
+            self.assertEqual(type(raw), str)
+            self.assertEqual(raw, self.data)
+
+            buffer[0] = '\xFF'
+            self.assertEqual(raw, self.data)
+            self.assertEqual(packet.raw_view[0], '\xFF')
+
+    def test_raw_offset(self):
+        buffer = bytearray('\x00' * 3 + self.data * 2)
+        packets = list(MXStatusPacket.iter_from_buffer(buffer, 3))
+        self.assertEqual(len(packets), 2)
+        for packet in packets:
+            self.assertEqual(packet.raw, self.data)
+            self.assertEqual(len(packet.raw_view), MXStatusPacket.size)
+
+        packet = MXStatusPacket.from_buffer('\x00' * 3 + self.data, 3)
+        self.assertEqual(packet.raw, self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+# Round-trip tests for MateNETPJON over a pseudo-terminal, against an emulated PJON bridge
+#
+
+__author__ = 'Jared'
+
+from ptyhelper import PtyPeer
+from pymate.matenet import MateNET, MateNETPJON
+from pymate.matenet.matenet_pjon import SFSPDecoder, SFSP_START, SFSP_END, SFSP_ESCAPES, CRC8_TABLE
+from serial import Serial
+from struct import unpack
+import unittest
+
+
+def crc8(data):
+    crc = 0
+    for b in data:
+        crc = CRC8_TABLE[crc ^ b]
+    return crc
+
+
+def pjon_frame(packet_id, payload):
+    """
+    Build a response frame, as sent by the bridge
+    :param payload: The MateNET response (command ack byte + data, excluding checksum)
+    """
+    buffer = bytearray([1, 0x02 | 0x80, 0, 0, 0x0A, packet_id >> 8, packet_id & 0xFF]) + bytearray(payload)
+    buffer[2] = len(buffer) + 1
+    buffer[3] = crc8(buffer[:3])
+    buffer.append(crc8(buffer))
+
+    data = bytes(buffer)
+    for b, escaped in SFSP_ESCAPES:
+        data = data.replace(b, escaped)
+    return chr(SFSP_START) + data + chr(SFSP_END)
+
+
+class Bridge(object):
+    """
+    Emulates a PJON bridge (for PtyPeer).
+    Each request is passed to respond(packet_id, port, ptype, addr, param),
+    which returns the frames to send back (see pjon_frame()).
+    """
+    def __init__(self, respond):
+        self.respond = respond
+        self.decoder = SFSPDecoder()
+        self.requests = []  # (packet_id, port, ptype, addr, param)
+
+    def __call__(self, data):
+        output = ''
+        for frame in self.decoder.feed(data):
+            # [ID][Header][Length][CRC][TX ID][Packet ID:16][Target][MateNET packet...][CRC]
+            packet_id = (frame[5] << 8) | frame[6]
+            request = (packet_id,) + unpack('>BBHH', bytes(frame[8:14]))
+            self.requests.append(request)
+            output += self.respond(*request)
+        return output
+
+
+def register_value(addr):
+    # The value of each emulated register
+    return '\x02' + chr(addr >> 8) + chr(addr & 0xFF)
+
+
+class PJONTest(unittest.TestCase):
+    def setUp(self):
+        self.bridge = Bridge(lambda packet_id, port, ptype, addr, param: pjon_frame(packet_id, register_value(addr)))
+        self.peer = PtyPeer(self.bridge)
+        self.port = MateNETPJON(Serial(self.peer.name, 9600), use_packet_id=True)
+        self.bus = MateNET(self.port, topology_file=None)
+
+    def tearDown(self):
+        self.port.ser.close()
+        self.peer.close()
+
+    def test_query(self):
+        self.assertEqual(self.bus.query(0x1234, port=1), 0x1234)
+        self.assertEqual(self.bridge.requests, [(1, 1, MateNET.TYPE_QUERY, 0x1234, 0)])
+
+    def test_late_response(self):
+        # The first attempt gets no response, and its response arrives late,
+        # just before the response to the retry. It must not be taken as the answer.
+        dropped = []
+        def respond(packet_id, port, ptype, addr, param):
+            if not dropped:
+                dropped.append(packet_id)
+                return ''
+            return pjon_frame(dropped[0], '\x02\xEE\xEE') + pjon_frame(packet_id, register_value(addr))
+        self.bridge.respond = respond
+
+        self.assertEqual(self.bus.query(0x0010), 0x0010)
+        self.assertEqual(len(self.bridge.requests), 2)
+        self.assertEqual(self.bus.stats.get(0, MateNET.TYPE_QUERY).timeouts, 1)
+
+    def test_pipelined(self):
+        # Responses arrive in the reverse order
+        held = []
+        def respond(packet_id, port, ptype, addr, param):
+            held.append(pjon_frame(packet_id, register_value(addr)))
+            if len(held) < 3:
+                return ''
+            return ''.join(reversed(held))
+        self.bridge.respond = respond
+
+        requests = [(MateNET.TYPE_QUERY, addr, 0, 1) for addr in (0x0001, 0x0002, 0x0003)]
+        results = self.bus.send_many(requests, record=True)
+
+        self.assertEqual([resp for resp, txn in results], ['\x00\x01', '\x00\x02', '\x00\x03'])
+        self.assertEqual([txn.addr for resp, txn in results], [0x0001, 0x0002, 0x0003])
+        self.assertTrue(all(txn.latency is not None for resp, txn in results))
+
+        s = self.bus.stats.get(1, MateNET.TYPE_QUERY)
+        self.assertEqual(s.transactions, 3)
+        self.assertEqual(s.latency_count, 3)
+        self.assertEqual(s.tx_bytes, 3 * 8)
+        self.assertEqual(s.rx_bytes, 3 * 5)
+
+    def test_pipelined_fallback(self):
+        # A packet that gets no response is re-sent on its own
+        def respond(packet_id, port, ptype, addr, param):
+            if packet_id == 2:
+                return ''
+            return pjon_frame(packet_id, register_value(addr))
+        self.bridge.respond = respond
+        self.port.ser.timeout = 0.1
+
+        requests = [(MateNET.TYPE_QUERY, addr, 0, 1) for addr in (0x0001, 0x0002, 0x0003)]
+        self.assertEqual(self.bus.send_many(requests), ['\x00\x01', '\x00\x02', '\x00\x03'])
+        self.assertEqual([r[3] for r in self.bridge.requests], [0x0001, 0x0002, 0x0003, 0x0002])
+        self.assertEqual(self.bus.stats.get(1, MateNET.TYPE_QUERY).retries, 1)
+
+    def test_pipelined_invalid_command(self):
+        # A rejected command is the device's answer, so it is not re-sent
+        def respond(packet_id, port, ptype, addr, param):
+            if addr == 0x0002:
+                return pjon_frame(packet_id, '\x82\x00\x00')
+            return pjon_frame(packet_id, register_value(addr))
+        self.bridge.respond = respond
+
+        requests = [(MateNET.TYPE_QUERY, addr, 0, 1) for addr in (0x0001, 0x0002, 0x0003)]
+        self.assertEqual(self.bus.send_many(requests), ['\x00\x01', None, '\x00\x03'])
+        self.assertEqual(len(self.bridge.requests), 3)
+
+        s = self.bus.stats.get(1, MateNET.TYPE_QUERY)
+        self.assertEqual(s.transactions, 3)
+        self.assertEqual(s.invalid_commands, 1)
+        self.assertEqual(s.retries, 0)
+
+    def test_feed_back_to_back(self):
+        # Two responses arrive in the same read. The second is kept until it is asked for.
+        packet_ids = [self.port.send('\x00\x02\x00\x01\x00\x00'), self.port.send('\x00\x02\x00\x02\x00\x00')]
+        data = pjon_frame(packet_ids[1], '\x02\x00\x02') + pjon_frame(packet_ids[0], '\x02\x00\x01')
+
+        self.port.recv_start(3, packet_id=packet_ids[0])
+        self.assertEqual(self.port.recv_feed(data[:-3]), None)
+        self.assertEqual(self.port.recv_feed(data[-3:]), '\x02\x00\x01')
+        self.port.recv_start(3, packet_id=packet_ids[1])
+        self.assertEqual(self.port.recv_feed(''), '\x02\x00\x02')
+
+        packet_ids = [self.port.send('\x00\x02\x00\x01\x00\x00'), self.port.send('\x00\x02\x00\x02\x00\x00')]
+        data = pjon_frame(packet_ids[0], '\x02\x00\x01') + pjon_frame(packet_ids[1], '\x02\x00\x02')
+
+        self.port.recv_start(3, packet_id=packet_ids[0])
+        self.assertEqual(self.port.recv_feed(data), '\x02\x00\x01')
+        self.port.recv_start(3, packet_id=packet_ids[1])
+        self.assertEqual(self.port.recv_feed(''), '\x02\x00\x02')
+
+
+class SFSPDecoderTest(unittest.TestCase):
+    def test_split_frames(self):
+        decoder = SFSPDecoder()
+        frame = pjon_frame(0x95EA, '\x02\xBB\x95')  # Bytes which must be escaped
+        self.assertEqual(decoder.feed(frame[:5]), [])
+        frames = decoder.feed(frame[5:] + frame)
+        self.assertEqual(len(frames), 2)
+        self.assertEqual(frames[0], frames[1])
+        self.assertEqual(bytes(frames[0][7:10]), '\x02\xBB\x95')
+
+    def test_oversized_frame(self):
+        # A frame with no SFSP_END is discarded, rather than growing without limit
+        decoder = SFSPDecoder()
+        decoder.feed(chr(SFSP_START))
+        for i in range(10):
+            decoder.feed('\x00' * SFSPDecoder.MAX_FRAME_LEN)
+        self.assertEqual(decoder.buffer, '')
+
+        frame = pjon_frame(1, '\x02\x00\x00')
+        self.assertEqual(len(decoder.feed(frame)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# Tests for AdaptiveScheduler, on a simulated clock
+#
+
+__author__ = 'Jared'
+
+from pymate import scheduler
+from pymate.scheduler import AdaptiveScheduler
+import unittest
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        # Each poll advances the simulated clock by the bus time it uses
+        self.now = 0.0
+        self.busy = 0.0
+        self._monotonic = scheduler.monotonic
+        scheduler.monotonic = lambda: self.now
+
+        self.sched = AdaptiveScheduler(budget=0.5)
+        self.sched.COST_WEIGHT = 1.0  # Use the cost of the last poll, rather than an average
+
+    def tearDown(self):
+        scheduler.monotonic = self._monotonic
+
+    def source(self, cost):
+        def poll():
+            self.now += cost
+            self.busy += cost
+            return 1  # Never changes
+        return poll
+
+    def run_for(self, duration):
+        t_end = self.now + duration
+        while self.now < t_end:
+            self.now += self.sched.run_pending()
+
+    def test_within_budget(self):
+        self.sched.add('a', self.source(0.01), min_interval=0.1, max_interval=1.0)
+        self.run_for(10.0)
+        self.assertFalse(self.sched.overloaded)
+        self.assertEqual(self.sched.sources[0].interval, 1.0)  # Backed off, since nothing changed
+
+    def test_stretch(self):
+        # The intervals are stretched (up to max_interval) to stay within the budget
+        for name in 'abcd':
+            self.sched.add(name, self.source(0.05), min_interval=0.1, max_interval=1.0)
+        self.run_for(10.0)
+        self.assertFalse(self.sched.overloaded)
+        self.assertLessEqual(self.sched.load, self.sched.budget + 1e-9)
+
+    def test_oversubscribed(self):
+        # Even at max_interval the sources need 100% of the bus, so polls are deferred
+        self.sched.add('a', self.source(0.05), min_interval=0.1, max_interval=0.1)
+        self.sched.add('b', self.source(0.05), min_interval=0.1, max_interval=0.1)
+
+        self.run_for(1.0)
+        self.assertTrue(self.sched.overloaded)
+
+        busy_start, t_start = self.busy, self.now
+        self.run_for(10.0)
+        self.assertLessEqual((self.busy - busy_start) / (self.now - t_start), self.sched.budget + 0.01)
+        self.assertTrue(all(source.interval == 0.1 for source in self.sched.sources))
+
+        # Cheaper polls bring it back within budget
+        for source in self.sched.sources:
+            source.poll = self.source(0.01)
+        self.run_for(1.0)
+        self.assertFalse(self.sched.overloaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# Round-trip tests for MateNETSerial over a pseudo-terminal
+#
+# A pty has no 9th bit, so the device side just sees the bytes of each packet.
+#
+
+__author__ = 'Jared'
+
+from ptyhelper import PtyPeer, PtySerial, MateResponder
+from pymate.matenet import MateNET, MateNETSerial
+from pymate.util import monotonic
+import unittest
+
+
+class SerialTest(unittest.TestCase):
+    def setUp(self):
+        self.responses = {}  # {addr: raw response}, None to not respond
+        self.frame = None    # Converts each encoded response into what is written to the port
+        self.responder = MateResponder(lambda port, ptype, addr, param: self.responses.get(addr),
+                                       frame=lambda data: self.frame(data) if self.frame else data)
+        self.peer = PtyPeer(self.responder)
+        self.port = MateNETSerial(PtySerial(self.peer.name, 9600), supports_spacemark=True, calibration_file=None)
+        self.bus = MateNET(self.port, topology_file=None)
+
+    def tearDown(self):
+        self.port.ser.close()
+        self.peer.close()
+
+    def test_exact_length(self):
+        self.responses[0x0010] = '\x02\x12\x34'
+        t_start = monotonic()
+        self.assertEqual(self.bus.query(0x0010, port=1), 0x1234)
+        self.assertEqual(self.responder.requests, [(1, MateNET.TYPE_QUERY, 0x0010, 0)])
+
+        # Returns as soon as the response arrives, without waiting for the bus to go idle
+        self.assertLess(monotonic() - t_start, self.port.END_OF_PACKET_TIMEOUT * 5)
+
+    def test_short(self):
+        # A response that is too short is retried, and then fails
+        self.responses[0x0010] = '\x02\x12'
+        with self.assertRaises(RuntimeError):
+            self.bus.query(0x0010)
+        self.assertEqual(len(self.responder.requests), self.bus.RETRY_PACKET + 1)
+        self.assertEqual(self.bus.stats.get(0, MateNET.TYPE_QUERY).errors, self.bus.RETRY_PACKET + 1)
+
+    def test_oversized(self):
+        # A response that is longer than expected is rejected (and retried),
+        # and its trailing bytes are not mistaken for the next response
+        self.responses[0x0010] = '\x02\x12\x34\x56'
+        with self.assertRaises(RuntimeError):
+            self.bus.send(MateNET.TYPE_QUERY, 0x0010, response_len=2)
+        self.assertEqual(len(self.responder.requests), self.bus.RETRY_PACKET + 1)
+        self.assertEqual(self.bus.stats.get(0, MateNET.TYPE_QUERY).errors, self.bus.RETRY_PACKET + 1)
+
+        self.responses[0x0020] = '\x02\x00\x20'
+        self.assertEqual(self.bus.query(0x0020), 0x0020)
+        self.assertEqual(self.bus.stats.get(0, MateNET.TYPE_QUERY).errors, self.bus.RETRY_PACKET + 1)
+
+    def test_response_lengths(self):
+        lookup = MateNET.lookup_response_len
+        self.assertEqual(lookup(MateNET.TYPE_QUERY, 0x0010), 2)
+        self.assertEqual(lookup(MateNET.TYPE_STATUS, 0x01), 13)
+        self.assertEqual(lookup(MateNET.TYPE_STATUS, 0x0A, MateNET.DEVICE_FLEXNETDC), 13)
+        self.assertEqual(lookup(MateNET.TYPE_LOG, 0x0000, MateNET.DEVICE_MX), 14)
+        self.assertEqual(lookup(MateNET.TYPE_LOG, 0x0000), None)
+
+    def test_send_many_device_type(self):
+        # The device type is used to look up the response length of each request
+        expected_lens = []
+        recv = self.port.recv
+        def recv_hook(expected_len=None, *args, **kwargs):
+            expected_lens.append(expected_len)
+            return recv(expected_len, *args, **kwargs)
+        self.port.recv = recv_hook
+
+        self.responses[0x0000] = '\x02' + '\x00' * 14
+        self.responses[0x0001] = '\x02' + '\x00' * 13
+        results = self.bus.send_many([
+            (MateNET.TYPE_LOG, 0x0000, 0, 1, MateNET.DEVICE_MX),
+            (MateNET.TYPE_STATUS, 0x0001, 0, 1),
+        ])
+        self.assertEqual(results, ['\x00' * 14, '\x00' * 13])
+        self.assertEqual(expected_lens, [15, 14])  # Including command ack byte
+
+    def test_probe(self):
+        self.responses[0x0000] = '\x02\x00\x03'
+        self.assertEqual(self.bus.probe(1), MateNET.DEVICE_MX)
+        self.responder.respond = lambda port, ptype, addr, param: None
+        self.assertEqual(self.bus.probe(2), None)
+
+        self.assertEqual(self.bus.stats.get(1, MateNET.TYPE_QUERY).transactions, 1)
+        self.assertEqual(self.bus.stats.get(1, MateNET.TYPE_QUERY).latency_count, 1)
+        self.assertEqual(self.bus.stats.get(2, MateNET.TYPE_QUERY).transactions, 1)
+        self.assertEqual(self.bus.stats.get(2, MateNET.TYPE_QUERY).timeouts, 1)
+
+    def test_leading_junk(self):
+        # A stray byte before the response is discarded, without retrying
+        self.responses[0x0010] = '\x02\x12\x34'
+        self.frame = lambda data: '\x55' + data
+        self.assertEqual(self.bus.query(0x0010), 0x1234)
+        self.assertEqual(len(self.responder.requests), 1)
+
+    def test_leading_junk_feed(self):
+        # Same as above, for the non-blocking interface
+        self.port.recv_start(3)
+        self.assertEqual(self.port.recv_feed('\x55\x02\x12\x34'), None)
+        self.assertEqual(self.port.recv_feed('\x00'), None)  # Checksum incomplete
+        self.assertEqual(self.port.recv_feed('\x48'), '\x02\x12\x34')
+
+    def test_bad_checksum(self):
+        self.port.recv_start(3)
+        self.assertEqual(self.port.recv_feed('\x02\x12\x34\x00\x00'), None)
+        with self.assertRaises(RuntimeError):
+            self.port.recv_end()
+
+
+if __name__ == '__main__':
+    unittest.main()
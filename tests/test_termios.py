@@ -0,0 +1,118 @@
+# Round-trip tests for MateNETTermios (native mark/space parity) over a pseudo-terminal
+#
+# A pty never reports parity errors, and would escape the PARMRK markers written by the
+# test (0xFF is doubled when PARMRK is set). So PARMRK is cleared on the pty,
+# and the device side writes exactly what a real UART driver would deliver:
+# '\xFF\x00' before a byte with the 9th bit set, and '\xFF\xFF' for a literal 0xFF.
+#
+
+__author__ = 'Jared'
+
+from ptyhelper import PtyPeer, MateResponder
+from pymate.matenet import MateNET, MateNETSerial
+from pymate.util import monotonic
+from serial import Serial, PARITY_EVEN
+import unittest
+import time
+import sys
+
+try:
+    import termios
+    from pymate.matenet.matenet_termios import MateNETTermios, CMSPAR
+except ImportError:
+    termios = None  # Not supported on this platform
+
+
+def mark(data):
+    """
+    Convert a packet into the PARMRK stream received from the bus
+    (the first byte has the 9th bit set)
+    """
+    escaped = data.replace('\xFF', '\xFF\xFF')
+    if data[0] == '\xFF':
+        return '\xFF\x00\xFF' + escaped[2:]
+    return '\xFF\x00' + escaped
+
+
+class PtyTermios(MateNETTermios if termios else object):
+    def __init__(self, comport):
+        super(PtyTermios, self).__init__(comport)
+        self.attrs[0] &= ~termios.PARMRK
+        termios.tcsetattr(self.fd, termios.TCSANOW, self.attrs)
+
+    def _check_attrs(self):
+        pass  # PARMRK is cleared deliberately (see above)
+
+
+@unittest.skipIf(termios is None or not sys.platform.startswith('linux'), 'Requires Linux termios')
+class TermiosTest(unittest.TestCase):
+    def setUp(self):
+        self.responses = {}  # {addr: raw response}, None to not respond
+        self.responder = MateResponder(lambda port, ptype, addr, param: self.responses.get(addr), frame=mark)
+        self.peer = PtyPeer(self.responder)
+        self.port = PtyTermios(Serial(self.peer.name, 9600))
+
+    def tearDown(self):
+        self.port.ser.close()
+        self.peer.close()
+
+    def test_settings(self):
+        # (A pty always clears PARENB, so check what the port asked for)
+        iflag, oflag, cflag = self.port.attrs[:3]
+        self.assertEqual(cflag & (termios.PARENB | CMSPAR), termios.PARENB | CMSPAR)
+        self.assertTrue(iflag & termios.INPCK)
+
+    def test_restore_settings(self):
+        # Changing the parity through pyserial clears CMSPAR, which is restored before the next packet
+        self.port.ser.parity = PARITY_EVEN
+        self.assertFalse(termios.tcgetattr(self.port.fd)[2] & CMSPAR)
+        MateNETTermios._check_attrs(self.port)
+        self.assertTrue(termios.tcgetattr(self.port.fd)[2] & CMSPAR)
+
+    def test_decode(self):
+        # Marked bytes, escaped 0xFF, and an escape sequence split across reads
+        self.assertEqual(self.port._decode('\x01\xFF\x00\x02\xFF\xFF'), [0x01, 0x102, 0xFF])
+        self.assertEqual(self.port._decode('\x03\xFF'), [0x03])
+        self.assertEqual(self.port._decode('\x00'), [])
+        self.assertEqual(self.port._decode('\x04\x05'), [0x104, 0x05])
+
+    def test_send(self):
+        data = []
+        self.peer.handler = data.append
+        self.port.send('\x01\x02\x00\x10\x00\x00')
+        time.sleep(0.1)
+        self.assertEqual(''.join(data), '\x01\x02\x00\x10\x00\x00\x00\x13')
+
+    def test_round_trip(self):
+        self.responses[0x0010] = '\x02\x12\xFF'  # Includes a byte that must be escaped
+        bus = MateNET(self.port, topology_file=None)
+        self.assertEqual(bus.query(0x0010, port=1), 0x12FF)
+        self.assertEqual(self.responder.requests, [(1, MateNET.TYPE_QUERY, 0x0010, 0)])
+
+    def test_split_response(self):
+        # The response arrives a byte at a time, with the escape sequence split up
+        def respond(data):
+            self.responder(data)
+            for b in mark(MateNETSerial.encode_packet('\x02\x12\x34')):
+                self.peer.write(b)
+                time.sleep(0.002)
+        self.peer.handler = respond
+        bus = MateNET(self.port, topology_file=None)
+        self.assertEqual(bus.query(0x0010), 0x1234)
+
+    def test_discard_before_start(self):
+        # Anything before the start of the packet (9th bit set) is discarded
+        self.port.send('\x00\x02\x00\x10\x00\x00')
+        self.peer.write('\x55\xAA' + mark(MateNETSerial.encode_packet('\x02\x12\x34')))
+        self.assertEqual(self.port.recv(3), '\x02\x12\x34')
+
+    def test_timeout(self):
+        bus = MateNET(self.port, topology_file=None)
+        bus.RETRY_PACKET = 0
+        t_start = monotonic()
+        self.assertEqual(bus.send(MateNET.TYPE_QUERY, 0x0020), None)
+        self.assertLess(monotonic() - t_start, 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()